@@ -16,12 +16,54 @@ import pandas as pd
 
 from Prop3D.common.AbstractStructure import AbstractStructure
 from Prop3D.common.ProteinTables import vdw_radii, vdw_aa_radii
+from Prop3D.util.local_h5 import is_local_h5, local_path, open_local_h5
 
 residue_columns = ["residue_id", "chain", "bfactor", "X", "Y", "Z"]
 atom_columns = ["serial_number", "atom_name", "residue_id", "chain", "bfactor",
 "X", "Y", "Z"]
 entity_levels = ["A", "R", "C", "M", "S"]
 
+def apply_feature_updates(group: Union[h5pyd.Group, h5py.Group], table: str, data: np.recarray) -> np.recarray:
+    """Overlay feature columns stored in companion tables ({table}_updates/{category}),
+    written when only a subset of features were recalculated, onto the base table.
+    Updated columns replace the base columns of the same name and new columns are
+    appended.
+
+    Parameters
+    ----------
+    group : h5pyd.Group or h5py.Group
+        Group for the domain containing the base table
+    table : str
+        Name of base table, 'atom' or 'residue'
+    data : structured numpy array
+        Base table already read in
+
+    Returns
+    -------
+    Structured numpy array with all updates applied
+    """
+    updates_key = f"{table}_updates"
+    if updates_key not in group:
+        return data
+
+    index_col = "residue_id" if table == "residue" else "serial_number"
+
+    for category in group[updates_key].keys():
+        update = group[f"{updates_key}/{category}"][:]
+        if len(update) != len(data) or not np.array_equal(update[index_col], data[index_col]):
+            raise RuntimeError(f"Feature update {updates_key}/{category} does not match the {table} table")
+
+        update_names = [name for name in update.dtype.names if name != index_col]
+        new_names = [name for name in update_names if name not in data.dtype.names]
+        if len(new_names) > 0:
+            data = numpy.lib.recfunctions.append_fields(data, new_names,
+                [update[name] for name in new_names], usemask=False)
+
+        for name in update_names:
+            data[name] = update[name]
+
+    return data
+
 class DistributedStructure(AbstractStructure):
     """A structure class to deal with structures originated from a distributed
      HSDS instance.
@@ -29,7 +71,8 @@ class DistributedStructure(AbstractStructure):
     Parameters
     ----------
     path : str
-        path to h5 file in HSDS endpoint to access structures
+        path to h5 file in HSDS endpoint to access structures, or a local h5 file
+        with the same layout (prefix with file:// if ambiguous)
     key : str
         Key to access speficic protein inside the HDF file
     cath_domain_dataset : str
@@ -46,12 +89,17 @@ class DistributedStructure(AbstractStructure):
         if cath_domain_dataset is None:
             #Full key given
             try:
-                self.f = h5pyd.File(path, use_cache=False)
+                self.f = self._open(path)
                 try:
                     self.full_key = key
                     cath_domain_dataset = self.f[key]
                 except KeyError:
-                    raise RuntimeError(f"Structure with key {key} does not exist in {path}")
+                    if isinstance(self.f, h5py.File) and "atom" in self.f:
+                        #Local file with a single structure
+                        cath_domain_dataset = self.f
+                        self.full_key = Path(local_path(path)).stem
+                    else:
+                        raise RuntimeError(f"Structure with key {key} does not exist in {path}")
             except IOError:
                 #Might be file:
                 try:
@@ -65,7 +113,7 @@ class DistributedStructure(AbstractStructure):
         elif isinstance(cath_domain_dataset, str):
             try:
                 #Name of domain
-                self.f = h5pyd.File(path, use_cache=False)
+                self.f = self._open(path)
                 try:
                     self.full_key = f"{key}/domains/{cath_domain_dataset}"
                     cath_domain_dataset = self.f[f"{key}/domains/{cath_domain_dataset}"]
@@ -74,8 +122,8 @@ class DistributedStructure(AbstractStructure):
             except IOError:
                 #Might be file
                 raise RuntimeError("cath_domain_dataset must be a group within an hsds dataset")
-        elif not isinstance(cath_domain_dataset, h5pyd.Group):
-            raise RuntimeError("cath_domain_dataset must be None (key suppllied w/ previous argument), a domain name within the key, or a h5pyd.Group")
+        elif not isinstance(cath_domain_dataset, (h5pyd.Group, h5py.Group)):
+            raise RuntimeError("cath_domain_dataset must be None (key suppllied w/ previous argument), a domain name within the key, or a h5pyd.Group or h5py.Group")
         else:
             #Is is already a group
             self.full_key = cath_domain_dataset.name
@@ -101,6 +149,7 @@ class DistributedStructure(AbstractStructure):
 
         if coarse_grained:
             self.data = self.cath_domain_dataset["residue"][:]
+            self.data = apply_feature_updates(self.cath_domain_dataset, "residue", self.data)
             self.pdb_info = self.data[residue_columns]
             self.feature_names = [name for name in self.data.dtype.names if name not in residue_columns]
             self.features = self.data[self.feature_names]
@@ -109,18 +158,27 @@ class DistributedStructure(AbstractStructure):
                 self.data = self.cath_domain_dataset["atom"][:]
             except:
                 assert 0, (self.cath_domain_dataset, list(self.cath_domain_dataset.keys()))
+            self.data = apply_feature_updates(self.cath_domain_dataset, "atom", self.data)
             self.pdb_info = self.data[atom_columns]
             self.feature_names = [name for name in self.data.dtype.names if name not in atom_columns]
             self.features = self.data[self.feature_names]
 
+        if self.f is not None:
+            #Everything is read, do not keep local files locked
+            self.f.close()
+
         self.n = len(self.data)
         self.coords = None
         self.get_coords()
 
         super().__init__(f"{key}-{self.cath_domain}", coarse_grained=coarse_grained)
 
-        if self.f is not None:
-            self.f.close()
+    @staticmethod
+    def _open(path: str) -> Union[h5pyd.File, h5py.File]:
+        """Open an HSDS domain, or a local h5 file with the same layout"""
+        if is_local_h5(path):
+            return open_local_h5(path, "r")
+        return h5pyd.File(path, use_cache=False)
 
     def deep_copy_feature(self, feature_name: str, memo: Any) -> Any:
         """Deep copy a  specific feature
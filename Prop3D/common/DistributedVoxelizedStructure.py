@@ -1,5 +1,5 @@
 from collections import defaultdict
-from typing import Union
+from typing import Union, Any
 from collections.abc import Iterator
 
 import numpy as np
@@ -64,6 +64,9 @@ class DistributedVoxelizedStructure(DistributedStructure):
 
         self.features = self.features[self.use_features]
 
+        #Keep input frame to sample maps calculated from the original structure, e.g. APBS
+        self.original_coords = self.get_coords().copy()
+
         if rotate is None or (isinstance(rotate, bool) and not rotate):
             self.shift_coords_to_volume_center()
             self.set_voxel_size(self.voxel_size)
@@ -528,6 +531,47 @@ class DistributedVoxelizedStructure(DistributedStructure):
         self.voxel_tree = spatial.cKDTree(list(zip(mx.ravel(), my.ravel(), mz.ravel())))
         #spatial.cKDTree(self.get_coords())
 
+    def get_original_frame_coords(self, coords: np.array) -> np.array:
+        """Map coordinates from the current (shifted, rotated, or oriented) frame back into
+        the frame of the input structure. The transform is fit from the atoms' current and
+        original coordinates, so any combination of moves is supported.
+
+        Parameters
+        ----------
+        coords : (n, 3) array
+            Coordinates in the current frame, e.g. voxel centers
+        """
+        current = self.get_coords()
+        ok = ~(np.isnan(current).any(axis=1) | np.isnan(self.original_coords).any(axis=1))
+        ones = np.ones((ok.sum(), 1))
+        transform, *_ = np.linalg.lstsq(np.hstack((current[ok], ones)), self.original_coords[ok], rcond=None)
+        coords = np.asarray(coords).reshape(-1, 3)
+        return np.hstack((coords, np.ones((len(coords), 1)))) @ transform
+
+    def interpolate_grid_at_voxels(self, grid: Any, voxels: Union[np.array, None] = None,
+                                   fill_value: float = np.nan) -> np.array:
+        """Sample a grid calculated for the input structure (e.g. a cached APBS potential map,
+        see Prop3D.util.dx.DXGrid and APBS.get_dx_grid_from_pdb) at voxel centers with
+        trilinear interpolation, without rerunning the solver
+
+        Parameters
+        ----------
+        grid : DXGrid
+            Grid in the frame of the input structure
+        voxels : (n, 3) array or None
+            Voxel centers in the current frame. If None, use every voxel in the volume
+            (see set_voxel_size)
+        fill_value : float
+            Value of voxels outside of the grid. Default NaN
+
+        Returns
+        -------
+        (n,) array of values in the same order as the voxels
+        """
+        if voxels is None:
+            voxels = self.voxel_tree.data
+        return grid.interpolate(self.get_original_frame_coords(voxels), fill_value=fill_value)
+
     def convert_voxels(self, grid: np.array, radius: float = 2.75, level: str = "A") -> Union[np.array, list[np.array]]:
         """Convert grid points to atoms
 
@@ -946,3 +946,30 @@ def get_dihedral(p0: np.array, p1: np.array, p2: np.array, p3: np.array) -> floa
     x = np.dot(v, w)
     y = np.dot(np.cross(b1, v), w)
     return np.degrees(np.arctan2(y, x))
+
+def angles_between(v1: np.array, v2: np.array) -> np.array:
+    """Vectorized version of angle_between for two (N,3) arrays of vectors. Returns
+    an N-vector of angles in radians; rows with a zero length vector are NaN.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        v1_u = v1 / np.linalg.norm(v1, axis=1)[:, None]
+        v2_u = v2 / np.linalg.norm(v2, axis=1)[:, None]
+        return np.arccos(np.clip(np.einsum("ij,ij->i", v1_u, v2_u), -1.0, 1.0))
+
+def get_dihedrals(p0: np.array, p1: np.array, p2: np.array, p3: np.array) -> np.array:
+    """Vectorized version of get_dihedral for four (N,3) arrays of points. Returns
+    an N-vector of torsion angles in degrees.
+    """
+    b0 = -1.0*(p1 - p0)
+    b1 = p2 - p1
+    b2 = p3 - p2
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        b1 = b1 / np.linalg.norm(b1, axis=1)[:, None]
+
+    v = b0 - np.einsum("ij,ij->i", b0, b1)[:, None]*b1
+    w = b2 - np.einsum("ij,ij->i", b2, b1)[:, None]*b1
+
+    x = np.einsum("ij,ij->i", v, w)
+    y = np.einsum("ij,ij->i", np.cross(b1, v), w)
+    return np.degrees(np.arctan2(y, x))
@@ -1,5 +1,5 @@
 import os
-from typing import Any, TypeVar
+from typing import Any, TypeVar, Callable, Union
 import yaml
 from collections import OrderedDict
 
@@ -15,6 +15,97 @@ non_geom_features_names = ["get_atom_type", "get_charge_and_electrostatics",
         "get_deepsite_features", "get_evolutionary_conservation_score"]
 
 FeaturesType = TypeVar('FeaturesType', bound='Features')
+
+def feature_dtype(feature_names: list[str]) -> np.dtype:
+    """Compile a structured dtype with a float64 field for each feature
+
+    Parameters
+    ----------
+    feature_names : list of str
+        Names of features in order
+    """
+    return np.dtype([(name, np.float64) for name in feature_names])
+
+def broadcast_defaults(defaults: pd.Series, n: int) -> np.array:
+    """Broadcast a vector of default feature values into a preallocated (n, nfeatures)
+    C-contiguous float64 block
+
+    Parameters
+    ----------
+    defaults : pd.Series
+        Default value for each feature
+    n : int
+        Number of rows (atoms or residues)
+    """
+    block = np.empty((n, len(defaults)), dtype=np.float64)
+    block[:] = defaults.to_numpy(dtype=np.float64)
+    return block
+
+comparisons = {">": np.greater, "<": np.less, ">=": np.greater_equal, "<=": np.less_equal, "!=": np.not_equal}
+
+def compile_threshold(threshold: Union[float, list[float]], equality: Union[str, list[str]]) -> Callable[[np.array], np.array]:
+    """Compile threshold and equality rules from a feature YAML into a vectorized
+    predicate. The predicate returns 1. where all rules pass, 0. where any rule
+    fails, and NaN where the input value is NaN
+
+    Parameters
+    ----------
+    threshold : float or list of 2 floats
+        Value(s) to compare to
+    equality : str or list of 2 strs
+        Comparison(s) to make, one of >, <, >=, <=, !=
+    """
+    if isinstance(threshold, (list, tuple)):
+        if not isinstance(equality, (list, tuple)) or len(threshold)!=2:
+            raise RuntimeError("If using two inequality values, they must both be lists or tuples of length 2")
+    else:
+        threshold, equality = [threshold], [equality]
+
+    try:
+        rules = [(comparisons[e], float(t)) for e, t in zip(equality, threshold)]
+    except KeyError:
+        raise RuntimeError("Unknown equality")
+
+    def predicate(values: np.array) -> np.array:
+        values = np.asarray(values, dtype=np.float64)
+        passed = np.ones(values.shape, dtype=bool)
+        for compare, t in rules:
+            passed &= compare(values, t)
+        return np.where(np.isnan(values), np.nan, passed.astype(np.float64))
+
+    return predicate
+
+def apply_threshold_rules(df: pd.DataFrame, rules: dict[str, tuple[str, Callable]],
+                          features: Union[list[str], None] = None) -> pd.DataFrame:
+    """Fill in every thresholded feature whose source feature is a column in df. The
+    DataFrame is updated in place and returned
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Features with continuous values already calculated
+    rules : dict
+        Thresholded feature names mapped to their (source feature, predicate)
+    features : list of str or None
+        Only fill in these thresholded features. If None, fill in all of them.
+    """
+    for name, (from_feature, predicate) in rules.items():
+        if features is not None and name not in features:
+            continue
+        if from_feature in df.columns:
+            df[name] = predicate(df[from_feature].to_numpy())
+    return df
+
+def default_feature_df(defaults: pd.Series, n: int) -> pd.DataFrame:
+    """Wrap a block of default values as a DataFrame without copying"""
+    return pd.DataFrame(broadcast_defaults(defaults, n), columns=defaults.index, copy=False)
+
+def default_feature_np(defaults: pd.Series, n: int, dtype: np.dtype) -> np.recarray:
+    """View a block of default values as a record array without copying. The dtype
+    must have one float64 field per default value"""
+    block = broadcast_defaults(defaults, n)
+    return block.reshape(-1).view(dtype).view(np.recarray)
+
 class Features(object):
     """Read in feature YAML file for eas parsing
 
@@ -57,6 +148,10 @@ class Features(object):
             index=self.residue_features,
             dtype=np.float64)
 
+        #Compiled once per feature set so default tables can be built by broadcasting
+        self.atom_feature_dtype = feature_dtype(self.atom_features)
+        self.residue_feature_dtype = feature_dtype(self.residue_features)
+
         self.atom_feature_thresholds = {feature["name"]:(feature["threshold"], feature["equality"]) \
             for category in self.features for feature in list(category.values())[0]\
             if "threshold" in feature}
@@ -65,6 +160,15 @@ class Features(object):
             for category in self.features for feature in list(category.values())[0] \
             if feature["residue"] and "threshold" in feature}
 
+        #Vectorized predicates to create boolean features from their source feature
+        self.atom_threshold_rules = OrderedDict([(feature["name"], (feature.get("from_feature"),
+            compile_threshold(feature["threshold"], feature["equality"]))) \
+            for category in self.features for feature in list(category.values())[0]\
+            if "threshold" in feature])
+
+        self.residue_threshold_rules = OrderedDict([(name, rule) for name, rule in \
+            self.atom_threshold_rules.items() if name in self.residue_feature_thresholds])
+
         self.atom_bool_features = [feature["name"] for category in self.features for feature in \
             list(category.values())[0] if feature["bool"]]
 
@@ -99,7 +203,7 @@ class Features(object):
         natoms: int
             Number of atoms to include in new data frame
         """
-        return pd.concat([self.default_atom_features] * natoms, axis=1).T
+        return default_feature_df(self.default_atom_features, natoms)
 
     def default_residue_feature_df(self, nres: int) -> pd.DataFrame:
         """Get a residue feature DataFrame with default values for every feature. Columns are features names
@@ -109,7 +213,7 @@ class Features(object):
         nres: int
             Number of residues to include in new data frame
         """
-        return pd.concat([self.default_residue_features] * nres, axis=1).T
+        return default_feature_df(self.default_residue_features, nres)
 
     def default_atom_feature_np(self, natoms: int) -> np.recarray:
         """Get an atom feature record array with default values for every feature. Columns are features names
@@ -119,9 +223,7 @@ class Features(object):
         natoms: int
             Number of atoms to include in new data frame
         """
-        df = self.default_atom_feature_df(natoms)
-        ds_dt = np.dtype({'names':df.columns,'formats':df.dtypes.values()})
-        return np.rec.fromarrays(df.values , dtype=ds_dt)
+        return default_feature_np(self.default_atom_features, natoms, self.atom_feature_dtype)
 
     def default_residue_feature_np(self, nres: int) -> np.recarray:
         """Get a residue feature record array with default values for every feature. Columns are features names
@@ -131,56 +233,49 @@ class Features(object):
         nres: int
             Number of residues to include in new data frame
         """
-        df = self.default_residue_feature_df(nres)
-        ds_dt = np.dtype({'names':df.columns,'formats':df.dtypes.values()})
-        return np.rec.fromarrays(df.values , dtype=ds_dt)
+        return default_feature_np(self.default_residue_features, nres, self.residue_feature_dtype)
 
-    def check_threshold(self, feature_name: str, raw_value: float, residue: bool = False) -> float:
+    def check_threshold(self, feature_name: str, raw_value: Union[float, np.array], residue: bool = False) -> Union[float, np.array]:
         """Create new boolean features by thresholding continuous value features
 
         Parameters
         ----------
         feature_name : str
             Name of new feature
-        raw_value : flaot
-            Value of continuous value feature
+        raw_value : float or array
+            Value(s) of continuous value feature
         residue : bool
             Feature calculated at the residue level
-        """
-        if raw_value == np.nan:
-            return np.nan
 
+        Returns
+        -------
+        1. if the value passes the threshold, 0. if not, NaN if the value is NaN.
+        An array is returned if an array is passed in.
+        """
         if not residue:
-            threshold, equality = self.atom_feature_thresholds[feature_name]
+            _, predicate = self.atom_threshold_rules[feature_name]
         else:
-            threshold, equality = self.residue_feature_thresholds[feature_name]
+            _, predicate = self.residue_threshold_rules[feature_name]
 
-        if isinstance(threshold, (list, tuple)):
-            if not isinstance(equality, (list, tuple)) or len(threshold)!=2:
-                raise RuntimeError("If using two inequality values, they must both be lists or tuples of length 2")
-            
-        else:
-            threshold, equality = [threshold], [equality]
-
-        val = True
-
-        for e, t in zip(equality, threshold):
-            if e == ">":
-                val_ = raw_value>t
-            elif e == "<":
-                val_ = raw_value<t
-            elif e == "<=":
-                val_ = raw_value<=t
-            elif e == ">=":
-                val_ = raw_value>=t
-            elif e == "!=":
-                val_ = raw_value!=t
-            else:
-                raise RuntimeError("Unknown equality")
+        value = predicate(raw_value)
+        return float(value) if value.ndim == 0 else value
 
-            val = val and val_
+    def apply_thresholds(self, df: pd.DataFrame, residue: bool = False, features: Union[list[str], None] = None) -> pd.DataFrame:
+        """Fill in all boolean features from their source features in one pass over
+        whole columns. The DataFrame is updated in place and returned
 
-        return float(val)
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Atom or residue features with continuous values already calculated
+        residue : bool
+            Features are at the residue level
+        features : list of str or None
+            Only fill in these boolean features, e.g. those from categories that
+            were calculated. If None, fill in all of them.
+        """
+        rules = self.residue_threshold_rules if residue else self.atom_threshold_rules
+        return apply_threshold_rules(df, rules, features=features)
 
     def number_of_features(self, only_aa: bool = False, only_atom: bool = False, non_geom_features: bool = False,
       use_deepsite_features: bool = False, coarse_grained: bool = False) -> int:
@@ -235,6 +330,38 @@ class AllFeatures(object):
     def __init__(self, *features: FeaturesType) -> None:
         self.features = features
 
+        #Combine defaults once, methods can't be merged by __getattr__
+        self.default_atom_features = pd.concat([f.default_atom_features for f in features])
+        self.default_residue_features = pd.concat([f.default_residue_features for f in features])
+        self.atom_feature_dtype = feature_dtype(self.default_atom_features.index)
+        self.residue_feature_dtype = feature_dtype(self.default_residue_features.index)
+        self.atom_threshold_rules = OrderedDict([rule for f in features for rule in f.atom_threshold_rules.items()])
+        self.residue_threshold_rules = OrderedDict([rule for f in features for rule in f.residue_threshold_rules.items()])
+
+    def check_threshold(self, feature_name: str, raw_value: Union[float, np.array], residue: bool = False) -> Union[float, np.array]:
+        """See Features.check_threshold"""
+        return Features.check_threshold(self, feature_name, raw_value, residue=residue)
+
+    def apply_thresholds(self, df: pd.DataFrame, residue: bool = False, features: Union[list[str], None] = None) -> pd.DataFrame:
+        """See Features.apply_thresholds"""
+        return Features.apply_thresholds(self, df, residue=residue, features=features)
+
+    def default_atom_feature_df(self, natoms: int) -> pd.DataFrame:
+        """See Features.default_atom_feature_df"""
+        return default_feature_df(self.default_atom_features, natoms)
+
+    def default_residue_feature_df(self, nres: int) -> pd.DataFrame:
+        """See Features.default_residue_feature_df"""
+        return default_feature_df(self.default_residue_features, nres)
+
+    def default_atom_feature_np(self, natoms: int) -> np.recarray:
+        """See Features.default_atom_feature_np"""
+        return default_feature_np(self.default_atom_features, natoms, self.atom_feature_dtype)
+
+    def default_residue_feature_np(self, nres: int) -> np.recarray:
+        """See Features.default_residue_feature_np"""
+        return default_feature_np(self.default_residue_features, nres, self.residue_feature_dtype)
+
     def __getattr__(self, __name: str) -> Any:
         """Combine features from many features"""
         if __name in dir(self):
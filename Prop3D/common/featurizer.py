@@ -1,23 +1,35 @@
 import os
+import time
+import resource
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import groupby
-from typing import Union, TypeVar
+from collections import OrderedDict
+from typing import Union, TypeVar, Callable, Any
 
 import pandas as pd
 import numpy as np
 from sklearn.gaussian_process.kernels import RBF
 from Bio import PDB
-import freesasa
 import networkx as nx
+from scipy import spatial
         
 
 import warnings
 warnings.simplefilter('ignore', PDB.PDBExceptions.PDBConstructionWarning)
 
+try:
+    import freesasa
+except ImportError:
+    freesasa = None
+
 from toil.job import Job
 from toil.realtimeLogger import RealtimeLogger
 
 from Prop3D.util.pdb import InvalidPDB
-from Prop3D.util import natural_keys, silence_stdout, silence_stderr
+from Prop3D.util.sasa import calculate_sasa
+from Prop3D.util.electrostatics import electrostatics_methods, get_atom_potentials_from_pqr
+from Prop3D.util import natural_keys, silence_stdout, silence_stderr, safe_remove
 from Prop3D.generate_data.data_stores import data_stores
 from Prop3D.parsers import mgltools
 from Prop3D.parsers.FreeSASA import run_freesasa_biopython
@@ -26,10 +38,67 @@ from Prop3D.parsers.cx import CX
 from Prop3D.parsers.dssp import DSSP
 from Prop3D.parsers.eppic import EPPICApi, EPPICLocal
 from Prop3D.parsers.frustratometeR import FrustratometeR
+from Prop3D.parsers.container import get_tool_time
 
-from Prop3D.common.LocalStructure import LocalStructure, AtomType, ResidueType, angle_between, get_dihedral
+from Prop3D.common.LocalStructure import LocalStructure, AtomType, ResidueType, angle_between, get_dihedral, \
+    angles_between, get_dihedrals
 from Prop3D.common.ProteinTables import hydrophobicity_scales
 from Prop3D.common.features import default_features, custom_features, all_features
+from Prop3D.custom_featurizers import load_custom_featurizer
+
+def instrument_category(func):
+    """Decorator for feature category methods to record the wall time, external
+    tool time (see Container), peak RSS increase and outcome of every call. Values
+    are accumulated per category and entity level in ProteinFeaturizer.feature_timings.
+    A category fails if its method raises, or if it handles a tool error itself and
+    reports it with ProteinFeaturizer.record_category_failure
+    """
+    category = func.__name__
+
+    @wraps(func)
+    def wrapper(self, *args, **kwds):
+        entity = args[0] if len(args) > 0 else None
+        if isinstance(entity, PDB.Atom.Atom):
+            level = "atom"
+        elif isinstance(entity, PDB.Residue.Residue):
+            level = "residue"
+        else:
+            level = "structure"
+
+        if category in self._active_categories:
+            #Category calls itself, only time the outermost call
+            return func(self, *args, **kwds)
+
+        record = self.feature_timings.setdefault((category, level), {
+            "category": category, "level": level, "calls": 0, "wall_time": 0.,
+            "tool_time": 0., "peak_rss_delta": 0, "status": "ok", "error": ""})
+
+        self._active_categories.add(category)
+        start_tool_time, _ = get_tool_time()
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        try:
+            result = func(self, *args, **kwds)
+            if category in self._failed_categories:
+                #Method saved defaults after a tool failed instead of raising
+                record["status"] = "failed"
+                record["error"] = self._failed_categories[category]
+            else:
+                self._calculated_categories.add((category, level))
+            return result
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record["calls"] += 1
+            record["wall_time"] += time.perf_counter()-start
+            record["tool_time"] += get_tool_time()[0]-start_tool_time
+            #ru_maxrss is in kilobytes on linux
+            record["peak_rss_delta"] += resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-start_rss
+            self._active_categories.discard(category)
+
+    return wrapper
 
 class ProteinFeaturizer(LocalStructure):
     """An object to calculate biophysical properties from a single protein in a local structure file
@@ -52,10 +121,27 @@ class ProteinFeaturizer(LocalStructure):
         List of features names or feature groups to update (while keeping the rest the same). Defualt is None, update all features
     features_path : path or None
         Path to save feature file. If None, use cwd.
+    tool_results : dict or None
+        Cache of per-chain EPPIC results shared between featurizers of domains cut from the
+        same PDB chain (see get_tool_result). If None, nothing is shared.
+    sasa_engine : "freesasa", "shrake_rupley" or None
+        Implementation used for atom SASA. "shrake_rupley" runs in process with NumPy
+        (Prop3D.util.sasa) with the same ProtOr radii as freesasa. If None, use freesasa
+        if it is installed, otherwise shrake_rupley.
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials. "apbs" solves the Poisson-Boltzmann equation
+        (default). "coulomb" and "debye_huckel" are fast in process approximations from the
+        pdb2pqr charges (see Prop3D.util.electrostatics). The method that was used for the
+        saved potentials is kept in electrostatics_method_used.
+    custom_feature_workers : int or None
+        Number of custom featurizers to run at the same time (in threads). If None, run
+        all of them at once.
     """
     def __init__(self, path: str, cath_domain: str, job: Union[Job, None], work_dir: Union[str, None],
                  input_format:str = "pdb", force_feature_calculation: bool = False, update_features: list[str] = None, \
-                 features_path: str = None, **kwds) -> None:
+                 features_path: str = None, tool_results: Union[dict, None] = None,
+                 sasa_engine: Union[str, None] = None, electrostatics_method: str = "apbs",
+                 custom_feature_workers: Union[int, None] = None, **kwds) -> None:
         feature_mode = "w+" if force_feature_calculation else "r"
         if features_path is None: # and update_features is not None:
             features_path = work_dir
@@ -69,6 +155,29 @@ class ProteinFeaturizer(LocalStructure):
         self.job = job
         self.work_dir = work_dir
         self.update_features = update_features
+        self.feature_timings = OrderedDict()
+        self._active_categories = set()
+        #(category, level) of every category that finished, see fill_threshold_features.
+        #Custom categories use the level 'custom' since they fill in their own thresholds
+        self._calculated_categories = set()
+        #Category to error of tools that failed without raising, see record_category_failure
+        self._failed_categories = {}
+        self.tool_results = tool_results
+
+        if sasa_engine is None:
+            sasa_engine = "freesasa" if freesasa is not None else "shrake_rupley"
+        elif sasa_engine not in ("freesasa", "shrake_rupley"):
+            raise ValueError("Unknown SASA engine: {}".format(sasa_engine))
+        self.sasa_engine = sasa_engine
+
+        if electrostatics_method not in electrostatics_methods:
+            raise ValueError("Unknown electrostatics method: {}".format(electrostatics_method))
+        self.electrostatics_method = electrostatics_method
+        self.electrostatics_method_used = None
+
+        self.custom_feature_workers = custom_feature_workers
+        self._custom_features_done = False
+        self._atom_residue_codes = None
 
     def calculate_flat_features(self, coarse_grained: bool = False, only_aa: bool = False, only_atom: bool = False,
       non_geom_features: bool = False, use_deepsite_features: bool = False, write: bool = True) -> tuple[list[pd.DataFrame], str]:
@@ -100,8 +209,10 @@ class ProteinFeaturizer(LocalStructure):
             features = [self.calculate_features_for_residue(
                 self._remove_inscodes(r), only_aa=only_aa,
                 non_geom_features=non_geom_features,
-                use_deepsite_features=use_deepsite_features) \
+                use_deepsite_features=use_deepsite_features,
+                fill_thresholds=False) \
                 for r in self.structure.get_residues()]
+            self.fill_threshold_features(coarse_grained=True)
             if write and (self.residue_feature_mode == "w+" or self.update_features is not None):
                 self.write_features(coarse_grained=True)
             return features, self.residue_features_file
@@ -109,8 +220,10 @@ class ProteinFeaturizer(LocalStructure):
             features = [self.calculate_features_for_atom(
                 self._remove_altloc(atom), only_aa=only_aa,
                 only_atom=only_atom, non_geom_features=non_geom_features,
-                use_deepsite_features=use_deepsite_features) \
+                use_deepsite_features=use_deepsite_features,
+                fill_thresholds=False) \
                 for atom in self.structure.get_atoms()]
+            self.fill_threshold_features()
             if write and (self.atom_feature_mode == "w+" or self.update_features is not None):
                 self.write_features()
             return features, self.atom_features_file
@@ -123,18 +236,151 @@ class ProteinFeaturizer(LocalStructure):
             non_geom_features=non_geom_features,
             use_deepsite_features=use_deepsite_features, write=write)
 
+    def get_tool_result(self, tool: str, calculate: Callable[[], Any]) -> Any:
+        """Get the result of an external tool that is run on the entire chain, reusing
+        the result from another domain of the same PDB chain if possible. Results are
+        keyed by (tool, pdb, chain), so chains with the same sequence (e.g. homo-oligomers)
+        do not share them. Only EPPIC conservation uses this, tools that depend on the
+        domain's geometry (DSSP, pdb2pqr, CX, ...) are run on each domain.
+
+        Parameters
+        ----------
+        tool : str
+            Name of tool
+        calculate : callable
+            Function with no arguments that runs the tool if there is no saved result
+        """
+        if self.tool_results is None:
+            return calculate()
+
+        key = (tool, self.pdb, self.chain)
+
+        try:
+            return self.tool_results[key]
+        except KeyError:
+            result = self.tool_results[key] = calculate()
+            return result
+
+    def get_update_categories(self, coarse_grained: bool = False) -> dict[str, list[str]]:
+        """Get the feature categories (and all of the columns they write) that
+        need to be recalculated to satisfy update_features. A whole category is
+        recalculated if any one of its features is requested since each get_*
+        method fills in every feature in its category.
+
+        Parameters
+        ----------
+        coarse_grained : bool
+            Use residue features. Default false (Atoms features)
+
+        Returns
+        -------
+        An OrderedDict mapping category names to the feature names inside each
+        category. Empty if update_features is None.
+        """
+        if self.update_features is None:
+            return OrderedDict()
+
+        if coarse_grained:
+            by_category = all_features.residue_features_by_category
+        else:
+            by_category = all_features.atom_features_by_category
+
+        return OrderedDict([(feat_type, feat_names) for feat_type, feat_names in \
+            by_category.items() if feat_type in self.update_features or \
+            any(feat_name in self.update_features for feat_name in feat_names)])
+
+    def record_category_failure(self, category: str, error: Exception) -> None:
+        """Mark a category as failed when its method catches a tool error and saves
+        defaults instead. The category is reported as failed in feature_timings and
+        its boolean features and update tables are not filled in.
+
+        Parameters
+        ----------
+        category : str
+            Name of the category method, e.g. get_evolutionary_conservation_score
+        error : Exception
+            The error that was handled
+        """
+        self._failed_categories[category] = f"{type(error).__name__}: {error}"
+        RealtimeLogger.info(f"{category} failed for {self.cath_domain}: {self._failed_categories[category]}")
+
+    def get_calculated_categories(self, coarse_grained: bool = False) -> set[str]:
+        """Get the feature categories that finished for every atom (or residue) so far,
+        including custom categories. In update mode only these are saved, categories
+        that were requested but did not finish keep their saved values.
+
+        Parameters
+        ----------
+        coarse_grained : bool
+            Use residue features. Default false (Atoms features)
+        """
+        level = "residue" if coarse_grained else "atom"
+        return {category for category, category_level in self._calculated_categories \
+            if category_level in (level, "custom")}
+
+    def get_feature_timings(self) -> list[dict[str, Union[str, int, float]]]:
+        """Get the timing and outcome of each feature category calculated so far
+        as structured records, one per category and entity level (atom, residue,
+        or structure for edges and custom features).
+
+        Returns
+        -------
+        List of dicts with keys domain, category, level, calls, wall_time (s),
+        tool_time (s, time spent running external programs), peak_rss_delta
+        (KB, increase in peak memory of this process), status ('ok' or 'failed',
+        see instrument_category), and error
+        """
+        return [{"domain": self.cath_domain, **record} for record in self.feature_timings.values()]
+
+    def fill_threshold_features(self, coarse_grained: bool = False, index: Union[list[Any], None] = None) -> None:
+        """Calculate every boolean (thresholded) feature over whole columns once the
+        continuous features are known. The get_* methods only save the continuous
+        values. Only categories that were calculated successfully are filled so
+        defaults of skipped categories are kept.
+
+        Parameters
+        ----------
+        coarse_grained : bool
+            Use residue features. Default false (Atoms features)
+        index : list or None
+            Only fill these atoms (serial numbers) or residues (ids). If None, fill all
+        """
+        if coarse_grained:
+            features, by_category, level = self.residue_features, all_features.residue_features_by_category, "residue"
+        else:
+            features, by_category, level = self.atom_features, all_features.atom_features_by_category, "atom"
+
+        calculated = [name for category, category_level in self._calculated_categories \
+            if category_level == level for name in by_category.get(category, [])]
+
+        if index is None:
+            all_features.apply_thresholds(features, residue=coarse_grained, features=calculated)
+            return
+
+        rows = features.index.get_indexer(index)
+        rows = rows[rows >= 0]
+        subset = all_features.apply_thresholds(features.iloc[rows].copy(), residue=coarse_grained,
+            features=calculated)
+        columns = [name for name in calculated if name in subset.columns]
+        features.iloc[rows, features.columns.get_indexer(columns)] = subset[columns].to_numpy()
+
     def get_features_per_atom(self, residue_list: list[ResidueType]) -> list[pd.DataFrame]:
         """Get features for each atom in a list of residues"""
-        features = [self.get_features_for_atom(self._remove_altloc(a)) for r in residue_list for a in r]
+        atoms = [self._remove_altloc(a) for r in residue_list for a in r]
+        features = [self.calculate_features_for_atom(a, fill_thresholds=False) for a in atoms]
+        self.fill_threshold_features(index=[a.serial_number for a in atoms])
         return features
 
     def get_features_per_residue(self, residue_list: list[ResidueType]) -> list[pd.DataFrame]:
         """Get features for each atom in a list of residues"""
-        features = [self.get_features_for_residue(self._remove_inscodes(r)) for r in residue_list]
+        residues = [self._remove_inscodes(r) for r in residue_list]
+        features = [self.calculate_features_for_residue(r, fill_thresholds=False) for r in residues]
+        self.fill_threshold_features(coarse_grained=True, index=[r.get_id() for r in residues])
         return features
 
     def calculate_features_for_atom(self, atom: PDB.Atom, only_aa: bool = False, only_atom: bool = False,
-      non_geom_features: bool = False, use_deepsite_features: bool = False, warn_if_buried: bool = False) -> Union[pd.DataFrame, tuple[pd.DataFrame, bool]]:
+      non_geom_features: bool = False, use_deepsite_features: bool = False, warn_if_buried: bool = False,
+      fill_thresholds: bool = True) -> Union[pd.DataFrame, tuple[pd.DataFrame, bool]]:
         """Calculate features for a single atom
         
         Parameters
@@ -151,6 +397,9 @@ class ProteinFeaturizer(LocalStructure):
             Copy features first used by DeepSite by classifying autodock names
         warn_if_buried : bool
             returns a bool if residue is buried or not from DSSP
+        fill_thresholds : bool
+            Fill in the boolean features of this entity. Set to False when
+            fill_threshold_features is run over whole columns afterwards
 
         Returns
         -------
@@ -160,19 +409,17 @@ class ProteinFeaturizer(LocalStructure):
             Is residue buried or not
         """
         if self.update_features is not None:
-            for feat_type, feat_names in all_features.atom_features_by_category.items():
-                if feat_type in self.update_features:
+            for feat_type in self.get_update_categories():
+                if hasattr(self, feat_type):
                     getattr(self, feat_type)(atom)
                 else:
-                    use_feats = [feat_name in self.update_features for feat_name \
-                        in feat_names]
-                    if any(use_feats):
-                        getattr(self, feat_type)(atom)
+                    #Category comes from a custom featurizer
+                    self.calculate_custom_features()
+            if fill_thresholds:
+                self.fill_threshold_features(index=[atom.serial_number])
             if warn_if_buried:
-                if "residue_buried" not in self.atom_features.columns:
-                    is_burried = self.get_accessible_surface_area(atom, save=False)
-                else:
-                    is_buried = self.atom_features.loc[atom.serial_number, "residue_buried"]
+                #residue_buried is not saved until fill_threshold_features
+                is_buried = self.get_accessible_surface_area(atom, save=False)
                 return self.atom_features, bool(is_buried["residue_buried"])
             else:
                 return self.atom_features
@@ -180,7 +427,7 @@ class ProteinFeaturizer(LocalStructure):
         if use_deepsite_features:
             self.get_deepsite_features(atom)
             if warn_if_buried:
-                is_burried = self.get_accessible_surface_area(atom, save=False)
+                is_buried = self.get_accessible_surface_area(atom, save=False)
         elif only_atom:
             self.get_element_type(atom)
             if warn_if_buried:
@@ -212,7 +459,9 @@ class ProteinFeaturizer(LocalStructure):
             self.get_frustration(atom)
             self.calculate_custom_features()
 
-            is_buried = self.atom_features.loc[atom.serial_number, "residue_buried"]
+            if warn_if_buried:
+                #residue_buried is not saved until fill_threshold_features
+                is_buried = self.get_accessible_surface_area(atom, save=False)
 
         # RealtimeLogger.info("Finished atom {} {}".format(atom, atom.serial_number))
         # RealtimeLogger.info("Feats {}".format(features))
@@ -223,13 +472,17 @@ class ProteinFeaturizer(LocalStructure):
 
         #RealtimeLogger.info("atom_features is {}".format(self.atom_features))
 
+        if fill_thresholds:
+            self.fill_threshold_features(index=[atom.serial_number])
+
         if warn_if_buried:
             return self.atom_features, bool(is_buried["residue_buried"])
         else:
             return self.atom_features
 
     def calculate_features_for_residue(self, residue: ResidueType, only_aa: bool = False, non_geom_features: bool = False,
-                                       use_deepsite_features: bool = False, warn_if_buried: bool = False) -> Union[pd.DataFrame, tuple[pd.DataFrame, bool]]:
+                                       use_deepsite_features: bool = False, warn_if_buried: bool = False,
+                                       fill_thresholds: bool = True) -> Union[pd.DataFrame, tuple[pd.DataFrame, bool]]:
         """Calculate features for a single atom
         
         Parameters
@@ -244,6 +497,9 @@ class ProteinFeaturizer(LocalStructure):
             Copy features first used by DeepSite by classifying autodock names
         warn_if_buried : bool
             returns a bool if residue is buried or not from DSSP
+        fill_thresholds : bool
+            Fill in the boolean features of this entity. Set to False when
+            fill_threshold_features is run over whole columns afterwards
 
         Returns
         -------
@@ -253,19 +509,17 @@ class ProteinFeaturizer(LocalStructure):
             Is residue buried or not
         """
         if self.update_features is not None:
-            for feat_type, feat_names in residue_features_by_category.items():
-                if feat_type in self.update_features:
+            for feat_type in self.get_update_categories(coarse_grained=True):
+                if hasattr(self, feat_type):
                     getattr(self, feat_type)(residue)
                 else:
-                    use_feats = [feat_name in self.update_features for feat_name \
-                        in feat_names]
-                    if any(use_feats):
-                        getattr(self, feat_type)(residue)
+                    #Category comes from a custom featurizer
+                    self.calculate_custom_features()
+            if fill_thresholds:
+                self.fill_threshold_features(coarse_grained=True, index=[residue.get_id()])
             if warn_if_buried:
-                if "residue_buried" not in self.residue_features.columns:
-                    is_buried = self.get_accessible_surface_area(residue, save=False)
-                else:
-                    is_buried = self.residue_features.loc[residue.get_id(), "residue_buried"]
+                #residue_buried is not saved until fill_threshold_features
+                is_buried = self.get_accessible_surface_area(residue, save=False)
                 return self.residue_features, bool(is_buried["residue_buried"])
             else:
                 return self.residue_features
@@ -293,13 +547,19 @@ class ProteinFeaturizer(LocalStructure):
             self.get_evolutionary_conservation_score(residue)
             self.get_frustration(residue)
             self.calculate_custom_features()
-            is_buried = self.residue_features.loc[[residue.get_id()], "residue_buried"]
+            if warn_if_buried:
+                #residue_buried is not saved until fill_threshold_features
+                is_buried = self.get_accessible_surface_area(residue, save=False)
+
+        if fill_thresholds:
+            self.fill_threshold_features(coarse_grained=True, index=[residue.get_id()])
 
         if warn_if_buried:
             return self.residue_features, bool(is_buried["residue_buried"])
         else:
             return self.residue_features
 
+    @instrument_category
     def get_atom_type(self, atom: AtomType) -> pd.DataFrame:
         """Get Autodock atom type for Bio.PDB.Atom"""
 
@@ -323,6 +583,7 @@ class ProteinFeaturizer(LocalStructure):
         return self.atom_features.loc[atom.serial_number,
             default_features.atom_features_by_category["get_atom_type"]]
 
+    @instrument_category
     def get_element_type(self, atom: AtomType) -> pd.DataFrame:
         """Get element name for Bio.PDB.Atom"""
         elems = "CNOS"
@@ -340,6 +601,7 @@ class ProteinFeaturizer(LocalStructure):
         return self.atom_features.loc[atom.serial_number,
             default_features.atom_features_by_category["get_element_type"]]
 
+    @instrument_category
     def get_vdw(self, atom_or_residue: Union[AtomType, ResidueType]) -> pd.DataFrame:
         """Get Van der Waals radius for Bio.PDB.Atom"""
         vdw = super().get_vdw(atom_or_residue)
@@ -355,6 +617,7 @@ class ProteinFeaturizer(LocalStructure):
             self.residue_features.loc[idx, "vdw_radii"] = vdw
             return self.residue_features.loc[idx, ["vdw_radii"]]
 
+    @instrument_category
     def get_charge_and_electrostatics(self, atom_or_residue: Union[AtomType, ResidueType], only_charge: bool = False,
                                       only_bool: bool = False, calculate: bool = True) -> pd.DataFrame:
         """Run pdb2par and APBS on an atom or residue to get charge and electrostatic information
@@ -404,30 +667,16 @@ class ProteinFeaturizer(LocalStructure):
         else:
             raise RuntimeError("Input must be Atom or Residue, not {}".format(atom_or_residue))
 
-        if self.update_features is not None:
-            if "electrostatic_potential" not in self.update_features and \
-              "is_electropositive" not in self.update_features and \
-              "is_electronegative" not in self.update_features:
-                 only_charge = True
-            if "get_charge_and_electrostatics" not in self.update_features:
-                calculate = False
-
         atoms = pd.concat([self.get_charge_and_electrostatics_for_atom(
             self._remove_altloc(a)) for a in residue], axis=0)
         charge_value = atoms["charge"].sum()
         electrostatic_pot_value = atoms["electrostatic_potential"].sum()
 
-        charge = [
-            charge_value,
-            default_features.check_threshold("neg_charge", charge_value, residue=True), #float(charge_value < 0)
-            default_features.check_threshold("pos_charge", charge_value, residue=True) #float(charge_value > 0)
-            ]
+        #Boolean features are filled by fill_threshold_features
+        charge = [charge_value, np.nan, np.nan]
         cols = default_features.residue_features_by_category["get_charge_and_electrostatics"][:3]
         if not only_charge:
-            charge += [
-                electrostatic_pot_value,
-                default_features.check_threshold("is_electronegative", electrostatic_pot_value, residue=True) #float(electrostatic_pot_value < 0)
-                ]
+            charge += [electrostatic_pot_value, np.nan]
             cols += default_features.residue_features_by_category["get_charge_and_electrostatics"][3:]
 
         if only_bool:
@@ -458,14 +707,6 @@ class ProteinFeaturizer(LocalStructure):
         if not isinstance(atom, PDB.Atom.Atom):
             raise RuntimeError("Input must be Atom")
 
-        if self.update_features is not None:
-            if "electrostatic_potential" not in self.update_features and \
-              "is_electropositive" not in self.update_features and \
-              "is_electronegative" not in self.update_features:
-                 only_charge = True
-            if "get_charge_and_electrostatics" not in self.update_features:
-                calculate = False
-
         if not hasattr(self, "_pqr"):
             self._pqr = {}
         if calculate and (len(self._pqr)==0 or (not only_charge and len(list(self._pqr.values())[0])==1)): #not hasattr(self, "_pqr")
@@ -473,9 +714,18 @@ class ProteinFeaturizer(LocalStructure):
                 if only_charge:
                     pdb2pqr = Pdb2pqr(work_dir=self.work_dir, job=self.job)
                     self._pqr = pdb2pqr.get_charge_from_pdb_file(self.other_formats["pdb"], with_charge=False)
-                else:
+                elif self.electrostatics_method == "apbs":
                     apbs = APBS(work_dir=self.work_dir, job=self.job)
                     self._pqr = apbs.get_atom_potentials_from_pdb(self.other_formats["pdb"])
+                    self.electrostatics_method_used = "apbs"
+                else:
+                    pdb2pqr = Pdb2pqr(work_dir=self.work_dir, job=self.job)
+                    pqr_file = pdb2pqr.create_pqr(self.other_formats["pdb"], whitespace=True, chain=True)
+                    try:
+                        self._pqr = get_atom_potentials_from_pqr(pqr_file, method=self.electrostatics_method)
+                    finally:
+                        safe_remove(pqr_file)
+                    self.electrostatics_method_used = self.electrostatics_method
             except (SystemExit, KeyboardInterrupt):
                 raise
             except Exception as e:
@@ -500,19 +750,13 @@ class ProteinFeaturizer(LocalStructure):
                     charge_value, electrostatic_pot_value = np.NaN, np.NaN
 
 
-            charge = [
-                charge_value,
-                default_features.check_threshold("neg_charge", charge_value), #float(charge_value < 0)
-                default_features.check_threshold("pos_charge", charge_value) #float(charge_value > 0)
-                ]
+            #Boolean features are filled by fill_threshold_features
+            charge = [charge_value, np.nan, np.nan]
 
         cols = default_features.atom_features_by_category["get_charge_and_electrostatics"][:3]
         if not only_charge:
             if calculate:
-                charge += [
-                    electrostatic_pot_value,
-                    default_features.check_threshold("is_electronegative", electrostatic_pot_value) #float(electrostatic_pot_value < 0)
-                ]
+                charge += [electrostatic_pot_value, np.nan]
             cols += default_features.atom_features_by_category["get_charge_and_electrostatics"][3:]
 
         if only_bool:
@@ -531,6 +775,7 @@ class ProteinFeaturizer(LocalStructure):
 
         return self.atom_features.loc[idx, cols]
 
+    @instrument_category
     def get_concavity(self, atom_or_residue: Union[AtomType, ResidueType]) -> pd.DataFrame:
         """Get concavity of an atom or residue by running CX
         """
@@ -541,10 +786,7 @@ class ProteinFeaturizer(LocalStructure):
             concavity_value = pd.concat([self.get_concavity(
                 self._remove_altloc(a)) for a in residue], axis=0)["cx"].mean()
 
-            concavity = np.array([
-                concavity_value,
-                default_features.check_threshold("is_concave", concavity_value, residue=True) #float(concavity_value <= 2)
-                ])
+            concavity = np.array([concavity_value, np.nan])
 
             idx = residue.get_id()
             cols = default_features.residue_features_by_category["get_concavity"]
@@ -561,10 +803,8 @@ class ProteinFeaturizer(LocalStructure):
         concavity_value = self._cx.get(atom.serial_number, np.NaN)
 
 
-        concavity = np.array([
-            concavity_value,
-            default_features.check_threshold("is_concave", concavity_value) #float(concavity_value <= 2)
-            ])
+        #is_concave is filled by fill_threshold_features
+        concavity = np.array([concavity_value, np.nan])
 
         idx = atom.serial_number
         cols = default_features.atom_features_by_category["get_concavity"]
@@ -572,6 +812,7 @@ class ProteinFeaturizer(LocalStructure):
 
         return self.atom_features.loc[idx, cols]
 
+    @instrument_category
     def get_hydrophobicity(self, atom_or_residue: Union[AtomType, ResidueType]) -> pd.DataFrame:
         """Get the hydrophocity of an atom or residue using three different scales: 
             Kyte-Doolite (kd), Biological, and Octanal
@@ -595,12 +836,8 @@ class ProteinFeaturizer(LocalStructure):
             hydrophobicity, biological, octanal = np.nan, np.nan, np.nan
 
 
-        result = np.array([
-            hydrophobicity,
-            default_features.check_threshold("is_hydrophobic", hydrophobicity, residue=not use_atom), #float(concavity_value <= 2)
-            biological,
-            octanal
-            ])
+        #is_hydrophobic is filled by fill_threshold_features
+        result = np.array([hydrophobicity, np.nan, biological, octanal])
 
         if use_atom:
             idx = atom.serial_number
@@ -613,6 +850,7 @@ class ProteinFeaturizer(LocalStructure):
             self.residue_features.loc[idx, cols] = result
             return self.residue_features.loc[idx, cols]
 
+    @instrument_category
     def get_accessible_surface_area(self, atom_or_residue: Union[AtomType, ResidueType], save: bool = True)  -> Union[pd.DataFrame, pd.Series]:
         """Returns the ASA value from freesasa (if inout is Atom) and the DSSP
         value (if input is Atom or Residue)
@@ -642,6 +880,21 @@ class ProteinFeaturizer(LocalStructure):
         if not isinstance(atom, PDB.Atom.Atom):
             raise RuntimeErorr("Input must be Atom")
 
+        if self.sasa_engine == "shrake_rupley":
+            if not hasattr(self, "_sasa"):
+                self._sasa = calculate_sasa(self.structure)
+            atom_area = self._sasa.get(atom.serial_number, np.nan)
+        else:
+            atom_area = self._get_freesasa_atom_area(atom)
+
+        if save:
+            idx = atom.serial_number
+            self.atom_features.loc[idx, "atom_asa"] = atom_area
+            return self.atom_features.loc[idx, ["atom_asa"]]
+        else:
+            return pd.Series([atom_area], index=["atom_asa"])
+
+    def _get_freesasa_atom_area(self, atom: AtomType) -> float:
         if not hasattr(self, "_sasa"):
             self._sasa = run_freesasa_biopython(self.path)
 
@@ -657,12 +910,7 @@ class ProteinFeaturizer(LocalStructure):
             raise
             atom_area = np.NaN
 
-        if save:
-            idx = atom.serial_number
-            self.atom_features.loc[idx, "atom_asa"] = atom_area
-            return self.atom_features.loc[idx, ["atom_asa"]]
-        else:
-            return pd.Series([atom_area], index=["atom_asa"])
+        return atom_area
 
     def get_accessible_surface_area_residue(self, atom_or_residue: Union[AtomType, ResidueType], acc_threshold: float = 0.2, 
                                             save: bool = True) -> Union[pd.DataFrame, pd.Series]:
@@ -698,9 +946,11 @@ class ProteinFeaturizer(LocalStructure):
             except KeyError as e2:
                 residue_rasa = np.nan
 
+        #residue_buried is filled by fill_threshold_features, only calculated here for
+        #callers that ask if the residue is buried without saving
         asa = np.array([
             residue_rasa,
-            default_features.check_threshold("residue_buried", residue_rasa, residue=True)
+            np.nan if save else default_features.check_threshold("residue_buried", residue_rasa, residue=True)
         ])
 
         if is_atom:
@@ -720,6 +970,7 @@ class ProteinFeaturizer(LocalStructure):
             else:
                 return pd.Series(asa, index=cols)
 
+    @instrument_category
     def get_residue(self, atom_or_residue: Union[AtomType, ResidueType]) -> pd.DataFrame:
         """Get a one hote encoded represatnation the amino acid from atom or residue
         """
@@ -757,6 +1008,7 @@ class ProteinFeaturizer(LocalStructure):
             return self.residue_features.loc[residue.get_id(),
                 default_features.residue_features_by_category["get_residue"]]
 
+    @instrument_category
     def get_ss(self, atom_or_residue: Union[AtomType, ResidueType]) -> pd.Series:
         """Get 3- and 7- secondary strcutre codes from DSSP for an atom or residue as well as the phi and psi angles
         """
@@ -820,6 +1072,7 @@ class ProteinFeaturizer(LocalStructure):
             self.residue_features.loc[idx, cols] = ss
             return self.residue_features.loc[idx, cols]
 
+    @instrument_category
     def get_deepsite_features(self, atom: AtomType, calc_charge: bool = True, calc_conservation: bool = True):
         """Use DeepSite rules for autodock atom types: 
             is_hydrophobic (C or A)
@@ -878,6 +1131,7 @@ class ProteinFeaturizer(LocalStructure):
 
         return self.atom_features.loc[idx, cols]
 
+    @instrument_category
     def get_evolutionary_conservation_score(self, atom_or_residue: Union[AtomType, ResidueType], eppic=True,
                                             only_bool=False, run_eppic_for_domain_on_failure=False) -> pd.Series:
         """Get the evolutionary conservation score measured by the EPPIC entropy value.
@@ -905,34 +1159,29 @@ class ProteinFeaturizer(LocalStructure):
 
         idx = residue.get_id()
 
-        if self.update_features is not None and \
-          ("get_evolutionary_conservation_score" not in self.update_features or \
-          "is_conserved" not in self.update_features or \
-          "eppic_entropy" not in self.update_features):
-            #No need to update
-            return self.atom_features.loc[atom.serial_number, cols] if use_atom else \
-                self.residue_features.loc[idx, cols]
-
         if not hasattr(self, "_eppic"):
             try:
                 eppic_api = EPPICApi(self.pdb[:4], data_stores(self.job).eppic_store, data_stores(self.job).pdbe_store,
                     use_representative_chains=False, work_dir=self.work_dir)
-                self._eppic = eppic_api.get_entropy_scores(self.chain)
+                #Scores are for the whole chain, so all domains from the chain can use them
+                self._eppic = self.get_tool_result("eppic", lambda: eppic_api.get_entropy_scores(self.chain))
             except (SystemExit, KeyboardInterrupt):
                 raise
-            except:
+            except Exception as e:
                 if run_eppic_for_domain_on_failure:
                     eppic_local = EPPICLocal(work_dir=self.work_dir, job=self.job)
                     self._eppic = eppic_local.get_entropy_scores(self.path)
                 else:
                     self._eppic = {}
+                    self.record_category_failure("get_evolutionary_conservation_score", e)
 
         result = pd.Series(np.empty(len(cols)), index=cols, dtype=np.float64)
         result["eppic_entropy"] = self._eppic.get(residue.get_id(), np.nan)
-        result["is_conserved"] = default_features.check_threshold("is_conserved", result["eppic_entropy"], residue=not use_atom)
+        #is_conserved is filled by fill_threshold_features
+        result["is_conserved"] = np.nan
 
         if only_bool:
-            return result["is_conserved"]
+            return default_features.check_threshold("is_conserved", result["eppic_entropy"], residue=not use_atom)
 
         if use_atom:
             idx = atom.serial_number
@@ -943,6 +1192,7 @@ class ProteinFeaturizer(LocalStructure):
 
         return result
 
+    @instrument_category
     def get_frustration(self, atom_or_residue: Union[AtomType, ResidueType]) -> None:
         """Calculate frustration for an atom or residue"""
         if isinstance(atom_or_residue, PDB.Atom.Atom):
@@ -959,11 +1209,6 @@ class ProteinFeaturizer(LocalStructure):
 
         idx = residue.get_id()
 
-        if self.update_features is not None and "get_frustration" not in self.update_features:
-            #No need to update
-            return self.atom_features.loc[atom.serial_number, cols] if use_atom else \
-                self.residue_features.loc[idx, cols]
-
         if not hasattr(self, "_frustration_singleresidue"):
             frust = FrustratometeR(work_dir=self.work_dir)
             self._frustration_singleresidue = frust.run(pdb_file=self.other_formats["pdb"], mode="singleresidue")
@@ -982,31 +1227,152 @@ class ProteinFeaturizer(LocalStructure):
         result["sd_energy"] = frust_values.get("SDEnergy", np.nan)
         result["frustration_index"] = frust_values.get("FrstIndex", np.nan)
 
-        result["is_highly_frustrated"] = default_features.check_threshold("is_highly_frustrated", frust_values.get("FrstIndex", np.nan), residue=not use_atom)
-        result["is_minimally_frustrated"] = default_features.check_threshold("is_minimally_frustrated", frust_values.get("FrstIndex", np.nan), residue=not use_atom)
-        result["has_nuetral_frustration"] = default_features.check_threshold("has_nuetral_frustration", frust_values.get("FrstIndex", np.nan), residue=not use_atom)
-        
+        #Boolean features are filled by fill_threshold_features
+        result["is_highly_frustrated"] = np.nan
+        result["is_minimally_frustrated"] = np.nan
+        result["has_nuetral_frustration"] = np.nan
+
+        if use_atom:
+            self.atom_features.loc[atom.serial_number, result.index] = result
+        else:
+            self.residue_features.loc[idx, result.index] = result
 
-    def calculate_graph(self, d_cutoff: float = 100., edgelist: bool = False, write: bool = True) -> tuple[nx.Graph, str]:
-        """Build a residue-residue network, linking residues if the distances between is less than given cutoff and 
-        give attributes to each edge. Network is saved as a pd.DataFrame or edge list.
+        return result
+
+
+    def calculate_graph(self, d_cutoff: float = 10., edgelist: bool = False, write: bool = True) -> tuple[Union[nx.Graph, pd.DataFrame], str]:
+        """Build a residue-residue network, linking residues if any of their atoms are closer than the
+        given cutoff and give attributes to each edge. Network is saved as a pd.DataFrame or edge list.
+
+        Parameters
+        ----------
+        d_cutoff : float
+            Maximum distance (in Angstroms) between any two atoms of a pair of residues to create an
+            edge. Default is 10.
+        edgelist : bool
+            Return the edges as a pd.DataFrame instead of a nx.Graph. Default False.
+        write : bool
+            Save network as an edge list file. Default True.
         """
-        structure_graph = nx.Graph()
-        for r1, r2 in self.calculate_neighbors(d_cutoff=d_cutoff):
-            structure_graph.add_edge(r1.get_id(), r2.get_id(),
-                attr_dict=self.get_edge_features(r1, r2))
+        edges = self.calculate_edges(d_cutoff=d_cutoff)
 
         edge_file = os.path.join(self.work_dir, "{}.edges.gz".format(self.id))
+
+        if write or not edgelist:
+            structure_graph = nx.from_pandas_edgelist(edges, "src", "dst", edge_attr=True)
+
         if write:
             nx.write_edgelist(structure_graph, edge_file)
 
         if edgelist:
-            edges = [{"src":u, "dst":v, **dict(d)["attr_dict"]} for u, v, d in \
-                structure_graph.edges(data=True)]
-            structure_graph = pd.DataFrame(edges)
+            return edges, edge_file
 
         return structure_graph, edge_file
 
+    @instrument_category
+    def calculate_edges(self, d_cutoff: float = 10.) -> pd.DataFrame:
+        """Calculate edge features for all pairs of residues with any two atoms within d_cutoff of each other,
+        the same contacts as LocalStructure.calculate_neighbors (Bio.PDB NeighborSearch at the residue level).
+        Atom pairs are found using a KD-tree and reduced to residue pairs, geometric features are calculated
+        for all pairs at once from residue centroids and pairwise frustration is added with a single join.
+        See get_edge_features for a description of each feature.
+
+        Parameters
+        ----------
+        d_cutoff : float
+            Maximum distance (in Angstroms) between any two atoms of a pair of residues to create an
+            edge. Default is 10.
+
+        Returns
+        -------
+        edges : pd.DataFrame
+            One row per edge with columns 'src' and 'dst' (Bio.PDB residue ids) followed by the edge features
+        """
+        residues = list(self.get_residues())
+        residue_atoms = [[self._remove_altloc(a) for a in r] for r in residues]
+
+        n_atoms = np.array([len(atoms) for atoms in residue_atoms])
+        coords = np.array([a.get_coord() for atoms in residue_atoms for a in atoms], dtype=np.float64)
+        starts = np.concatenate(([0], np.cumsum(n_atoms)[:-1]))
+        centroids = np.add.reduceat(coords, starts, axis=0)/n_atoms[:, None]
+
+        #Residues are in contact if any of their atoms are, like NeighborSearch.search_all(level="R")
+        atom_residue = np.repeat(np.arange(len(residues)), n_atoms)
+        pairs = atom_residue[spatial.cKDTree(coords).query_pairs(r=d_cutoff, output_type="ndarray")]
+        pairs = np.unique(np.sort(pairs[pairs[:, 0] != pairs[:, 1]], axis=1), axis=0).reshape(-1, 2)
+        r1_idx, r2_idx = pairs[:, 0], pairs[:, 1]
+
+        r1_pos, r2_pos = centroids[r1_idx], centroids[r2_idx]
+        distance = np.linalg.norm(r1_pos-r2_pos, axis=1)
+        angle = angles_between(r1_pos, r2_pos)
+
+        #Add in features from gregarious paper using backbone O and N atoms, NaN if missing
+        o_coords = np.full((len(residues), 3), np.nan)
+        n_coords = np.full((len(residues), 3), np.nan)
+        for i, r in enumerate(residues):
+            if "O" in r and "N" in r:
+                o_coords[i] = r["O"].get_coord()
+                n_coords[i] = r["N"].get_coord()
+
+        on_vectors = o_coords-n_coords
+        on_midpoints = (o_coords+n_coords)/2.
+
+        omega = angles_between(on_vectors[r1_idx], on_vectors[r2_idx])
+        theta = get_dihedrals(o_coords[r1_idx], on_midpoints[r1_idx], on_midpoints[r2_idx], o_coords[r2_idx])
+
+        residue_ids = np.empty(len(residues), dtype=object)
+        residue_names = np.empty(len(residues), dtype=object)
+        for i, r in enumerate(residues):
+            residue_ids[i] = r.get_id()
+            residue_names[i] = "".join(map(str, r.get_id()[1:])).strip()
+
+        edges = pd.DataFrame({
+            "src": residue_ids[r1_idx],
+            "dst": residue_ids[r2_idx],
+            "Res1": residue_names[r1_idx],
+            "Res2": residue_names[r2_idx],
+            "distance": distance,
+            "angle": angle,
+            "omega": omega,
+            "theta": theta})
+
+        #Calculate pairwise frustration
+        #NativeEnergy DecoyEnergy SDEnergy FrstIndex Welltype FrstState
+        if not hasattr(self, "_frustration_configutational"):
+            frust = FrustratometeR(work_dir=self.work_dir)
+            self._frustration_configutational = frust.run(pdb_file=self.other_formats["pdb"], mode="configurational")
+
+        frust_cols = ["NativeEnergy", "DecoyEnergy", "SDEnergy", "FrstIndex", "Welltype", "FrstState"]
+        frust_values = self._frustration_configutational
+        frust_values = frust_values[(frust_values.ChainRes1==self.chain)&(frust_values.ChainRes2==self.chain)]
+        frust_values = frust_values.assign(
+            Res1=frust_values.Res1.astype(str).str.strip(),
+            Res2=frust_values.Res2.astype(str).str.strip())
+        frust_values = frust_values.drop_duplicates(["Res1", "Res2"]).set_index(["Res1", "Res2"])[frust_cols]
+
+        edges = edges.join(frust_values, on=["Res1", "Res2"])
+
+        return pd.DataFrame({
+            "src": edges["src"],
+            "dst": edges["dst"],
+            "distance": edges["distance"],
+            "angle": edges["angle"],
+            "omega": edges["omega"],
+            "theta": edges["theta"],
+
+            #Frustration:
+            "native_energy": edges["NativeEnergy"].astype(np.float64),
+            "decoy_energy": edges["DecoyEnergy"].astype(np.float64),
+            "sd_energy": edges["SDEnergy"].astype(np.float64),
+            "frustration_index": edges["FrstIndex"].astype(np.float64),
+            "is_highly_frustrated": edges["FrstState"]=="highly",
+            "is_minimally_frustrated": edges["FrstState"]=="minimally",
+            "has_nuetral_frustration": edges["FrstState"]=="neutral",
+            "is_water_mediated_welltype": edges["Welltype"]=="water-mediated",
+            "is_short_welltype": edges["Welltype"]=="short",
+            "is_long_welltype": edges["Welltype"]=="long",
+        }).reset_index(drop=True)
+
     def get_edge_features(self, r1: ResidueType, r2: ResidueType) -> dict[str, float]:
         """Calculate edge features for a pair of residues.
 
@@ -1097,95 +1463,167 @@ class ProteinFeaturizer(LocalStructure):
             "is_long_welltype": frust_values.get("Welltype","")=="long",
         }
 
-    def calculate_custom_features(self) -> None:
-        if not hasattr(self, "custom_feature_values"):
-            self.custom_feature_values = {}
-            self.custom_feature_modules = {}
-            self.custom_feature_done_category = []
-        
-        update_whole_category = False
-        for category in custom_features.features:
-            if category in self.custom_feature_done_category:
-                continue
+    def get_custom_categories(self) -> OrderedDict[str, list[list[dict[str, Any]]]]:
+        """Get the custom feature categories to calculate, grouped by the featurizer
+        (the 'parser' in custom_features.yaml) that calculates them
+
+        Returns
+        -------
+        An OrderedDict of parser names to a list of (category, features) pairs
+        """
+        update_categories = self.get_update_categories() if self.update_features is not None else None
 
-            if self.update_features is not None and category not in self.update_features:
-                update_whole_category = True
+        parsers = OrderedDict()
+        for category, features in custom_features.atom_feature_categories.items():
+            if update_categories is not None and category not in update_categories:
+                continue
+            for parser_name, parser_features in groupby(features, key=lambda feat: feat["parser"]):
+                parsers.setdefault(parser_name, []).append((category, list(parser_features)))
+        return parsers
+
+    def get_atom_residue_codes(self) -> np.array:
+        """Position of each atom's residue in residue_features, in the order of
+        atom_features (-1 if the residue is missing). Used to move features between
+        atoms and residues without looping over residues.
+        """
+        if self._atom_residue_codes is None:
+            residue_of_atom = {a.serial_number:a.get_parent().get_id() for a in self.structure.get_atoms()}
+            residue_ids = [residue_of_atom.get(serial, (None, None, None)) for serial in self.atom_features.index]
+            self._atom_residue_codes = self.residue_features.index.get_indexer(residue_ids)
+        return self._atom_residue_codes
+
+    def _custom_results_to_df(self, results: Any, index: pd.Index, entities: Callable) -> pd.DataFrame:
+        """Convert results from a custom featurizer into a DataFrame aligned to index"""
+        if results is None:
+            return pd.DataFrame(index=index)
+        elif isinstance(results, pd.DataFrame):
+            return results.reindex(index)
+
+        columns = {}
+        for name, values in results.items():
+            if isinstance(values, pd.Series):
+                columns[name] = values.reindex(index).to_numpy()
+            else:
+                values = np.asarray(values, dtype=np.float64)
+                if len(values) != len(index):
+                    #Arrays follow the order of the structure, not features index
+                    order = pd.Index(entities()).get_indexer(index)
+                    values = np.where(order >= 0, values[order], np.nan)
+                columns[name] = values
+        return pd.DataFrame(columns, index=index)
+
+    def store_custom_results(self, categories: list[tuple[str, list[dict[str, Any]]]], atom_results: Any,
+                             residue_results: Any) -> None:
+        """Save the results of a custom featurizer into atom and residue features. Features
+        only calculated for residues are copied to their atoms, features only calculated for
+        atoms are aggregated into their residues (with the 'aggregate' rule), and thresholded
+        features are created from their 'from_feature', all one column at a time.
 
-            for parser_name, features in groupby(list(category.values())[0], key=lambda feat: feat["parser"]):
-                if self.update_features is not None and not (update_whole_category or any(f in self.update_features for f in features)):
+        Parameters
+        ----------
+        categories : list of (category, features)
+            Categories calculated by the featurizer (see get_custom_categories)
+        atom_results, residue_results : DataFrame, dict of arrays, or None
+            Output from CustomFeaturizer.calculate_prop3D
+        """
+        atom_df = self._custom_results_to_df(atom_results, self.atom_features.index,
+            lambda: [a.serial_number for a in self.structure.get_atoms()])
+        residue_df = self._custom_results_to_df(residue_results, self.residue_features.index,
+            lambda: [r.get_id() for r in self.structure.get_residues()])
+        codes = self.get_atom_residue_codes()
+        has_residue = codes >= 0
+
+        for category, features in categories:
+            #Source features of residue level thresholds must also be residue level
+            residue_sources = {f["from_feature"] for f in features if f["residue"] and \
+                "from_feature" in f and "threshold" in f}
+
+            #Raw features first, thresholded features are made from them afterwards
+            for feat in features:
+                name = feat["name"]
+                if "from_feature" in feat and "threshold" in feat:
                     continue
 
+                if name not in atom_df and name in residue_df:
+                    #Copy residue value to every atom in the residue
+                    values = residue_df[name].to_numpy()
+                    atom_df[name] = np.where(has_residue, values[np.maximum(codes, 0)], np.nan)
+
+                if (feat["residue"] or name in residue_sources) and name not in residue_df and name in atom_df:
+                    #Aggregate atoms into residues
+                    agg = {"avg": "mean"}.get(feat["aggregate"], feat["aggregate"])
+                    if agg not in ("sum", "min", "max", "mean"):
+                        raise KeyError(f"Aggregate rule must be: sum, min, max, mean, or avg, not {agg}")
+                    grouped = atom_df[name][has_residue].groupby(codes[has_residue]).agg(agg)
+                    residue_df[name] = grouped.reindex(np.arange(len(residue_df))).to_numpy()
+
+            atom_names = [f["name"] for f in features]
+            residue_names = [f["name"] for f in features if f["residue"]]
+            #Only create thresholded features the featurizer did not calculate itself
+            atom_thresholds = [name for name in atom_names if name in custom_features.atom_threshold_rules \
+                and name not in atom_df]
+            residue_thresholds = [name for name in residue_names if name in custom_features.residue_threshold_rules \
+                and name not in residue_df]
+
+            for name in atom_names:
+                if name not in atom_df:
+                    atom_df[name] = np.nan
+            for name in residue_names:
+                if name not in residue_df:
+                    residue_df[name] = np.nan
+
+            custom_features.apply_thresholds(atom_df, features=atom_thresholds)
+            custom_features.apply_thresholds(residue_df, residue=True, features=residue_thresholds)
+
+            self.atom_features[atom_names] = atom_df[atom_names].to_numpy(dtype=np.float64)
+            if len(residue_names) > 0:
+                self.residue_features[residue_names] = residue_df[residue_names].to_numpy(dtype=np.float64)
+            self._calculated_categories.add((category, "custom"))
+
+    @instrument_category
+    def calculate_custom_features(self) -> None:
+        """Run all custom featurizers (see Prop3D.custom_featurizers) once for the whole
+        structure. Featurizers are run concurrently in threads since most of them wait on
+        external programs, then their results are saved with store_custom_results.
+        """
+        if self._custom_features_done:
+            return
+
+        parsers = self.get_custom_categories()
+        self._custom_features_done = True
+        if len(parsers) == 0:
+            return
+
+        if not hasattr(self, "custom_feature_modules"):
+            self.custom_feature_modules = {}
+
+        def run_parser(parser_name):
+            try:
+                parser = self.custom_feature_modules[parser_name]
+            except KeyError:
+                parser = load_custom_featurizer(parser_name)(job=self.job, work_dir=self.work_dir)
+                self.custom_feature_modules[parser_name] = parser
+            return parser.calculate_prop3D(self.path, self.structure)
+
+        errors = []
+        max_workers = self.custom_feature_workers or len(parsers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run_parser, parser_name):parser_name for parser_name in parsers}
+            for future in as_completed(futures):
+                parser_name = futures[future]
                 try:
-                    parser = self.custom_feature_modules[category]
-                except KeyError:
-                    parser = import_module(parser_name)(work_dir=self.work_dir)
-                    self.custom_feature_modules[category] = parser
-                
-                atom_results, residue_results = parser.calculate_prop3D(self.path, self.structure)
-
-                if atom_results is None:
-                    residue_results = pd.DataFrame(np.nan, index=self.residue_features.index)
-                
-                if residue_results is None:
-                    residue_results = pd.DataFrame(np.nan, index=self.residue_features.index)#, columns=custom_features.atom_features_by_category[category])
-                
-                if len(residue_results.columns) != custom_features.residue_features_by_category[category] or \
-                    len(atom_results.columns) != custom_features.atom_features_by_category[category]:
-                    #Map features from atoms to residues and residues to atoms
-                    resi_to_atoms = {resi.get_id():[a.serial for a in resi] for resi in self.get_residues()}
-
-                    #Create boolean/thresholded features
-                    update_atom_cols = False
-                    for feat in custom_features.atom_feature_categories[category]:
-                        if feat["name"] not in atom_results:
-                            try:
-                                source_feature = feat["from_feature"]
-                            except KeyError:
-                                raise KeyError(f"Feature '{feat['name']} has no source feature ('from_feature') attribute")
-                            
-                            new_feat = atom_results[source_feature].apply(lambda v: custom_features.check_threshold(feat["name"], v, residue=False))
-                            atom_results = atom_results.assign(**{feat["name"]: new_feat})
-                            update_atom_cols = True
-                    if update_atom_cols:
-                        atom_results = atom_results[custom_features.atom_features_by_category(category)]
-
-                    update_resi_cols = False
-                    for feat in custom_features.residue_feature_categories[category]:
-                        if feat["name"] not in residue_results:
-                            try:
-                                source_feature = feat["from_feature"]
-                            except KeyError:
-                                raise KeyError(f"Feature '{feat['name']} has no source feature ('from_feature') attribute")
-                            
-                            new_feat = residue_results[source_feature].apply(lambda v: custom_features.check_threshold(feat["name"], v, residue=True))
-                            residue_results = residue_results.assign(**{feat["name"]: new_feat})
-                            update_resi_cols = True
-                    if update_resi_cols:
-                        residue_results = residue_results[custom_features.residue_features_by_category(category)]
-
-                    #Map atom features to residue feature through aggegation rules
-                    aggregate_rules = {"sum": np.sum, "min":np.min, "max":np.max, "mean":np.mean, "avg":np.mean}
-                    for feat in custom_features.residue_feature_categories[category]:
-                        if feat["name"] not in residue_results and feat.get("from_feature", None) is None:
-                            try:
-                                agg = aggregate_rules[feat["aggregate"]]
-                            except KeyError:
-                                raise KeyError(f"Aggregate rule must be: {aggregate_rules.keys()}")
-                            
-                            residue_results = residue_results.assign(**{feat: np.nan})
-                            
-                            for resi in self.get_residues():
-                                idx = resi_to_atoms[resi.get_id()]
-                                residue_results.loc[resi.get_id(), feat] = agg(atom_results.loc[idx, feat])
-
-                    #Map residue features to atoms by copying the features to all atoms in the residue
-                    for feat in custom_features.atom_feature_categories[category]:
-                        if feat["name"] not in atom_results:
-                            atom_results = atom_results.assign(**{feat: np.nan})
-
-                            for resi, atoms in resi_to_atoms.items():
-                                atom_results.loc[atoms, feat] = residue_results.loc[resi.get_id(), feat]
-            self.custom_feature_done_category.append(category)
+                    atom_results, residue_results = future.result()
+                except Exception as e:
+                    RealtimeLogger.info(f"Custom featurizer {parser_name} failed: {type(e).__name__}: {e}")
+                    errors.append((parser_name, e))
+                    for category, _ in parsers[parser_name]:
+                        self.record_category_failure(category, e)
+                    continue
+                self.store_custom_results(parsers[parser_name], atom_results, residue_results)
+
+        if len(errors) > 0:
+            raise RuntimeError("Custom featurizers failed: {}".format(
+                ", ".join(f"{name} ({type(e).__name__}: {e})" for name, e in errors))) from errors[0][1]
 
 
 
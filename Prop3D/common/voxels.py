@@ -48,6 +48,14 @@ class LocalVoxelizedStructure(LocalStructure):
             features_path=features_path,
             residue_feature_mode=residue_feature_mode)
 
+        #Boolean features are filled in a column pass after featurizing, fill any
+        #that were saved without it (all NaN) from their source features
+        for features, residue in ((self.atom_features, False), (self.residue_features, True)):
+            rules = all_features.residue_threshold_rules if residue else all_features.atom_threshold_rules
+            missing = [name for name in rules if name in features.columns and features[name].isna().all()]
+            if len(missing) > 0:
+                all_features.apply_thresholds(features, residue=residue, features=missing)
+
         self.mean_coord = np.zeros(3)
         self.mean_coord_updated = False
 
@@ -1,18 +1,70 @@
+import os
 from pathlib import Path
+from importlib import import_module
 modules = Path(__file__).parent.glob("*.py")
 __all__ = [f.stem for f in modules if f.is_file() and not f.stem.startswith("_")]
 
 from typing import Union, TypeVar
+import numpy as np
 import pandas as pd
 from toil.job import Job
 from Bio.PDB import Structure
 
 StructureType = TypeVar('StructureType', bound='Structure')
 
+#Results for one level: a DataFrame or dict of feature name -> array-like. DataFrames and
+#Series are matched by index (atom serial number or residue id), plain arrays by position
+#in structure.get_atoms()/structure.get_residues()
+CustomResultsType = Union[pd.DataFrame, dict[str, Union[np.array, pd.Series, list]], None]
+
 class CustomFeaturizer(object):
+    """Base class for custom feature plugins. Subclasses implement calculate_prop3D and
+    are listed in custom_features.yaml with the 'parser' key, e.g.
+    Prop3D.custom_featurizers.HalfSphereExposure. Each plugin calculates its raw values only,
+    ProteinFeaturizer maps residue values to atoms, aggregates atom values to residues, and
+    creates thresholded features in bulk. Plugins may be run concurrently in threads so
+    they must not modify the structure.
+    """
     def __init__(self, job: Union[Job, None] = None, work_dir: Union[str, None] = None):
         self.job = job
-        self.work_dir = os.getcwd() if work_dir is None else work_dir    
+        self.work_dir = os.getcwd() if work_dir is None else work_dir
+
+    def calculate_prop3D(self, path: str, structure: StructureType) -> tuple[CustomResultsType, CustomResultsType]:
+        """Calculate features for a structure
+
+        Parameters
+        ----------
+        path : str
+            Path to structure file
+        structure : Bio.PDB.Structure
+
+        Returns
+        -------
+        atom_results, residue_results : DataFrame, dict of arrays, or None
+            Features calculated for each atom (keyed by serial number) and each residue
+            (keyed by residue id). Either can be None.
+        """
+        raise NotImplementedError
+
+def load_custom_featurizer(parser_name: str) -> type:
+    """Get the class of a custom featurizer from its 'parser' name in custom_features.yaml.
+    Classes can be named by their full module path or by the package, e.g.
+    Prop3D.custom_featurizers.HalfSphereExposure is found in Prop3D.custom_featurizers.hs_exposure
+
+    Parameters
+    ----------
+    parser_name : str
+        Module path and class name separated by '.'
+    """
+    module_name, class_name = parser_name.rsplit(".", 1)
+    module = import_module(module_name)
+    if hasattr(module, class_name):
+        return getattr(module, class_name)
+
+    #Search submodules of a package
+    for submodule_name in getattr(module, "__all__", []):
+        submodule = import_module(f"{module_name}.{submodule_name}")
+        if hasattr(submodule, class_name):
+            return getattr(submodule, class_name)
 
-    def calculate_prop3D(self, path: str, structure: StructureType) -> tuple[Union[pd.DataFrame, None], Union[pd.DataFrame, None]]:
-        raise NotImplementedError
\ No newline at end of file
+    raise ImportError(f"Cannot find custom featurizer {parser_name}")
@@ -0,0 +1,153 @@
+"""Compare compression and chunk layouts for feature tables (see Prop3D.util.table_storage).
+Domains from one superfamily are copied into a local h5 file for each setting, reporting
+the size on disk, write throughput, and the latency of random DistributedStructure loads.
+
+python -m Prop3D.generate_data.benchmark_storage /home/$USER/Prop3D.h5 1.10.10.10 --domains 100
+"""
+import os
+import time
+import argparse
+from typing import Union, Any
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from Prop3D.util import safe_remove
+from Prop3D.util.hsds import hsds_file
+from Prop3D.util.table_storage import STORAGE_PRESETS, get_storage_config
+from Prop3D.common.DistributedStructure import DistributedStructure
+from Prop3D.generate_data.calculate_features_hsds import write_table
+
+def read_sample(source: str, superfamily: str, n_domains: int = 50, seed: int = 0) -> dict[str, dict[str, np.ndarray]]:
+    """Read all tables for a random sample of domains in a superfamily
+
+    Returns
+    -------
+    Domain mapped to its tables (key relative to the domain) and their data
+    """
+    key = f"/{superfamily.replace('.', '/')}/domains"
+    sample = {}
+    with hsds_file(source, mode="r") as store:
+        domains = sorted(store[key].keys())
+        rng = np.random.default_rng(seed)
+        domains = rng.choice(domains, size=min(n_domains, len(domains)), replace=False)
+
+        for domain in sorted(domains):
+            tables = {}
+            def add(group, prefix=""):
+                for name in group.keys():
+                    obj = group[name]
+                    if hasattr(obj, "keys"):
+                        add(obj, f"{prefix}{name}/")
+                    else:
+                        tables[f"{prefix}{name}"] = obj[:]
+            add(store[f"{key}/{domain}"])
+            sample[domain] = tables
+
+    return sample
+
+def benchmark_storage(source: str, superfamily: str, settings: Union[list[str], dict[str, Any], None] = None,
+                      n_domains: int = 50, reads: int = 100, work_dir: Union[str, None] = None,
+                      keep: bool = False) -> pd.DataFrame:
+    """Write the same sample of domains with each storage setting and time it
+
+    Parameters
+    ----------
+    source : str
+        HSDS domain or local h5 file with featurized domains
+    superfamily : str
+        CATH code of superfamily to sample, e.g. 1.10.10.10
+    settings : list of preset names, dict of name -> storage config, or None
+        Settings to compare. Default: all presets
+    n_domains : int
+        Number of domains to copy
+    reads : int
+        Number of random DistributedStructure loads to time
+    work_dir : str or None
+        Where to write test files. Default: current directory
+    keep : bool
+        Keep the test files
+
+    Returns
+    -------
+    DataFrame with one row per setting. Reads are from the page cache after writing,
+    so they measure decompression and layout rather than the disk
+    """
+    work_dir = os.getcwd() if work_dir is None else work_dir
+    if settings is None:
+        settings = list(STORAGE_PRESETS.keys())
+    if not isinstance(settings, dict):
+        settings = {name: name for name in settings}
+
+    sample = read_sample(source, superfamily, n_domains=n_domains)
+    domains = list(sample.keys())
+    raw_bytes = sum(data.nbytes for tables in sample.values() for data in tables.values())
+    key = f"/{superfamily.replace('.', '/')}"
+
+    results = []
+    for name, storage in settings.items():
+        #Check the setting before writing anything
+        get_storage_config(storage)
+
+        h5_file = os.path.join(work_dir, f"benchmark-{name}.h5")
+        safe_remove(h5_file)
+
+        start = time.perf_counter()
+        try:
+            with h5py.File(h5_file, "w") as f:
+                for domain, tables in sample.items():
+                    for table, data in tables.items():
+                        column_dtypes = {col: data.dtype.fields[col][0].str for col in data.dtype.names}
+                        write_table(f, f"{key}/domains/{domain}/{table}", data, column_dtypes,
+                            max_request_size=2**62, exists=False, storage=storage)
+        except ImportError as e:
+            #Codec not available, e.g. blosc without hdf5plugin
+            print(f"Skipping {name}: {e}")
+            safe_remove(h5_file)
+            continue
+        write_time = time.perf_counter()-start
+        size = os.path.getsize(h5_file)
+
+        rng = np.random.default_rng(0)
+        latencies = []
+        for domain in rng.choice(domains, size=reads):
+            start = time.perf_counter()
+            DistributedStructure(h5_file, key, cath_domain_dataset=domain)
+            latencies.append(time.perf_counter()-start)
+        latencies = np.array(latencies)*1000
+
+        results.append({
+            "setting": name,
+            "size_MB": size/1024**2,
+            "ratio": raw_bytes/max(size, 1),
+            "write_MB/s": raw_bytes/1024**2/max(write_time, 1e-9),
+            "read_mean_ms": latencies.mean(),
+            "read_p50_ms": np.percentile(latencies, 50),
+            "read_p95_ms": np.percentile(latencies, 95),
+        })
+
+        if not keep:
+            safe_remove(h5_file)
+
+    return pd.DataFrame(results).set_index("setting")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="HSDS domain or local h5 file with featurized domains")
+    parser.add_argument("superfamily", help="CATH code of superfamily to sample, e.g. 1.10.10.10")
+    parser.add_argument("--settings", nargs="+", default=None,
+        help=f"Presets ({', '.join(STORAGE_PRESETS.keys())}) or JSON configs to compare. Default: all presets")
+    parser.add_argument("--domains", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=100)
+    parser.add_argument("--work_dir", default=None)
+    parser.add_argument("--keep", action="store_true", default=False)
+    args = parser.parse_args()
+
+    settings = None
+    if args.settings is not None:
+        settings = {f"config{i}" if s.strip().startswith("{") else s: s for i, s in enumerate(args.settings)}
+
+    results = benchmark_storage(args.source, args.superfamily, settings=settings, n_domains=args.domains,
+        reads=args.reads, work_dir=args.work_dir, keep=args.keep)
+    print(results.to_string(float_format=lambda x: f"{x:.2f}"))
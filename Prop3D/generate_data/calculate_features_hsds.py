@@ -1,13 +1,24 @@
 import os
+import json
+import time
+import queue
+import atexit
+import threading
 import traceback
 from pathlib import Path
 from functools import partial
-from typing import Union, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Any, Callable
 
+import numpy as np
 import h5pyd
 from Prop3D.common.featurizer import ProteinFeaturizer
 
 from Prop3D.util import safe_remove
+from Prop3D.util.hsds import hsds_file, call_h5, get_max_request_size, get_thread_file
+from Prop3D.util.table_storage import get_table_storage
+from Prop3D.generate_data.domain_manifest import get_stage, hash_tables, mark_domains_complete
 from Prop3D.generate_data.data_stores import data_stores
 
 from toil.job import Job
@@ -39,6 +50,7 @@ class CalculateFeaturesError(RuntimeError):
         self.stage = stage
         self.message = message
         self.errors = errors if isinstance(errors, list) else []
+        self.job = job
         self.jobStoreName = os.path.basename(job.fileStore.jobStore.config.jobStore.split(":")[-1])
 
     def __str__(self):
@@ -55,7 +67,7 @@ class CalculateFeaturesError(RuntimeError):
         store : IOStore
         """
         if store is None:
-            store = data_stores(job).cath_features
+            store = data_stores(self.job).cath_features
         fail_file = "{}.{}".format(self.cath_domain, self.stage)
         with open(fail_file, "w") as f:
             print(self.message, file=f)
@@ -65,38 +77,452 @@ class CalculateFeaturesError(RuntimeError):
             f"errors/{self.jobStoreName}/{os.path.basename(fail_file)}")
         safe_remove(fail_file)
 
-def calculate_features(job: Job, cath_full_h5: str, cath_domain: str, cathcode: str, update_features: Union[list[str], None] = None, 
-                       domain_file: Union[str, None] = None, work_dir: Union[str, None] = None, edge_features: bool = True) -> None:
-    """Featurize a protein at the atom, residue, and graph level saving all data into the h5 file on HSDS endpoint
+def write_table(store: h5pyd.File, key: str, rec_arr: np.recarray, column_dtypes: dict[str, str],
+                max_request_size: Union[int, None] = None, exists: bool = True,
+                storage: Union[str, dict[str, Any], None] = None) -> int:
+    """Write a record array as a table into an open HSDS file, replacing the
+    table if it already exists. Tables that fit in one request are created with
+    their data, larger tables are created empty and their rows sent in pieces no
+    larger than the maximum request size, so they never need to be retried.
 
     Parameters
     ----------
-    job : toil Job
-        Currently running job
-    cath_full_h5 : str
-        Path to h5 on hsds endpoint
-    cath_domain : str
-        CATH domain (7-letter code) PDB ID, CHAIN, Domain ID, eg. 1zyzA00
-    cathcode : str
-        Superfamily cath domain belongs to (Use / instead of .)
-    update_features : list of str or None
-        Select which features update (either indidual feature names or whole group names). If None, all features will be calculated.
-        Default is None.
-    domain_file : str or None
-        Path to pdb file. If None, it will be downloaded from the raw IOStore (see data_stores)
-    work_dir : str
-        Where to save temp files
-    edge_features: bool
-        Include edge feature or not
+    store : h5pyd.File
+        HSDS file opened for appending
+    key : str
+        Full path of the table to write
+    rec_arr : np.recarray
+        Data to write
+    column_dtypes : dict
+        Column names mapped to their numpy type strings
+    max_request_size : int or None
+        Largest request in bytes. Default: get_max_request_size()
+    exists : bool
+        Check if the table exists and delete it first. Set to False if the caller
+        already knows it does not exist to skip a request
+    storage : str, dict, or None
+        Compression and chunk layout, see Prop3D.util.table_storage. Default: PROP3D_TABLE_STORAGE
+
+    Returns
+    -------
+    Number of HTTP requests used to create the table and write its data
     """
-    if work_dir is None:
-        if job is not None and hasattr(job, "fileStore"):
-            work_dir = job.fileStore.getLocalTempDir()
+    requests = 0
+    if exists:
+        requests += 1
+        if key in store:
+            try:
+                del store[key]
+            except OSError:
+                pass
+            requests += 1
+
+    if max_request_size is None:
+        max_request_size = get_max_request_size()
+
+    #Leave room for headers
+    rows_per_request = max(1, int(0.9*max_request_size)//max(rec_arr.dtype.itemsize, 1))
+
+    local = not hasattr(store, "create_table")
+    storage_kwds = get_table_storage(key, storage, local=local)
+    if storage_kwds["chunks"] is not True:
+        #Rows per chunk, chunks cannot be larger than fixed size tables
+        rows = storage_kwds["chunks"] if local else min(storage_kwds["chunks"], max(len(rec_arr), 1))
+        storage_kwds["chunks"] = (rows,)
+
+    dtype = list(column_dtypes.items())
+    if rec_arr.nbytes <= 0.9*max_request_size:
+        #Create and fill in one request
+        if not local:
+            store.create_table(key, data=rec_arr, dtype=dtype, **storage_kwds)
         else:
-            work_dir = os.getcwd()
+            store.create_dataset(key, data=np.asarray(rec_arr, dtype=dtype), maxshape=(None,), **storage_kwds)
+        return requests+1
+
+    if not local:
+        table = store.create_table(key, numrows=len(rec_arr), dtype=dtype, **storage_kwds)
+    else:
+        #Local h5py file
+        table = store.create_dataset(key, shape=(len(rec_arr),), maxshape=(None,),
+            dtype=dtype, **storage_kwds)
+    requests += 1
+
+    for start in range(0, len(rec_arr), rows_per_request):
+        table[start:start+rows_per_request] = rec_arr[start:start+rows_per_request]
+        requests += 1
+
+    return requests
+
+#Upload threads used when no executor is given, e.g. in the local h5 writer process.
+#Kept for the life of the process so each thread reuses its pooled HSDS handles
+_write_executors = {}
+_write_executors_lock = threading.Lock()
+
+def get_write_executor(workers: int = 4) -> ThreadPoolExecutor:
+    """Get the process wide executor with the given number of upload threads"""
+    with _write_executors_lock:
+        if workers not in _write_executors:
+            _write_executors[workers] = ThreadPoolExecutor(workers, thread_name_prefix="TableWriter")
+        return _write_executors[workers]
+
+def write_featurized_domains(store: h5pyd.File, pending: list[dict[str, Any]], max_request_size: Union[int, None] = None,
+                             workers: int = 4, executor: Union[ThreadPoolExecutor, None] = None) -> tuple[dict[str, Exception], int, int, int]:
+    """Write the tables, attributes and timings of featurized domains into an open file.
+    Used by TableWriteBuffer, see it for parameters. Tables are uploaded by executor,
+    or by get_write_executor(workers) if None
+
+    Returns
+    -------
+    failed : dict
+        Domain group key to error of each domain that failed
+    ntables, nbytes, requests : int
+        Number of tables and bytes written and HTTP requests used
+    """
+    failed = {}
+    requests = 0
+    nbytes = 0
+    ntables = 0
+
+    #May be called from a writer thread, HSDS handles cannot be shared between threads
+    store = get_thread_file(store)
+
+    def write(key, rec_arr, column_dtypes, exists):
+        return write_table(get_thread_file(store), key, rec_arr, column_dtypes,
+            max_request_size=max_request_size, exists=exists)
+
+    #Create groups and find old tables first, these are shared by a domain's tables
+    jobs = []
+    for featurized in pending:
+        cath_key = featurized["cath_key"]
+        try:
+            existing = set(get_domain_keys(store, cath_key))
+            requests += 1
+            if len(existing) == 0:
+                store.require_group(cath_key)
+                requests += 1
+            for key, rec_arr, column_dtypes in featurized["tables"]:
+                name = key[len(cath_key):].strip("/")
+                if "/" in name:
+                    store.require_group(os.path.dirname(key))
+                    requests += 1
+                jobs.append((cath_key, key, rec_arr, column_dtypes, name.split("/")[0] in existing))
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            failed[cath_key] = e
+
+    if executor is None:
+        executor = get_write_executor(workers)
+
+    futures = [(cath_key, rec_arr.nbytes, executor.submit(write, key, rec_arr, column_dtypes, exists)) \
+        for cath_key, key, rec_arr, column_dtypes, exists in jobs if cath_key not in failed]
+
+    for cath_key, size, future in futures:
+        try:
+            requests += future.result()
+            nbytes += size
+            ntables += 1
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            failed.setdefault(cath_key, e)
+
+    completed = []
+    for featurized in pending:
+        cath_key = featurized["cath_key"]
+        if cath_key in failed:
+            continue
+        try:
+            for key in featurized["delete"]:
+                if key in store:
+                    try:
+                        del store[key]
+                    except OSError:
+                        pass
+
+            save_feature_timings(store, cath_key, featurized["timings"])
+
+            for name, value in featurized.get("attrs", {}).items():
+                store[cath_key].attrs[name] = value
+
+            completed.append((cath_key, featurized.get("stage", get_stage()), hash_tables(featurized["tables"])))
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            failed[cath_key] = e
+
+    #Only after everything else for the domain is saved
+    requests += mark_domains_complete(store, completed)
+
+    return failed, ntables, nbytes, requests
+
+class TableWriteBuffer(object):
+    """Collect the tables of many featurized domains and upload them together.
+    Existing keys are listed once per domain instead of once per table, each table
+    is written in pieces sized to the maximum request size, and tables are
+    uploaded in parallel by threads that live as long as the buffer, so each keeps
+    its pooled HSDS handle between flushes. Call flush when done, and close to stop
+    the threads.
+
+    Parameters
+    ----------
+    store : h5pyd.File or str
+        HSDS file opened for appending, or path to an HSDS domain or local h5 file
+    max_buffer_size : int
+        Flush automatically when the buffered tables are larger than this (bytes)
+    max_request_size : int or None
+        Largest request in bytes. Default: get_max_request_size()
+    workers : int
+        Number of tables to upload at the same time
+    """
+    def __init__(self, store: Union[h5pyd.File, str], max_buffer_size: int = 256*1024**2,
+                 max_request_size: Union[int, None] = None, workers: int = 4) -> None:
+        self.store = store
+        self.max_buffer_size = max_buffer_size
+        self.max_request_size = max_request_size if max_request_size is not None else get_max_request_size()
+        self.workers = workers
+        self.pending = []
+        self.buffered_bytes = 0
+        self.failed = {}
+        self.stats = {"domains": 0, "tables": 0, "bytes": 0, "requests": 0, "seconds": 0.}
+        #Local files are written by the writer process with its own threads
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="TableWriteBuffer") \
+            if not isinstance(store, str) else None
+
+    def add(self, featurized: dict[str, Any]) -> None:
+        """Add the output of featurize_domain, flushing if the buffer is full"""
+        self.pending.append(featurized)
+        self.buffered_bytes += sum(rec_arr.nbytes for _, rec_arr, _ in featurized["tables"])
+        if self.buffered_bytes >= self.max_buffer_size:
+            self.flush()
+
+    def flush(self) -> dict[str, Exception]:
+        """Upload all buffered domains
+
+        Returns
+        -------
+        A dict of the domain group key to the error of each domain that failed in this flush.
+        All failures are also saved in the failed attribute
+        """
+        if len(self.pending) == 0:
+            return {}
+
+        start_time = time.perf_counter()
+        pending, self.pending, self.buffered_bytes = self.pending, [], 0
+
+        if isinstance(self.store, str):
+            #Local files are written by the single writer process
+            failed, ntables, nbytes, requests = call_h5(self.store, write_featurized_domains,
+                pending, max_request_size=self.max_request_size, workers=self.workers)
+        else:
+            failed, ntables, nbytes, requests = write_featurized_domains(self.store,
+                pending, max_request_size=self.max_request_size, workers=self.workers,
+                executor=self.executor)
+
+        elapsed = time.perf_counter()-start_time
+        self.stats["domains"] += len(pending)-len(failed)
+        self.stats["tables"] += ntables
+        self.stats["bytes"] += nbytes
+        self.stats["requests"] += requests
+        self.stats["seconds"] += elapsed
+        self.failed.update(failed)
+
+        RealtimeLogger.info("Wrote {} tables from {} domains ({:.1f} MB) in {:.1f}s with ~{} requests: {:.2f} MB/s".format(
+            ntables, len(pending)-len(failed), nbytes/1024**2, elapsed, requests,
+            nbytes/1024**2/elapsed if elapsed > 0 else 0.))
+
+        return failed
+
+    def close(self) -> dict[str, Exception]:
+        """Upload all buffered domains and stop the upload threads
+
+        Returns
+        -------
+        A dict of the domain group key to the error of each domain that failed
+        """
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        return self.failed
+
+#Writers that have not been closed, flushed when the process exits
+_background_writers = set()
+
+class BackgroundTableWriter(object):
+    """Upload featurized domains on a background thread so the next domains can be
+    featurized while earlier ones upload. Domains are collected in a
+    TableWriteBuffer and uploaded together when the buffer is full, when the oldest
+    domain has waited max_age seconds, or on flush or close. put blocks when
+    max_queue_size domains are waiting while the thread uploads (backpressure).
+    Call close (or flush) before reporting that a job has finished, unclosed
+    writers are flushed at exit.
+
+    Parameters
+    ----------
+    store : h5pyd.File or str
+        HSDS file opened for appending, or path to an HSDS domain or local h5 file
+    max_queue_size : int
+        Number of domains that can wait to be uploaded before put blocks
+    max_age : float
+        Upload buffered domains after the oldest has waited this many seconds
+    **buffer_kwds :
+        Passed to TableWriteBuffer
+    """
+    _stop = object()
+    _flush = object()
+
+    def __init__(self, store: Union[h5pyd.File, str], max_queue_size: int = 4, max_age: float = 60.,
+                 **buffer_kwds: Any) -> None:
+        self.buffer = TableWriteBuffer(store, **buffer_kwds)
+        self.max_age = max_age
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True, name="BackgroundTableWriter")
+        self.thread.start()
+        _background_writers.add(self)
+
+    @property
+    def failed(self) -> dict[str, Exception]:
+        return self.buffer.failed
+
+    @property
+    def stats(self) -> dict[str, Union[int, float]]:
+        return self.buffer.stats
+
+    def put(self, featurized: dict[str, Any], callback: Union[Callable[[str, Union[Exception, None]], None], None] = None) -> None:
+        """Queue the output of featurize_domain to be uploaded, blocking if the queue is full
+
+        Parameters
+        ----------
+        featurized : dict
+            Output from featurize_domain
+        callback : callable or None
+            Called from the writer thread with the domain group key and the error (None
+            if successful) once the domain's tables are saved, e.g. to write "done" markers
+        """
+        if not self.thread.is_alive():
+            raise RuntimeError("Background writer is not running") from self.error
+        self.queue.put((featurized, callback))
+
+    def _run(self) -> None:
+        #Domains added to the buffer since the last upload
+        waiting = []
+        oldest = None
+        while True:
+            timeout = None if oldest is None else max(0., self.max_age-(time.monotonic()-oldest))
+            try:
+                item = self.queue.get(timeout=timeout)
+                queued = True
+            except queue.Empty:
+                #Oldest domain has waited long enough
+                item, queued = self._flush, False
+
+            stop = item is self._stop
+            if stop or item is self._flush:
+                try:
+                    self.buffer.flush()
+                except Exception as e:
+                    self.error = e
+                    for cath_key, _ in waiting:
+                        self.buffer.failed.setdefault(cath_key, e)
+                uploaded = True
+            else:
+                featurized, callback = item
+                waiting.append((featurized["cath_key"], callback))
+                if oldest is None:
+                    oldest = time.monotonic()
+                try:
+                    self.buffer.add(featurized)
+                except Exception as e:
+                    #Failed during an automatic flush, errors are saved per domain
+                    self.buffer.failed.setdefault(featurized["cath_key"], e)
+                #add uploads everything when the buffer is full
+                uploaded = len(self.buffer.pending) == 0
+
+            if uploaded:
+                for cath_key, callback in waiting:
+                    if callback is not None:
+                        try:
+                            callback(cath_key, self.buffer.failed.get(cath_key))
+                        except Exception:
+                            RealtimeLogger.info(f"Callback failed for {cath_key}: {traceback.format_exc()}")
+                    self.queue.task_done()
+                waiting = []
+                oldest = None
+
+            if queued and (stop or item is self._flush):
+                self.queue.task_done()
+
+            if stop:
+                break
+
+    def flush(self) -> None:
+        """Wait until all queued domains have been uploaded"""
+        if self.thread.is_alive():
+            self.queue.put(self._flush)
+            self.queue.join()
+
+    def close(self) -> dict[str, Exception]:
+        """Upload all queued domains and stop the writer thread
+
+        Returns
+        -------
+        A dict of the domain group key to the error of each domain that failed
+        """
+        if self.thread.is_alive():
+            self.queue.put(self._stop)
+            self.thread.join()
+        self.buffer.close()
+        _background_writers.discard(self)
+        return self.failed
+
+    def __enter__(self) -> "BackgroundTableWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
 
-    to_remove = []
+def close_background_writers() -> None:
+    """Finish uploads from all writers that were not closed"""
+    for writer in list(_background_writers):
+        writer.close()
 
+atexit.register(close_background_writers)
+
+def save_feature_timings(store: h5pyd.File, cath_key: str, timings: list[dict[str, Any]]) -> None:
+    """Attach the per-category timing records from a featurized structure to its
+    domain group as a JSON encoded 'feature_timings' attribute. Collect them across
+    a run with the attributes of each domain (or from the records returned by
+    calculate_features) to see which tools are worth caching or parallelizing.
+
+    Parameters
+    ----------
+    store : h5pyd.File
+        HSDS file opened for appending
+    cath_key : str
+        Key of the domain group in the h5 file
+    timings : list of dicts
+        Records from ProteinFeaturizer.get_feature_timings
+    """
+    store[cath_key].attrs["feature_timings"] = json.dumps(timings)
+
+    total = sum(t["wall_time"] for t in timings)
+    tool = sum(t["tool_time"] for t in timings)
+    RealtimeLogger.info(f"Feature timings for {cath_key}: {total:.2f}s total, {tool:.2f}s in external tools")
+
+def get_cath_key(cath_domain: str, cathcode: Union[str, None]) -> tuple[str, Union[str, None]]:
+    """Get the key of a domain group in the h5 file and its key in the prepared structure IOStore
+
+    Parameters
+    ----------
+    cath_domain : str
+        CATH domain (7-letter code) or path to pdb file
+    cathcode : str or None
+        Superfamily cath domain belongs to (Use / instead of .)
+    """
     if cathcode is not None:
         cath_key = f"/{cathcode}/domains/{cath_domain}"
         s3_cath_key = "{}/{}".format(cathcode, cath_domain)
@@ -106,27 +532,81 @@ def calculate_features(job: Job, cath_full_h5: str, cath_domain: str, cathcode:
     else:
         cath_key = f"/domains/{cath_domain}"
         s3_cath_key = None
+    return cath_key, s3_cath_key
+
+def get_domain_keys(store: h5pyd.File, cath_key: str) -> list[str]:
+    """Get the tables already saved for a domain, empty if the domain has no group"""
+    try:
+        return list(store[cath_key].keys())
+    except KeyError:
+        return []
+
+def get_featurized_domains(store: h5pyd.File, superfamily: str, cath_domains: list[str]) -> set[str]:
+    """Get the domains that already have atom, residue, and edges tables. Run with
+    call_h5 so local files are read through the writer"""
+    return {cath_domain for cath_domain in cath_domains if {"atom", "residue", "edges"}.issubset(
+        get_domain_keys(store, f"/{superfamily}/domains/{cath_domain}"))}
+
+def plan_chain_groups(cath_domains: list[str]) -> OrderedDict[str, OrderedDict[str, list[str]]]:
+    """Group domains by the PDB entry and chain they were cut from so chain level
+    tools (EPPIC conservation) only need to run once per chain.
+    Chains from the same entry are kept together so they are processed back to back.
+    Domains that are not CATH style names (e.g. paths) are put into their own group.
+
+    Parameters
+    ----------
+    cath_domains : list of str
+        CATH domains (7-letter code) or paths to pdb files
+
+    Returns
+    -------
+    OrderedDict of PDB entry -> OrderedDict of chain -> domains
+    """
+    groups = OrderedDict()
+    for cath_domain in cath_domains:
+        if len(cath_domain) == 7 and not os.path.isfile(cath_domain):
+            pdb, chain = cath_domain[:4], cath_domain[4]
+        else:
+            pdb, chain = cath_domain, None
+        groups.setdefault(pdb, OrderedDict()).setdefault(chain, []).append(cath_domain)
+    return groups
 
+def featurize_domain(job: Job, cath_domain: str, cathcode: str, update_features: Union[list[str], None] = None, 
+                     domain_file: Union[str, None] = None, work_dir: Union[str, None] = None, edge_features: bool = True,
+                     existing_keys: Union[list[str], None] = None, tool_results: Union[dict, None] = None,
+                     electrostatics_method: str = "apbs") -> dict[str, Any]:
+    """Featurize a protein at the atom, residue, and graph level, keeping all tables in memory
+    so they can be uploaded with write_domain_tables. See calculate_features for parameters.
+
+    Parameters
+    ----------
+    existing_keys : list of str or None
+        Tables already saved for this domain (see get_domain_keys). Only used to check if the
+        domain can be updated when update_features is set.
+    tool_results : dict or None
+        Per-chain EPPIC results shared with other domains from the same PDB chain
+        (see ProteinFeaturizer.get_tool_result)
+
+    Returns
+    -------
+    A dict with the domain group key (cath_key), tables to write as (key, rec_arr, column_dtypes)
+    tuples (tables), keys to remove (delete), per category timings (timings), attributes
+    to set on the domain group (attrs), and the stage to record in the domain manifest (stage)
+    """
+    if work_dir is None:
+        if job is not None and hasattr(job, "fileStore"):
+            work_dir = job.fileStore.getLocalTempDir()
+        else:
+            work_dir = os.getcwd()
+
+    cath_key, s3_cath_key = get_cath_key(cath_domain, cathcode)
 
     if update_features is not None:
-        #Save features for cath domain in new seperate h5 files to be red in by the Featurizer
-        store = h5pyd.File(cath_full_h5, mode="r", use_cache=False)
-        try:
-            feat_files = list(store[cath_key].keys())
-            if len(feat_files) == 3 and "atom" in feat_files and \
-                "residue" in feat_files and feat_files and "edges":
-                for feature_type, index_col in (("atoms", "serial_number"), ("residues", "residue_id")):
-                    df = pd.DataFrame(store[f"{cath_key}/{feature_type}"]).set_index(index_col)
-                    feature_file = os.path.join(work_dir, f"{cath_domain}_{feature_type:-1]}.h5")
-                    df.to_hdf(feature_file, "table")
-                    del df
-                    to_remove.append(feature_file)
-            else:
-                update_features = None
-        except KeyError:
-            feats_exist = False
-        finally:
-            store.close()
+        #Only update features if the domain has already been fully featurized,
+        #otherwise there are no base tables to add the new columns to
+        feat_files = existing_keys if existing_keys is not None else []
+        if "atom" not in feat_files or "residue" not in feat_files:
+            update_features = None
 
     if s3_cath_key is not None:
         domain_file = os.path.join(work_dir, "{}.pdb".format(cath_domain))
@@ -144,24 +624,38 @@ def calculate_features(job: Job, cath_full_h5: str, cath_domain: str, cathcode:
         output_name = cath_key
 
     try:
+        #Features are never read back in from local files, in update mode only
+        #the requested categories are calculated on top of the defaults
         structure = ProteinFeaturizer(
             domain_file, cath_domain, job, work_dir,
-            force_feature_calculation=update_features is None,
-            update_features=update_features)
+            force_feature_calculation=True,
+            update_features=update_features,
+            tool_results=tool_results,
+            electrostatics_method=electrostatics_method)
     except:
         import traceback as tb
         RealtimeLogger.info(f"{tb.format_exc()}")
         raise
 
-    for ext, calculate in (("atom", structure.calculate_flat_features),
-                           ("residue", structure.calculate_flat_residue_features),
-                           ("edges", partial(structure.calculate_graph, edgelist=True))):
+    tables = [("atom", structure.calculate_flat_features),
+              ("residue", structure.calculate_flat_residue_features)]
+    if edge_features and (update_features is None or "edges" in update_features or \
+      "get_frustration" in structure.get_update_categories(coarse_grained=True)):
+        #Edges only need to be recalculated if frustration changed
+        tables.append(("edges", partial(structure.calculate_graph, edgelist=True)))
+
+    result = {"cath_key": cath_key, "tables": [], "delete": [], "timings": None, "attrs": {},
+        "stage": get_stage(update_features)}
+
+    for ext, calculate in tables:
         try:
             out, _ = calculate(write=False)
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception as e:
             tb = traceback.format_exc()
+            RealtimeLogger.info("Feature timings for failed domain {} {}: {}".format(
+                cathcode, output_name, json.dumps(structure.get_feature_timings())))
             raise
             CalculateFeaturesError(job, cath_domain, ext.split(".",1)[0], tb).save()
             return
@@ -177,45 +671,211 @@ def calculate_features(job: Job, cath_full_h5: str, cath_domain: str, cathcode:
             special_col_types = {"serial_number":"<i8", "atom_name":"<S5",
                 "residue_id":"<S8", "residue_name":"<S8", "chain":"<S2"}
 
+        if update_features is not None and ext != "edges":
+            #Only write the columns that changed as companion tables, one per
+            #category, leaving the (much larger) base table untouched. Categories
+            #that did not finish would overwrite the saved values with defaults
+            index_col = "residue_id" if ext=="residue" else "serial_number"
+            calculated = structure.get_calculated_categories(coarse_grained=ext=="residue")
+            categories = OrderedDict()
+            for category, feature_names in structure.get_update_categories(coarse_grained=ext=="residue").items():
+                if category in calculated:
+                    categories[category] = feature_names
+                else:
+                    RealtimeLogger.info("Not updating {} {} features, they were not calculated: {} {}".format(
+                        ext, category, cathcode, output_name))
+            for category, feature_names in categories.items():
+                cols = [index_col]+feature_names
+                column_dtypes = {col:special_col_types.get(col, '<f8') for col in cols}
+                rec_arr = df[cols].to_records(index=False, column_dtypes=column_dtypes)
+                result["tables"].append((f"{cath_key}/{ext}_updates/{category}", rec_arr, column_dtypes))
+            RealtimeLogger.info("Updated {} features ({}) for: {} {}".format(
+                ext, ", ".join(categories.keys()), cathcode, output_name))
+            continue
+
         column_dtypes = {col:special_col_types.get(col, '<f8') for col in df.columns}
         rec_arr = df.to_records(index=False, column_dtypes=column_dtypes)
+        result["tables"].append((f"{cath_key}/{ext}", rec_arr, column_dtypes))
 
-        with h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-            if f"{cath_key}/{ext}" in store.keys():
-                try:
-                    del store[f"{cath_key}/{ext}"]
-                except OSError:
-                    pass
-
-            if f"{cath_key}/{ext}" in store.keys():
-                try:
-                    del store[f"{cath_key}/{ext}"]
-                except:
-                    pass
-            try:
-                ds1 = store.create_table(f"{cath_key}/{ext}", data=rec_arr, dtype=list(column_dtypes.items()),
-                    chunks=True, compression="gzip", compression_opts=9)
-            except OSError as e:
-                if "Request Entity Too Large" in str(e):
-                    #Dataset too lareg to pass over http PUT
-                    span = 500 #atoms in structure int(len(rec_arr)/4)
-                    for i, start in enumerate(range(0, len(rec_arr), span)):
-                        small_data = rec_arr[start:start+span]
-                        if i==0:
-                            RealtimeLogger.info(f"Create small data: with: {len(small_data)}")
-                            store.create_table(f"{cath_key}/{ext}", data=small_data, dtype=list(column_dtypes.items()),
-                                chunks=True, compression="gzip", compression_opts=9)
-                        else:
-                            RealtimeLogger.info(f"Add small data: with: {len(small_data)}")
-                            store[f"{cath_key}/{ext}"].resize((store[f"{cath_key}/{ext}"].shape[0] + small_data.shape[0]), axis=0)
-                            store[f"{cath_key}/{ext}"][-small_data.shape[0]:] = small_data
+        if ext != "edges":
+            #Full recalculation supersedes any previous column updates
+            result["delete"].append(f"{cath_key}/{ext}_updates")
 
         RealtimeLogger.info("Finished {} features for: {} {}".format(ext, cathcode, output_name))
 
+    result["timings"] = structure.get_feature_timings()
+
+    if structure.electrostatics_method_used is not None:
+        #Potentials from approximate methods are not comparable to APBS
+        result["attrs"]["electrostatics_method"] = structure.electrostatics_method_used
+
     RealtimeLogger.info("Finished features for: {} {}".format(cathcode, output_name))
 
     safe_remove(domain_file)
 
-    if update_features:
-        for f in to_remove:
-            safe_remove(f)
+    return result
+
+def write_domain_tables(store: Union[h5pyd.File, str], featurized: dict[str, Any]) -> None:
+    """Upload all tables for a featurized domain into an open HSDS file
+
+    Parameters
+    ----------
+    store : h5pyd.File or str
+        HSDS file opened for appending, or path to an HSDS domain or local h5 file
+    featurized : dict
+        Output from featurize_domain
+    """
+    buffer = TableWriteBuffer(store)
+    buffer.add(featurized)
+    failed = buffer.close()
+    if len(failed) > 0:
+        raise failed[featurized["cath_key"]]
+
+def calculate_features(job: Job, cath_full_h5: str, cath_domain: str, cathcode: str, update_features: Union[list[str], None] = None, 
+                       domain_file: Union[str, None] = None, work_dir: Union[str, None] = None, edge_features: bool = True,
+                       electrostatics_method: str = "apbs") -> list[dict[str, Any]]:
+    """Featurize a protein at the atom, residue, and graph level saving all data into the h5 file on HSDS endpoint
+
+    Parameters
+    ----------
+    job : toil Job
+        Currently running job
+    cath_full_h5 : str
+        Path to h5 on hsds endpoint
+    cath_domain : str
+        CATH domain (7-letter code) PDB ID, CHAIN, Domain ID, eg. 1zyzA00
+    cathcode : str
+        Superfamily cath domain belongs to (Use / instead of .)
+    update_features : list of str or None
+        Select which features update (either indidual feature names or whole group names). If None, all features will be calculated.
+        Only the categories containing the selected features are calculated and each is written as a
+        companion table ({ext}_updates/{category}) next to the existing atom and residue tables. If the
+        domain has not been featurized yet, all features will be calculated. Default is None.
+    domain_file : str or None
+        Path to pdb file. If None, it will be downloaded from the raw IOStore (see data_stores)
+    work_dir : str
+        Where to save temp files
+    edge_features: bool
+        Include edge feature or not
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). The method used is
+        saved as the 'electrostatics_method' attribute of the domain group
+
+    Returns
+    -------
+    Timing records for each feature category (see ProteinFeaturizer.get_feature_timings),
+    also saved as the 'feature_timings' attribute of the domain group
+    """
+    existing_keys = None
+    if update_features is not None:
+        cath_key, _ = get_cath_key(cath_domain, cathcode)
+        with hsds_file(cath_full_h5, mode="r") as store:
+            existing_keys = get_domain_keys(store, cath_key)
+
+    featurized = featurize_domain(job, cath_domain, cathcode, update_features=update_features,
+        domain_file=domain_file, work_dir=work_dir, edge_features=edge_features,
+        existing_keys=existing_keys, electrostatics_method=electrostatics_method)
+
+    write_domain_tables(cath_full_h5, featurized)
+
+    return featurized["timings"]
+
+def calculate_features_batch(job: Job, cath_full_h5: str, cath_domains: list[str], cathcode: str, 
+                             update_features: Union[list[str], None] = None, work_dir: Union[str, None] = None, 
+                             edge_features: bool = True, electrostatics_method: str = "apbs",
+                             on_written: Union[Callable[[str, Union[Exception, None]], None], None] = None) -> dict[str, Any]:
+    """Featurize many domains in a single worker, sharing one HSDS connection and the
+    feature schemas, then upload all of the tables at once. A domain that fails is
+    skipped and its error is saved without stopping the rest of the batch. Domains
+    are grouped by source chain (see plan_chain_groups) so per-chain EPPIC results
+    can be reused between them.
+
+    Parameters
+    ----------
+    job : toil Job
+        Currently running job
+    cath_full_h5 : str
+        Path to h5 on hsds endpoint
+    cath_domains : list of str
+        CATH domains (7-letter code) or paths to pdb files
+    cathcode : str or None
+        Superfamily the cath domains belongs to (Use / instead of .)
+    update_features : list of str or None
+        See calculate_features
+    work_dir : str
+        Where to save temp files
+    edge_features: bool
+        Include edge feature or not
+    electrostatics_method : str
+        See calculate_features
+    on_written : callable or None
+        Called with the domain name and error (None if successful) as soon as each
+        domain's tables are uploaded, from the background writer thread
+
+    Returns
+    -------
+    A dict with the timing records of each finished domain (finished) and the
+    traceback of each failed domain (failed)
+    """
+    if work_dir is None:
+        if job is not None and hasattr(job, "fileStore"):
+            work_dir = job.fileStore.getLocalTempDir()
+        else:
+            work_dir = os.getcwd()
+
+    featurized = {}
+    failed = {}
+
+    #Tables are uploaded in the background while the next domains are featurized. The
+    #path is given so local files are written by the single writer process
+    writer = BackgroundTableWriter(cath_full_h5)
+
+    for pdb, chains in plan_chain_groups(cath_domains).items():
+        #Tool results are only kept while processing domains from one entry
+        tool_results = {}
+        for chain, chain_domains in chains.items():
+            if len(chain_domains) > 1:
+                RealtimeLogger.info(f"Sharing EPPIC results between {len(chain_domains)} domains from {pdb} {chain}")
+
+            for cath_domain in chain_domains:
+                existing_keys = None
+                if update_features is not None:
+                    existing_keys = call_h5(cath_full_h5, get_domain_keys,
+                        get_cath_key(cath_domain, cathcode)[0], mode="r")
+
+                try:
+                    result = featurize_domain(job, cath_domain, cathcode,
+                        update_features=update_features, work_dir=work_dir,
+                        edge_features=edge_features, existing_keys=existing_keys,
+                        tool_results=tool_results, electrostatics_method=electrostatics_method)
+                    featurized[cath_domain] = {"cath_key": result["cath_key"], "timings": result["timings"]}
+                    writer.put(result, callback=None if on_written is None else \
+                        (lambda cath_key, error, cath_domain=cath_domain: on_written(cath_domain, error)))
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception as e:
+                    failed[cath_domain] = traceback.format_exc()
+                    RealtimeLogger.info(f"Failed featurizing {cathcode} {cath_domain}: {e}")
+                    if job is not None and hasattr(job, "fileStore"):
+                        CalculateFeaturesError(job, Path(cath_domain).name, "featurize_domain",
+                            str(e), [failed[cath_domain]]).save()
+
+    #Do not finish the job until all tables are saved
+    write_failed = writer.close()
+
+    for cath_domain, result in list(featurized.items()):
+        if result["cath_key"] in write_failed:
+            error = write_failed[result["cath_key"]]
+            failed[cath_domain] = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+            del featurized[cath_domain]
+            RealtimeLogger.info(f"Failed writing {cathcode} {cath_domain}: {error}")
+            if job is not None and hasattr(job, "fileStore"):
+                CalculateFeaturesError(job, Path(cath_domain).name, "write_domain_tables",
+                    str(error), [failed[cath_domain]]).save()
+
+    stats = writer.stats
+    RealtimeLogger.info("Finished batch of {} domains ({} failed) from {}, uploaded {:.1f} MB at {:.2f} MB/s".format(
+        len(featurized), len(failed), cathcode, stats["bytes"]/1024**2,
+        stats["bytes"]/1024**2/stats["seconds"] if stats["seconds"] > 0 else 0.))
+
+    return {"finished": {d: r["timings"] for d, r in featurized.items()}, "failed": failed}
@@ -1,10 +1,11 @@
 from numbers import Number
 
-import h5pyd
 import pandas as pd
 from toil.job import Job
 from toil.realtimeLogger import RealtimeLogger
 
+from Prop3D.util.hsds import hsds_file
+
 def split_dataset_at_level(job: Job, cath_full_h5: str, superfamily: str, sfam_df: pd.DataFrame, level_key: str, level_name: str,
                            split_size: dict[str, float] = {"train":0.8, "validation":0.1, "test":0.1}) -> None:
     """Split a dataset into train/validation/test sets, saving the splits into new h5 groups with
@@ -91,7 +92,7 @@ def split_dataset_at_level(job: Job, cath_full_h5: str, superfamily: str, sfam_d
             size_pct = len(set1)/(len(sfam_df))
             subset = sfam_df[sfam_df.index.isin(set1)]["cath_domain"]
 
-        with h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+        with hsds_file(cath_full_h5, mode="a") as store:
             store.require_group(f"{superfamily}/data_splits/{level_name}")
             group = store.require_group(f"{superfamily}/data_splits/{level_name}/{split_name}")
             group.attrs["percent"] = size_pct
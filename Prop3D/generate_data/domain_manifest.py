@@ -0,0 +1,157 @@
+"""Per superfamily record of finished domains, stored next to the domains as
+/{superfamily}/completed. The table has one row per domain (sorted by name) with the
+last stage completed, a hash of the tables written, and when. process_superfamily
+creates the table and reads it in one request to find the remaining domains, and
+each domain's row is written in a single request after its tables are saved, so no
+two jobs ever write the same row.
+
+Stages are 'features' for a full featurization or 'update:{features}' when only
+some features were updated. Feature lists too long for the stage column are stored
+as 'update#{hash}' of the sorted feature names.
+"""
+import time
+import hashlib
+from typing import Union, Any
+
+import numpy as np
+
+from toil.realtimeLogger import RealtimeLogger
+
+MANIFEST_KEY = "completed"
+MANIFEST_DTYPE = [("domain", "S32"), ("stage", "S128"), ("hash", "S16"), ("time", "<f8")]
+
+FEATURES_STAGE = "features"
+STAGE_SIZE = np.dtype(MANIFEST_DTYPE)["stage"].itemsize
+
+#Row of each domain for every manifest used by this process, keyed by (file, superfamily)
+_manifest_rows = {}
+
+def get_stage(update_features: Union[list[str], tuple[str], None] = None) -> str:
+    """Name of the stage finished by featurizing a domain"""
+    if update_features is None:
+        return FEATURES_STAGE
+    features = ",".join(sorted(update_features))
+    stage = "update:"+features
+    if len(stage.encode("utf-8")) > STAGE_SIZE:
+        #numpy would silently truncate the name so it never matches again
+        stage = "update#"+hashlib.blake2b(features.encode("utf-8"), digest_size=16).hexdigest()
+    return stage
+
+def is_stage_complete(done_stage: str, stage: str) -> bool:
+    """Check if a domain that finished done_stage needs to run stage. Updated
+    domains were fully featurized first"""
+    if stage == FEATURES_STAGE:
+        return done_stage == FEATURES_STAGE or done_stage.startswith(("update:", "update#"))
+    return done_stage == stage
+
+def hash_tables(tables: list[tuple[str, np.recarray, Any]]) -> str:
+    """Short hash of the contents of a domain's tables"""
+    h = hashlib.blake2b(digest_size=8)
+    for key, rec_arr, _ in sorted(tables, key=lambda t: t[0]):
+        h.update(key.encode("utf-8"))
+        h.update(np.ascontiguousarray(rec_arr).tobytes())
+    return h.hexdigest()
+
+def split_domain_key(cath_key: str) -> Union[tuple[str, str], None]:
+    """Get the superfamily and domain from /{superfamily}/domains/{domain}, or None
+    if the key is not in a superfamily"""
+    if "/domains/" not in cath_key:
+        return None
+    superfamily, domain = cath_key.rsplit("/domains/", 1)
+    return superfamily.strip("/"), domain.split("/")[0]
+
+def _decode(value: Union[bytes, str]) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+def init_domain_manifest(store: Any, superfamily: str, cath_domains: list[str]) -> tuple[bool, dict[str, tuple[str, str, float]]]:
+    """Create or extend the manifest for a superfamily and read it. Only call from
+    one job per superfamily, before starting the domain jobs (rows may move)
+
+    Parameters
+    ----------
+    store : h5pyd.File or h5py.File
+        File opened for writing
+    superfamily : str
+        Superfamily key, e.g. 1/10/10/10
+    cath_domains : list of str
+        All domains in the superfamily
+
+    Returns
+    -------
+    created : bool
+        True if the manifest did not exist, so domains finished earlier are not listed
+    completed : dict
+        Domain mapped to (stage, hash, time) of every domain that finished a stage
+    """
+    key = f"/{superfamily.strip('/')}/{MANIFEST_KEY}"
+    created = key not in store
+    rows = np.zeros(0, dtype=MANIFEST_DTYPE) if created else store[key][:]
+
+    known = {_decode(d) for d in rows["domain"]}
+    new_domains = sorted(set(cath_domains)-known)
+    if len(new_domains) > 0:
+        #Keep rows sorted by domain so each job can find its row
+        new_rows = np.zeros(len(new_domains), dtype=MANIFEST_DTYPE)
+        new_rows["domain"] = new_domains
+        rows = np.concatenate((rows, new_rows))
+        rows = rows[np.argsort(rows["domain"], kind="stable")]
+        if not created:
+            del store[key]
+        store.create_dataset(key, data=rows)
+        RealtimeLogger.info(f"Added {len(new_domains)} domains to manifest {key}")
+
+    _manifest_rows.pop((store.filename, superfamily.strip("/")), None)
+
+    completed = {_decode(row["domain"]): (_decode(row["stage"]), _decode(row["hash"]), float(row["time"])) \
+        for row in rows if len(row["stage"]) > 0}
+
+    return created, completed
+
+def get_manifest_row(store: Any, superfamily: str, domain: str) -> Union[int, None]:
+    """Get the row of a domain in the manifest, domain names are read once per process"""
+    cache_key = (store.filename, superfamily)
+    rows = _manifest_rows.get(cache_key)
+    if rows is None or domain not in rows:
+        key = f"/{superfamily}/{MANIFEST_KEY}"
+        if key not in store:
+            return None
+        dset = store[key]
+        #Only read the domain column if possible
+        domains = dset.fields("domain")[:] if hasattr(dset, "fields") else dset[:]["domain"]
+        rows = _manifest_rows[cache_key] = {_decode(d): i for i, d in enumerate(domains)}
+    return rows.get(domain)
+
+def mark_domains_complete(store: Any, completed: list[tuple[str, str, Union[str, None]]]) -> int:
+    """Record domains that finished a stage. Domains not in a manifest are skipped
+
+    Parameters
+    ----------
+    store : h5pyd.File or h5py.File
+        File opened for writing
+    completed : list of (cath_key, stage, hash)
+        Domain group key, stage from get_stage, and hash of its tables (None if unknown,
+        e.g. tables written before the manifest existed)
+
+    Returns
+    -------
+    Number of domains recorded
+    """
+    marked = 0
+    for cath_key, stage, content_hash in completed:
+        key = split_domain_key(cath_key)
+        if key is None:
+            continue
+        superfamily, domain = key
+        try:
+            i = get_manifest_row(store, superfamily, domain)
+            if i is None:
+                continue
+            row = np.array([(domain, stage, content_hash or "", time.time())], dtype=MANIFEST_DTYPE)
+            store[f"/{superfamily}/{MANIFEST_KEY}"][i:i+1] = row
+            marked += 1
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            #Domain will be checked again on the next run
+            RealtimeLogger.info(f"Unable to add {cath_key} to manifest: {e}")
+    return marked
@@ -1,320 +1,637 @@
+import os
+import time
+import queue
+import hashlib
+import threading
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Any
+
+import numpy as np
 import h5py
 import h5pyd
-from time import sleep
-from pathlib import Path
 from Prop3D.util import safe_remove
 from Prop3D.util.toil import map_job
+from Prop3D.util.hsds import hsds_file, get_max_request_size, get_thread_file
 
 from toil.job import Job
 from toil.common import Toil
 from toil.realtimeLogger import RealtimeLogger
 
-def load_h5(job: Job, h5_file: str, hsds_file: str, prefix: str = "", hard_link_keys: list[str] = ["validation", "train", "test"], 
-            hard_link_map: dict[str, str] = {"data_splits":"domains", "representatives":"domains"}, hardlink_items: bool = False):
-    """A parallelized version of hsload
+#Largest batch of datasets uploaded by one load_h5 job
+DEFAULT_BATCH_SIZE = 256*1024**2
+DEFAULT_BATCH_ITEMS = 5000
+
+#Bytes counted for each group or link when balancing batches, they are small but
+#still one request each
+ITEM_OVERHEAD = 4096
+
+def get_manifest_path(h5_file: str, hsds_file: str) -> str:
+    """Default manifest of completed items when loading h5_file into hsds_file"""
+    digest = hashlib.md5(hsds_file.encode("utf-8")).hexdigest()[:8]
+    return f"{h5_file}.load-{digest}.manifest"
+
+def read_manifest(manifest: Union[str, None]) -> set[str]:
+    """Get the keys of all items that have already been loaded"""
+    if manifest is None or not os.path.isfile(manifest):
+        return set()
+    with open(manifest) as f:
+        #A partial last line from an interrupted job is just loaded again
+        return {line[:-1] for line in f if line.endswith("\n")}
+
+class ManifestWriter(object):
+    """Append completed keys to the manifest. Lines are written with O_APPEND in one
+    write, so jobs on the same node can share a manifest"""
+    def __init__(self, manifest: Union[str, None]) -> None:
+        self.manifest = manifest
+        self.lock = threading.Lock()
+
+    def add(self, key: str) -> None:
+        if self.manifest is None:
+            return
+        with self.lock:
+            fd = os.open(self.manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, f"{key}\n".encode("utf-8"))
+            finally:
+                os.close(fd)
+
+def get_link_target(key: str, parent: str, hard_link_keys: list[str], hard_link_map: dict[str, str]) -> Union[str, None]:
+    """Get the key a group should be hard linked to instead of copied, e.g. the
+    domains in data_splits/{level}/train or representatives are links into domains"""
+    parent_name = parent.rsplit("/", 1)[-1]
+    for old_kwd, new_kwd in hard_link_map.items():
+        if f"/{old_kwd}" in f"/{parent}" and (parent_name in hard_link_keys or parent_name == old_kwd):
+            return f"/{parent.split(old_kwd, 1)[0]}{new_kwd}/{key.rsplit('/', 1)[-1]}"
+    return None
+
+def plan_load(h5_file: str, prefix: str = "", hard_link_keys: list[str] = ["validation", "train", "test"],
+              hard_link_map: dict[str, str] = {"data_splits":"domains", "representatives":"domains"}) -> tuple[list, list]:
+    """Walk an h5 file and list everything that needs to be created in HSDS
+
+    Returns
+    -------
+    items : list of (kind, key, nbytes)
+        Groups and datasets in path order, kind is 'group' or 'dataset'
+    links : list of (key, target)
+        Groups that are hard links to another group
     """
-    #RealtimeLogger.info(f"Adding h5_file ({h5_file_id}) to hsds_file ({hsds_file})")
-                        
-    if prefix == "":
-        #Start of hierarchy
+    items = []
+    links = []
+
+    def walk(group, key):
+        for name, obj in group.items():
+            child = f"{key}/{name}"
+            if isinstance(obj, h5py.Group):
+                target = get_link_target(child, key.lstrip("/"), hard_link_keys, hard_link_map)
+                if target is not None and target in group.file:
+                    links.append((child, target))
+                    continue
+                items.append(("group", child, ITEM_OVERHEAD))
+                walk(obj, child)
+            elif isinstance(obj, h5py.Dataset):
+                items.append(("dataset", child, obj.size*obj.dtype.itemsize+ITEM_OVERHEAD))
+
+    prefix = prefix.strip("/")
+    with h5py.File(h5_file, "r") as f:
+        root = f[f"/{prefix}"]
+        if isinstance(root, h5py.Dataset):
+            items.append(("dataset", f"/{prefix}", root.size*root.dtype.itemsize+ITEM_OVERHEAD))
+        else:
+            items.append(("group", f"/{prefix}" if prefix != "" else "/", ITEM_OVERHEAD))
+            walk(root, f"/{prefix}" if prefix != "" else "")
+
+    return items, links
+
+def partition_items(items: list[tuple[Any, ...]], batch_size: int = DEFAULT_BATCH_SIZE,
+                    max_items: int = DEFAULT_BATCH_ITEMS) -> list[list[tuple[Any, ...]]]:
+    """Split items into contiguous batches of about batch_size bytes, items are kept
+    in path order so each domain is uploaded by one job. The last field of each item
+    is its size"""
+    batches = []
+    batch, size = [], 0
+    for item in items:
+        if len(batch) > 0 and (size+item[-1] > batch_size or len(batch) >= max_items):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(item)
+        size += item[-1]
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def upload_dataset(store: h5pyd.File, h5_object: h5py.Dataset, key: str, max_request_size: int) -> int:
+    """Copy a dataset into HSDS, sending at most max_request_size bytes per request.
+    Partial datasets left by an interrupted load are replaced. Returns the number
+    of requests"""
+    dset_parameters = {k:getattr(h5_object, k) for k in ('compression',
+        'compression_opts', 'scaleoffset', 'shuffle', 'fletcher32', 'fillvalue')}
+    dset_parameters = {k:v for k, v in dset_parameters.items() if v is not None}
+
+    #One request if the whole dataset fits, otherwise create it empty and write slices
+    nbytes = h5_object.size*h5_object.dtype.itemsize
+    small = nbytes <= 0.9*max_request_size or h5_object.shape == ()
+    data = h5_object[()] if small else None
+
+    for attempt in range(2):
         try:
-            with h5pyd.File(hsds_file, use_cache=False, retries=100):
-                file_mode = "a"
-        except IOError:
-            file_mode = "w"
-    else:
-        file_mode = "a"
-
-    RealtimeLogger.info(f"got file mode {file_mode}")
-
-
-    #Save link to h5 file in file store
-    #h5_file = job.fileStore.readGlobalFile(h5_file_id, cache=False, symlink=True)
-
-    RealtimeLogger.info(f"downlaoded h5_file {h5_file}")
+            if small:
+                store.create_dataset(key, data=data, chunks=True, **dset_parameters)
+            else:
+                store.create_dataset(key, shape=h5_object.shape, dtype=h5_object.dtype,
+                    chunks=True, **dset_parameters)
+            break
+        except (OSError, ValueError):
+            if attempt == 1 or key not in store:
+                raise
+            #Left over from an interrupted load
+            del store[key]
+
+    if small:
+        return 1
+
+    row_size = max(1, nbytes//max(h5_object.shape[0], 1))
+    rows_per_request = max(1, int(0.9*max_request_size)//row_size)
+    dset = store[key]
+    requests = 1
+    for start in range(0, h5_object.shape[0], rows_per_request):
+        dset[start:start+rows_per_request] = h5_object[start:start+rows_per_request]
+        requests += 1
+    return requests
+
+def require_group(store: h5pyd.File, key: str) -> h5pyd.Group:
+    """require_group that retries once if another job created the group at the same time"""
+    for attempt in range(2):
+        try:
+            return store.require_group(key)
+        except (OSError, ValueError):
+            if attempt == 1:
+                raise
 
-    if prefix.startswith('/'):
-        prefix = prefix[1:]
+def load_h5_batch(job: Job, batch: list[tuple[str, str, int]], h5_file: str, hsds_path: str,
+                  manifest: Union[str, None] = None, workers: int = 8) -> dict[str, Any]:
+    """Upload one batch of groups and datasets over a single pooled connection.
+    Groups are created first, then datasets are sent with parallel requests.
+    Completed items are added to the manifest.
 
-    if all([k not in prefix for k in hard_link_map.keys()]):
-        #if "domain" not in full_key or "data_splits" not in full_key or "representatives" not in full_key:
-        RealtimeLogger.info(f"Adding /{prefix}/{key}")
-        
-    elif hardlink_items:
-        #old_kwd, new_kwd = next(hard_link_map.items())
-        for old_kwd, new_kwd in hard_link_map.items():
-            if old_kwd in prefix:
-                base_key = Path(prefix).stem
-                with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                    store['/{prefix}'] = store[f"/{prefix.split(old_kwd, 1)[0]}/{new_kwd}/{base_key}"]
-                RealtimeLogger.info(f"Hardlinked /{prefix}")
-                break
-        else:
-            raise RuntimeError(f"hard_link_map keys ('{list(old_kwd.keys())}')")
-        
+    Parameters
+    ----------
+    job : toil.Job
+        Toil job
+    batch : list of (kind, key, nbytes)
+        Items from partition_items
+    h5_file : str
+        Local h5 file
+    hsds_path : str
+        HSDS domain to load into
+    manifest : str or None
+        File listing loaded items, see get_manifest_path
+    workers : int
+        Number of concurrent uploads
+
+    Returns
+    -------
+    Stats with number of items, bytes, and failures
+    """
+    done = ManifestWriter(manifest)
+    max_request_size = get_max_request_size()
+    start_time = time.time()
+    failed = []
+
+    groups = [key for kind, key, _ in batch if kind == "group"]
+    datasets = [key for kind, key, _ in batch if kind == "dataset"]
+
+    with h5py.File(h5_file, "r") as f, hsds_file(hsds_path, mode="a") as store:
+        for key in groups:
+            try:
+                group = require_group(store, key)
+                for attr, attr_value in f[key].attrs.items():
+                    group.attrs[attr] = attr_value
+                done.add(key)
+            except Exception as e:
+                RealtimeLogger.info(f"Failed to create group {key}: {e}")
+                failed.append(key)
+
+        #Parents of datasets are created by the batch with the group, make sure they
+        #exist before uploading in parallel
+        for parent in sorted({key.rsplit("/", 1)[0] for key in datasets} - set(groups)):
+            if parent != "":
+                require_group(store, parent)
+
+        def upload(key):
+            try:
+                #h5py serializes calls with its own lock, each thread uses its own HSDS handle
+                requests = upload_dataset(get_thread_file(store), f[key], key, max_request_size)
+                done.add(key)
+                return requests
+            except Exception as e:
+                RealtimeLogger.info(f"Failed to upload {key}: {e}")
+                failed.append(key)
+                return 0
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            requests = sum(pool.map(upload, datasets))
+
+    nbytes = sum(size for kind, _, size in batch if kind == "dataset")
+    elapsed = time.time()-start_time
+    RealtimeLogger.info(f"Loaded {len(batch)-len(failed)}/{len(batch)} items ({nbytes/1024**2:.1f}MB) "
+        f"in {requests} requests, {elapsed:.1f}s ({nbytes/1024**2/max(elapsed, 1e-6):.1f}MB/s)")
+
+    if len(failed) > 0:
+        raise RuntimeError(f"Failed to load {len(failed)} items: {failed[:10]}")
+
+    return {"items": len(batch), "bytes": nbytes, "requests": requests, "seconds": elapsed}
+
+def load_h5_links(job: Job, links: list[tuple[str, str, int]], hsds_path: str, manifest: Union[str, None] = None,
+                  max_items: int = DEFAULT_BATCH_ITEMS) -> None:
+    """Create hard links (e.g. data_splits and representatives into domains) after
+    all groups have been loaded. Large lists are split into child jobs"""
+    if len(links) > max_items:
+        for batch in partition_items(links, max_items=max_items):
+            job.addChildJobFn(load_h5_links, batch, hsds_path, manifest=manifest, max_items=max_items)
         return
 
-    with h5py.File(h5_file, 'r') as f:
-        h5_object = f[f'/{prefix}']
-
-        if isinstance(h5_object, h5py.Group):
-            with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                store_object = store.require_group(f'/{prefix}')
-
-                for attr, attr_value in h5_object.attrs.items():
-                    store_object.attrs[attr] = attr_value
-
-            for key in h5_object.keys():
-                if key not in hard_link_keys:
-                    job.addChildJobFn(load_h5, h5_file, hsds_file, prefix=f"{prefix}/{key}",
-                                      hard_link_keys=hard_link_keys, hard_link_map=hard_link_map, 
-                                      hardlink_items=False)
-                else:
-                    #Add hard links last
-                    job.addFollowOnJobFn(load_h5, h5_file, hsds_file, prefix=f"{prefix}/{key}", 
-                                         hard_link_keys=hard_link_keys, hard_link_map=hard_link_map, 
-                                         hardlink_items=True)
-
-        elif isinstance(h5_object, h5py.Dataset):
-            dset = h5_object[:]
-            shape = h5_object.shape
-            dtype = h5_object.dtype
-            dset_parameters = {k:getattr(h5_object, k) for k in ('compression',
-                'compression_opts', 'scaleoffset', 'shuffle', 'fletcher32', 'fillvalue')}
-            dset_parameters['chunks'] = True
-            
-            retry = False
-            should_remove = False
-            with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                try:
-                    store.require_dataset(f'/{prefix}', shape, dtype, data=dset, **dset_parameters)
-                except (OSError, TypeError) as e:
-                    if isinstance(e, OSError) and "Request Entity Too Large" in str(e):
-                        #First time loading dataset and it is too large
-                        retry = True
-                        should_remove = True
-
-                    elif isinstance(e, TypeError) or (isinstance(e, OSError) and "Dataset is not extensible" in str(e)):
-                        #Previous error and datasets aren't the same size. Remove everything and try again
-                        retry = True
-                        should_remove = True
-
-            if should_remove:
-                with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                    try:
-                        del store[f'/{prefix}']
-                    except IOError:
-                        pass
-                
-                for _ in range(20):
-                    with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                        try:
-                            store[f'/{prefix}']
-                            sleep(1)
-                            continue
-                        except KeyError:
-                            break
-                else:
-                    RealtimeLogger.info(f"Unable to remove {full_key} to start over")
-                    return
-
-            if retry:
-                #Dataset too lareg to pass over http PUT
-                
-                #dset_parameters["chunks"] = (chunk_size,)
-                dset_parameters["maxshape"] = None
-
-                with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                    new_dset = store.create_dataset(f'/{prefix}', dset.shape[0], dtype, **dset_parameters)
-                    chunk_size = min(new_dset.chunks[0], 500) #atoms in structure int(len(rec_arr)/4)
-
-                for start in range(0, len(dset), chunk_size):
-                    small_data = dset[start:start+chunk_size]
-                    with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-                        new_dset = store[f'/{prefix}']
-                        new_dset.resize(dset.shape[0] + small_data.shape[0], axis=0)
-                        new_dset[-1:] = small_data
-    # with h5py.File(h5_file, 'r') as f:
-    #     for key in f[f'/{prefix}'].keys():
-    #         full_key = f"/{prefix}/{key}"
-    #         if all([k not in full_key for k in hard_link_map.keys()]):
-    #             #if "domain" not in full_key or "data_splits" not in full_key or "representatives" not in full_key:
-    #             RealtimeLogger.info(f"Adding {prefix}/{key}")
-    #         elif hardlink_items:
-    #             #old_kwd, new_kwd = next(hard_link_map.items())
-    #             for old_kwd, new_kwd in hard_link_map.items():
-    #                 if old_kwd in full_key:
-    #                     store[full_key] = store[f"{prefix.split(old_kwd, 1)[0]}/{new_kwd}/{key}"]
-    #                     RealtimeLogger.info(f"Hardlinked {full_key}")
-    #                     break
-    #             else:
-    #                 raise RuntimeError(f"hard_link_map keys ('{list(old_kwd.keys())}')")
-                
-    #             continue
-
-                
-    #         h5_object = f[full_key]
-
-    #         if isinstance(h5_object, h5py.Group):
-    #             with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-    #                 store_object = store.require_group(full_key)
-
-    #                 for attr, attr_value in h5_object.attrs.items():
-    #                     store_object.attrs[attr] = attr_value
-
-    #             if key not in hard_link_keys:
-    #                 job.addChildJobFn(load_h5, h5_file, hsds_file, prefix=f"{prefix}/{key}",
-    #                                 hard_link_keys=hard_link_keys, hard_link_map=hard_link_map, hardlink_items=False)
-    #             else:
-    #                 #Add hard links last
-    #                 job.addFollowOnJobFn(load_h5, h5_file, hsds_file, prefix=f"{prefix}/{key}", 
-    #                                 hard_link_keys=hard_link_keys, hard_link_map=hard_link_map, hardlink_items=True)
-                    
-    #         elif isinstance(h5_object, h5py.Dataset):
-    #             dset = h5_object[:]
-    #             shape = h5_object.shape
-    #             dtype = h5_object.dtype
-    #             dset_parameters = {k:getattr(h5_object, k) for k in ('compression',
-    #                 'compression_opts', 'scaleoffset', 'shuffle', 'fletcher32', 'fillvalue')}
-    #             dset_parameters['chunks'] = True
-                
-    #             retry = False
-    #             should_remove = False
-    #             with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-    #                 try:
-    #                     store.require_dataset(full_key, shape, dtype, data=dset, **dset_parameters)
-    #                 except (OSError, TypeError) as e:
-    #                     if isinstance(e, OSError) and "Request Entity Too Large" in str(e):
-    #                         #First time loading dataset and it is too large
-    #                         retry = True
-    #                         should_remove = True
-
-    #                     elif isinstance(e, TypeError) or (isinstance(e, OSError) and "Dataset is not extensible" in str(e)):
-    #                         #Previous error and datasets aren't the same size. Remove everything and try again
-    #                         retry = True
-    #                         should_remove = True
-
-    #             if should_remove:
-    #                 with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-    #                     try:
-    #                         del store[full_key]
-    #                     except IOError:
-    #                         pass
-                    
-    #                 for _ in range(20):
-    #                     with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-    #                         try:
-    #                             store[full_key]
-    #                             sleep(1)
-    #                             continue
-    #                         except KeyError:
-    #                             break
-    #                 else:
-    #                     continue
-    #                     raise RuntimeError(f"Unable to remove {full_key} to start over")
-
-    #             if retry:
-    #                 #Dataset too lareg to pass over http PUT
-                    
-    #                 #dset_parameters["chunks"] = (chunk_size,)
-    #                 dset_parameters["maxshape"] = None
-
-    #                 with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-    #                     new_dset = store.create_dataset(full_key, dset.shape[0], dtype, **dset_parameters)
-    #                     chunk_size = min(new_dset.chunks[0], 500) #atoms in structure int(len(rec_arr)/4)
-
-    #                 for start in range(0, len(dset), chunk_size):
-    #                     small_data = dset[start:start+chunk_size]
-    #                     with h5pyd.File(hsds_file, mode=file_mode, use_cache=False, retries=100) as store:
-    #                         new_dset = store[full_key]
-    #                         new_dset.resize(dset.shape[0] + small_data.shape[0], axis=0)
-    #                         new_dset[-1:] = small_data
-
-def save_h5(hsds_file: str, h5_file: str, prefix: str = "", hard_link_keys: list[str] = ["validation", "train", "test"], 
-            hard_link_map: dict[str,str] = {"data_splits":"domains", "representatives":"domains"}, hardlink_items: bool = False) -> None:
-    """A custom version of hsget to save a H5 file from a an h5 file on an hsds endpoint. Parallel writing does not work, so Toil is not used.
+    done = ManifestWriter(manifest)
+    with hsds_file(hsds_path, mode="a") as store:
+        for key, target, _ in links:
+            if key not in store:
+                require_group(store, key.rsplit("/", 1)[0])
+                store[key] = store[target]
+            done.add(key)
+    RealtimeLogger.info(f"Hardlinked {len(links)} items")
+
+def load_h5(job: Job, h5_file: str, hsds_path: str, prefix: str = "", hard_link_keys: list[str] = ["validation", "train", "test"],
+            hard_link_map: dict[str, str] = {"data_splits":"domains", "representatives":"domains"},
+            batch_size: int = DEFAULT_BATCH_SIZE, max_items: int = DEFAULT_BATCH_ITEMS, workers: int = 8,
+            manifest: Union[str, None] = None) -> None:
+    """A parallelized version of hsload. The h5 file is split into batches of about
+    batch_size bytes, each uploaded by one job with parallel requests (one connection
+    per upload thread), instead of one job per group and dataset. Hard links are created
+    after every batch finished. Items already in the manifest are skipped, so an interrupted load can be
+    started again with the same arguments.
+
+    Parameters
+    ----------
+    job : toil.Job
+        Toil job
+    h5_file : str
+        Local h5 file, must be readable by all workers
+    hsds_path : str
+        HSDS domain to load into
+    prefix : str
+        The group to start loading from. Default is '' (everything)
+    hard_link_keys : list
+        Groups inside hard_link_map keys whose children are hard links, e.g. data_splits/{level}/train
+    hard_link_map : dict
+        Groups with links and where the links point to. The path is split on the key and the new key is added
+    batch_size : int
+        Approximate number of bytes uploaded by each job
+    max_items : int
+        Maximum number of groups and datasets in each job
+    workers : int
+        Number of concurrent uploads in each job
+    manifest : str or None
+        File listing loaded items. Default: next to h5_file (see get_manifest_path)
+    """
+    if manifest is None:
+        manifest = get_manifest_path(h5_file, hsds_path)
+
+    try:
+        with hsds_file(hsds_path, mode="r"):
+            pass
+    except IOError:
+        with hsds_file(hsds_path, mode="w"):
+            pass
+        #Nothing has been loaded into a new domain
+        safe_remove(manifest)
+
+    items, links = plan_load(h5_file, prefix=prefix, hard_link_keys=hard_link_keys, hard_link_map=hard_link_map)
+
+    loaded = read_manifest(manifest)
+    total = len(items)+len(links)
+    items = [item for item in items if item[1] not in loaded]
+    links = [(key, target, ITEM_OVERHEAD) for key, target in links if key not in loaded]
+    RealtimeLogger.info(f"Loading {len(items)+len(links)}/{total} items from {h5_file} "
+        f"({total-len(items)-len(links)} already loaded, see {manifest})")
+
+    for batch in partition_items(items, batch_size=batch_size, max_items=max_items):
+        job.addChildJobFn(load_h5_batch, batch, h5_file, hsds_path, manifest=manifest, workers=workers)
+
+    #Groups in links must exist first
+    if len(links) > 0:
+        job.addFollowOnJobFn(load_h5_links, links, hsds_path, manifest=manifest, max_items=max_items)
+
+#Memory used to stage data read from HSDS before it is written to the h5 file
+DEFAULT_STAGING_SIZE = 256*1024**2
+
+class ExportStaging(object):
+    """Bounded staging area between the HSDS readers and the h5 writer. Readers
+    block once staged data reaches max_size bytes"""
+    def __init__(self, max_size: int = DEFAULT_STAGING_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.items = deque()
+        self.cond = threading.Condition()
+
+    def put(self, item: tuple[Any, ...], nbytes: int = 0) -> None:
+        with self.cond:
+            #Always accept one item so datasets larger than max_size can still pass
+            while self.size > 0 and self.size+nbytes > self.max_size:
+                self.cond.wait()
+            self.items.append((item, nbytes))
+            self.size += nbytes
+            self.cond.notify_all()
+
+    def get(self, timeout: float = 1.) -> Union[tuple[Any, ...], None]:
+        with self.cond:
+            if len(self.items) == 0:
+                self.cond.wait(timeout)
+                if len(self.items) == 0:
+                    return None
+            item, nbytes = self.items.popleft()
+            self.size -= nbytes
+            self.cond.notify_all()
+            return item
+
+def read_hsds_dataset(dset: h5pyd.Dataset, max_request_size: int) -> np.ndarray:
+    """Read a dataset in slices no larger than max_request_size"""
+    nbytes = dset.size*dset.dtype.itemsize
+    if dset.shape == () or nbytes <= max_request_size:
+        return dset[()]
+    row_size = max(1, nbytes//max(dset.shape[0], 1))
+    rows_per_request = max(1, max_request_size//row_size)
+    return np.concatenate([dset[start:start+rows_per_request] \
+        for start in range(0, dset.shape[0], rows_per_request)])
+
+def get_dataset_parameters(dset: h5pyd.Dataset) -> dict[str, Any]:
+    """Creation properties of an HSDS dataset to keep in the h5 file"""
+    dset_parameters = {k:getattr(dset, k, None) for k in ('compression', 'compression_opts',
+        'scaleoffset', 'shuffle', 'fletcher32', 'fillvalue')}
+    dset_parameters = {k:v for k, v in dset_parameters.items() if v not in (None, False)}
+    chunks = getattr(dset, "chunks", None)
+    if dset.shape != ():
+        dset_parameters["chunks"] = chunks if isinstance(chunks, tuple) else True
+    return dset_parameters
+
+def save_h5(hsds_path: str, h5_file: str, prefix: str = "", hard_link_keys: list[str] = ["validation", "train", "test"],
+            hard_link_map: dict[str,str] = {"data_splits":"domains", "representatives":"domains"}, workers: int = 8,
+            staging_size: int = DEFAULT_STAGING_SIZE, manifest: Union[str, None] = None, checkpoint_interval: float = 60.,
+            progress_interval: float = 30.) -> dict[str, Any]:
+    """A parallel version of hsget to save an h5 file from an HSDS endpoint. HDF5 files cannot
+    be written in parallel, so reader threads walk the HSDS domain and fetch datasets into a
+    bounded staging area while a single writer (this thread) adds them to the h5 file.
+
+    The writer flushes the h5 file and appends everything written since the last flush to a
+    checkpoint manifest every checkpoint_interval seconds. Groups are added once all of their
+    children are saved, so an interrupted export started again with the same arguments does
+    not walk or fetch them again.
 
     Parameters
     ----------
-    hsds_file : str
+    hsds_path : str
         Path to h5 file on HSDS endpoint
     h5_file : str
         New path on local server to save the remote h5 file to
     prefix : str
         The prefix to start saving from. Defualt is ''
     hard_link_keys : list
-        If a group name is in the following keys, create a soft link to it so no extra data is saved.
+        Groups inside hard_link_map keys whose children are hard links, e.g. data_splits/{level}/train
     hard_link_map : dict
-        Create a soft link by replacing to the path to new one. The path is split on the key.
-    hardlink_items : bool
-    
+        Groups with links and where the links point to. The path is split on the key and the new key is added
+    workers : int
+        Number of concurrent readers
+    staging_size : int
+        Maximum bytes read from HSDS but not yet written
+    manifest : str or None
+        Checkpoint manifest. Default: next to h5_file (see get_manifest_path)
+    checkpoint_interval : float
+        Seconds between checkpoints
+    progress_interval : float
+        Seconds between progress reports
+
+    Returns
+    -------
+    Stats with number of items, bytes, seconds, and failed keys
     """
+    if manifest is None:
+        manifest = get_manifest_path(h5_file, hsds_path).replace(".load-", ".save-")
+
+    if not os.path.isfile(h5_file):
+        #Start over
+        safe_remove(manifest)
+
+    saved = read_manifest(manifest)
+    checkpoint = ManifestWriter(manifest)
+    max_request_size = get_max_request_size()
+    staging = ExportStaging(staging_size)
+
+    #Keys left to read, groups are listed and datasets fetched by the readers
+    work = queue.Queue()
+    pending_work = [0]
+    work_lock = threading.Lock()
+
+    def add_work(key, kind):
+        with work_lock:
+            pending_work[0] += 1
+        work.put((key, kind))
+
+    def read(store):
+        #Each reader uses its own HSDS handle
+        store = get_thread_file(store)
+        while True:
+            key, kind = work.get()
+            if key is None:
+                return
+            try:
+                if kind == "group":
+                    group = store[key]
+                    children = []
+                    for name in group.keys():
+                        child = f"{key.rstrip('/')}/{name}"
+                        if child in saved:
+                            continue
+                        target = get_link_target(child, key.strip("/"), hard_link_keys, hard_link_map)
+                        if target is not None:
+                            children.append((child, "link", target))
+                        else:
+                            children.append((child, "object", None))
+                    staging.put(("group", key, dict(group.attrs.items()), children))
+
+                    #The writer knows about the children before they are staged
+                    for child, kind, _ in children:
+                        if kind == "object":
+                            add_work(child, "object")
+                elif kind == "object":
+                    obj = store[key]
+                    if isinstance(obj, h5pyd.Group):
+                        add_work(key, "group")
+                    else:
+                        data = read_hsds_dataset(obj, max_request_size)
+                        staging.put(("dataset", key, data, get_dataset_parameters(obj),
+                            dict(obj.attrs.items())), data.nbytes)
+            except Exception as e:
+                RealtimeLogger.info(f"Failed to read {key}: {e}")
+                staging.put(("failed", key))
+            finally:
+                with work_lock:
+                    pending_work[0] -= 1
+
+    #Writer state, only used by this thread
+    parents = {}
+    remaining = {}
+    links = []
+    written = []
+    failed = []
+    stats = {"items": 0, "bytes": 0}
+
+    def complete(key):
+        #Item and all of its children are in the file
+        written.append(key)
+        stats["items"] += 1
+        parent = parents.pop(key, None)
+        if parent is not None:
+            remaining[parent] -= 1
+            if remaining[parent] == 0:
+                del remaining[parent]
+                complete(parent)
+
+    start_time = last_checkpoint = last_progress = time.time()
+
+    def report(force=False):
+        nonlocal last_checkpoint, last_progress
+        now = time.time()
+        if force or now-last_checkpoint > checkpoint_interval:
+            f.flush()
+            for key in written:
+                checkpoint.add(key)
+            written.clear()
+            last_checkpoint = now
+        if force or now-last_progress > progress_interval:
+            elapsed = now-start_time
+            RealtimeLogger.info(f"Saved {stats['items']} items ({stats['bytes']/1024**2:.1f}MB) from {hsds_path} "
+                f"in {elapsed:.0f}s ({stats['bytes']/1024**2/max(elapsed, 1e-6):.1f}MB/s), "
+                f"{staging.size/1024**2:.1f}MB staged")
+            last_progress = now
+
     if prefix.startswith('/'):
         prefix = prefix[1:]
-
-    add_keys = []
-    hard_linked_keys = []
-    with h5pyd.File(hsds_file, "r", use_cache=False, retries=100) as store, h5py.File(h5_file, 'a') as f:
-        for key in f[f'/{prefix}'].keys():
-            full_key = f"/{prefix}/{key}"
-            if hardlink_items:
-                #Convert to softlink
-                old_kwd, new_kwd = next(hard_link_map.items())
-                store[full_key] = h5py.SoftLink(f"{prefix.split(old_kwd, 1)[0]}/{new_kwd}/{key}")
-
-                for old_kwd, new_kwd in hard_link_map.items():
-                    if old_kwd in full_key:
-                        f[full_key] = h5py.HardLink(f"{prefix.split(old_kwd, 1)[0]}/{new_kwd}/{key}")
-                        RealtimeLogger.info(f"Hardlinked {full_key}")
+    root = f"/{prefix}"
+
+    with h5py.File(h5_file, "a") as f, hsds_file(hsds_path, mode="r") as store:
+        if root not in saved:
+            add_work(root, "object")
+
+        readers = [threading.Thread(target=read, args=(store,), daemon=True) for _ in range(max(1, workers))]
+        for reader in readers:
+            reader.start()
+
+        def drain():
+            #Write everything the readers stage until they run out of work
+            while True:
+                item = staging.get()
+                if item is None:
+                    with work_lock:
+                        finished = pending_work[0] == 0 and len(staging.items) == 0
+                    if finished:
                         break
-                else:
-                    raise RuntimeError(f"hard_link_map keys ('{list(old_kwd.keys())}')")
-
-                continue
-                
-            hsds_object = store[full_key]
-
-            if isinstance(hsds_object, h5pyd.Group):
-                h5_object = f.require_group(full_key)
-                for attr, attr_value in hsds_object.attrs.items():
-                    h5_object.attrs[attr] = attr_value
-
-                if key not in hard_link_keys:
-                    add_keys.append(full_key)
-                else:
-                    hard_linked_keys.append(full_key)
-
-            elif isinstance(h5_object, h5py.Dataset):
-                dset = hsds_object[:]
-                dset_parameters = {k:getattr(h5_object, k) for k in ('shape', 'dtype', 'chunks', 'compression',
-                  'compression_opts', 'scaleoffset', 'shuffle', 'fletcher32', 'fillvalue')}
-                f.create_dataset(full_key, data=dset, **dset_parameters)
-    
-    for key in add_keys:
-        save_h5(hsds_file, h5_file, prefix=f"{prefix}/{key}",
-                hard_link_keys=hard_link_keys, hard_link_map=hard_link_map, hardlink_items=False)
-    
-    #Add hard links last
-    for hard_linked_key in hard_linked_keys:
-        save_h5(hsds_file, h5_file, prefix=f"{prefix}/{hard_linked_key}",      
-                hard_link_keys=hard_link_keys, hard_link_map=hard_link_map, hardlink_items=True)
+                    report()
+                    continue
+
+                kind, key = item[:2]
+                try:
+                    if kind == "group":
+                        _, key, attrs, children = item
+                        group = f.require_group(key)
+                        for attr, attr_value in attrs.items():
+                            group.attrs[attr] = attr_value
+                        for child, child_kind, target in children:
+                            parents[child] = key
+                            if child_kind == "link":
+                                links.append((child, target))
+                        if len(children) == 0:
+                            complete(key)
+                        else:
+                            remaining[key] = len(children)
+                    elif kind == "dataset":
+                        _, key, data, dset_parameters, attrs = item
+                        if key in f:
+                            #Partially written before the last checkpoint
+                            del f[key]
+                        dset = f.create_dataset(key, data=data, **dset_parameters)
+                        for attr, attr_value in attrs.items():
+                            dset.attrs[attr] = attr_value
+                        stats["bytes"] += data.nbytes
+                        complete(key)
+                    elif kind == "failed":
+                        failed.append(key)
+                except Exception as e:
+                    RealtimeLogger.info(f"Failed to write {key}: {e}")
+                    failed.append(key)
+
+                report()
+
+        drain()
+
+        while True:
+            #Groups that only looked like links (e.g. data_splits/{level}) or whose
+            #target is outside of the prefix are saved as normal groups
+            missing = [(key, target) for key, target in links if target not in f]
+            if len(missing) == 0:
+                break
+            links = [(key, target) for key, target in links if target in f]
+            for key, _ in missing:
+                add_work(key, "object")
+            drain()
+
+        for _ in readers:
+            work.put((None, None))
+
+        #Links last, once their targets are saved
+        for key, target in links:
+            try:
+                if key in f:
+                    del f[key]
+                f[key] = f[target]
+                complete(key)
+            except Exception as e:
+                RealtimeLogger.info(f"Unable to hardlink {key} to {target}: {e}")
+                failed.append(key)
+
+        report(force=True)
+
+    elapsed = time.time()-start_time
+    if len(failed) > 0:
+        RealtimeLogger.info(f"Failed to save {len(failed)} items, run again to retry: {failed[:10]}")
+
+    return {"items": stats["items"], "bytes": stats["bytes"], "seconds": elapsed, "failed": failed}
 
 if __name__ == "__main__":
     parser = Job.Runner.getDefaultArgumentParser()
     action = parser.add_mutually_exclusive_group(required=True)
     action.add_argument("--load", action="store_true", default=False)
     action.add_argument("--save", action="store_true", default=False)
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Approximate number of bytes uploaded by each job")
+    parser.add_argument("--workers", type=int, default=8,
+        help="Concurrent uploads in each job (--load) or concurrent readers (--save)")
+    parser.add_argument("--manifest", default=None,
+        help="File listing loaded or saved items, used to resume. Default: next to the h5 file")
+    parser.add_argument("--staging_size", type=int, default=DEFAULT_STAGING_SIZE,
+        help="Maximum bytes read from HSDS but not yet written (--save)")
     parser.add_argument("infile")
     parser.add_argument("outfile")
     options = parser.parse_args()
 
     if options.save:
-        save_h5(options.infile, options.outfile)
+        save_h5(options.infile, options.outfile, workers=options.workers,
+            staging_size=options.staging_size, manifest=options.manifest)
     else:
         with Toil(options) as workflow:
             if not workflow.options.restart:
                 #inputH5FileID = workflow.importFile(f"file://{str(Path(options.infile).absolute())}")
-                job = Job.wrapJobFn(load_h5, str(Path(options.infile).absolute()), options.outfile)
+                job = Job.wrapJobFn(load_h5, str(Path(options.infile).absolute()), options.outfile,
+                    batch_size=options.batch_size, workers=options.workers, manifest=options.manifest)
                 workflow.start(job)
             else:
                 workflow.restart()
\ No newline at end of file
@@ -5,7 +5,6 @@ from typing import Union, Any, Optional
 from argparse import Namespace
 from collections import defaultdict
 
-import h5pyd
 import pandas as pd
 from toil.job import Job
 from toil.fileStores import FileID
@@ -13,13 +12,19 @@ from toil.realtimeLogger import RealtimeLogger
 
 from Prop3D.util import safe_remove, str2boolorlist
 from Prop3D.util.iostore import IOStore
+from Prop3D.util.hsds import hsds_file, call_h5
+from Prop3D.util.local_h5 import is_local_h5, start_local_h5_writer, stop_local_h5_writer
 from Prop3D.util.cath import run_cath_hierarchy, run_cath_hierarchy_h5
 from Prop3D.util.hdf import get_file, filter_hdf_chunks
-from Prop3D.util.toil import map_job, map_job_follow_ons
+from Prop3D.util.toil import map_job, map_job_follow_ons, partitions
 from Prop3D.util.pdb import get_atom_lines
+from Prop3D.util.electrostatics import electrostatics_methods
 
 from Prop3D.generate_data.prepare_protein import process_domain
 from Prop3D.generate_data.calculate_features_hsds import calculate_features as calculate_features_hsds
+from Prop3D.generate_data.calculate_features_hsds import calculate_features_batch, get_featurized_domains
+from Prop3D.generate_data.domain_manifest import (init_domain_manifest, mark_domains_complete,
+    get_stage, is_stage_complete)
 from Prop3D.generate_data.set_cath_h5_toil import create_h5_hierarchy
 
 from Prop3D.generate_data.data_stores import data_stores
@@ -35,7 +40,8 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 def get_domain_structure_and_features(job: Job, cath_domain: str, superfamily: Union[str, None], cathFileStoreID: Union[str, FileID], 
                                       update_features: Union[list[str],tuple[str]] = None, further_parallelize: bool = False, 
                                       force: Union[int,bool] = False, use_hsds: bool = True, prepare_structure: bool = True,
-                                      work_dir: Optional[str] = None) -> None:
+                                      work_dir: Optional[str] = None, check_existing: bool = True,
+                                      electrostatics_method: str = "apbs") -> None:
     """Process and 'prepare' a single domain and calculate its features
     
     Parameters
@@ -55,7 +61,12 @@ def get_domain_structure_and_features(job: Job, cath_domain: str, superfamily: U
     force : int or bool
         If True, clean all structures if already preocess. Default is False
     use_hsds: bool
-        Use HSDS, deprecating, alwasy sues hsds.
+        Use HSDS. If False, cathFileStoreID must be a local h5 file (see Prop3D.util.local_h5)
+    check_existing : bool
+        Check if the features were already saved. Set to False if the domain manifest
+        already showed they are not (see Prop3D.generate_data.domain_manifest)
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). Default is apbs
     """
     RealtimeLogger.info("get_domain_structure_and_features Process domain "+cath_domain)
 
@@ -67,9 +78,12 @@ def get_domain_structure_and_features(job: Job, cath_domain: str, superfamily: U
     else:
         work_dir_tmp = work_dir
 
-    if not use_hsds:
-        raise RuntimeError("You must use HSDS")
-    
+    if not use_hsds and not is_local_h5(cathFileStoreID):
+        raise RuntimeError("You must use HSDS or a local h5 file")
+
+    #Local h5 files have the same layout as HSDS domains
+    use_hsds = True
+
     calc_features_func = calculate_features_hsds
 
     if superfamily is not None:
@@ -107,18 +121,22 @@ def get_domain_structure_and_features(job: Job, cath_domain: str, superfamily: U
         feat_files = ["{}/{}_{}".format(superfamily, cath_domain, ext) for ext in \
             ('atom.h5', 'residue.h5', 'edges.h5')]
         feats_exist = all([data_stores(job).cath_features.exists(f) for f in feat_files])
-    elif not force and use_hsds:
-        with h5pyd.File(cathFileStoreID, mode="r", use_cache=False, retries=100) as store:
+    elif not force and use_hsds and check_existing:
+        with hsds_file(cathFileStoreID, mode="r") as store:
             try:
                 sfam = "" if local_file else superfamily
                 feat_files = list(store[f"{sfam}/domains/{cath_domain}"].keys())
-                if len(feat_files) == 3 and "atom" in feat_files and \
-                  "residue" in feat_files and feat_files and "edges":
+                if {"atom", "residue", "edges"}.issubset(feat_files):
+                    #Extra keys may be companion tables from feature updates
                     feats_exist = True
                 else:
                     feats_exist = False
             except KeyError:
                 feats_exist = False
+
+        if feats_exist and update_features is None:
+            #Saved before the manifest existed, so it is not checked again
+            call_h5(cathFileStoreID, mark_domains_complete, [(h5_key, get_stage(), None)])
     else:
         feats_exist = False
 
@@ -134,12 +152,14 @@ def get_domain_structure_and_features(job: Job, cath_domain: str, superfamily: U
         #Calculate features Processed domain file
         if further_parallelize:
             job.addFollowOnJobFn(calc_features_func, cathFileStoreID, cath_domain,
-                superfamily, update_features=update_features, domain_file=local_domain_file, work_dir=work_dir)
+                superfamily, update_features=update_features, domain_file=local_domain_file, work_dir=work_dir,
+                electrostatics_method=electrostatics_method)
         else:
             RealtimeLogger.info("get_domain_structure_and_features calculate_features")
             try:
                 calc_features_func(job, cathFileStoreID, cath_domain, superfamily,
-                    update_features=update_features, domain_file=local_domain_file, work_dir=work_dir_tmp)
+                    update_features=update_features, domain_file=local_domain_file, work_dir=work_dir_tmp,
+                    electrostatics_method=electrostatics_method)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except:
@@ -153,9 +173,99 @@ def get_domain_structure_and_features(job: Job, cath_domain: str, superfamily: U
             f"updates/{jobStoreName}/{superfamily}/{cath_domain}")
         safe_remove(done_file)
 
+def get_domain_structures_and_features_batch(job: Job, cath_domains: list[str], superfamily: str, cathFileStoreID: Union[str, FileID], 
+                                             update_features: Union[list[str],tuple[str]] = None, force: Union[int,bool] = False, 
+                                             work_dir: Optional[str] = None, check_existing: bool = True,
+                                             electrostatics_method: str = "apbs") -> None:
+    """Process and 'prepare' a batch of domains from the same superfamily and calculate their features
+    in one worker (see calculate_features_batch). Domains that fail are skipped without stopping the batch.
+    
+    Parameters
+    ----------
+    job : toil.Job
+        the toil job that is currently running
+    cath_domains : list of str
+        The names of the cath_domains
+    superfamily : str
+        The name of the superfamily the domains belongs to
+    cathFileStoreID : str or FileID
+        Path to the h5 file to update
+    update_features : list of str
+        List of features to update
+    force : int or bool
+        If True, clean all structures if already preocess. Default is False
+    check_existing : bool
+        Check if the features were already saved. Set to False if the domain manifest
+        already showed they are not (see Prop3D.generate_data.domain_manifest)
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). Default is apbs
+    """
+    RealtimeLogger.info(f"get_domain_structures_and_features_batch Process {len(cath_domains)} domains from {superfamily}")
+
+    if work_dir is None:
+        if job is not None and hasattr(job, "fileStore"):
+            work_dir_tmp = job.fileStore.getLocalTempDir()
+        else:
+            work_dir_tmp = os.getcwd()
+    else:
+        work_dir_tmp = work_dir
+
+    processed_domains = []
+    for cath_domain in cath_domains:
+        key = "{}/{}.pdb".format(superfamily, cath_domain)
+        try:
+            if force or not data_stores(job).prepared_cath_structures.exists(key) or \
+              data_stores(job).prepared_cath_structures.get_size(key)==0:
+                process_domain(job, cath_domain, superfamily, cathFileStoreID=cathFileStoreID, work_dir=work_dir_tmp)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            #Failed, do not proceed in calculating features
+            import traceback as tb
+            RealtimeLogger.info(f"Failed processing domain {cath_domain}: {tb.format_exc()}")
+            continue
+        processed_domains.append(cath_domain)
+
+    #Read after processing so the file is not held open while the domains are prepared,
+    #local files cannot be written while they are open for reading
+    featurized = set()
+    if check_existing and not force and len(processed_domains) > 0:
+        featurized = call_h5(cathFileStoreID, get_featurized_domains, superfamily, processed_domains, mode="r")
+
+    domains_to_featurize = []
+    already_done = []
+    for cath_domain in processed_domains:
+        if force or update_features is not None or cath_domain not in featurized:
+            domains_to_featurize.append(cath_domain)
+        else:
+            already_done.append((f"/{superfamily}/domains/{cath_domain}", get_stage(), None))
+
+    if len(already_done) > 0:
+        #Saved before the manifest existed, so they are not checked again
+        call_h5(cathFileStoreID, mark_domains_complete, already_done)
+
+    if update_features is not None:
+        jobStoreName = os.path.basename(job.fileStore.jobStore.config.jobStore.split(":")[-1])
+
+        def on_written(cath_domain, error):
+            #Mark each domain as soon as its tables are saved
+            if error is not None:
+                return
+            done_file = job.fileStore.getLocalTempFile()
+            data_stores(job).data_eppic_cath_features.write_output_file(done_file,
+                f"updates/{jobStoreName}/{superfamily}/{cath_domain}")
+            safe_remove(done_file)
+    else:
+        on_written = None
+
+    calculate_features_batch(job, cathFileStoreID, domains_to_featurize, superfamily,
+        update_features=update_features, work_dir=work_dir_tmp, on_written=on_written,
+        electrostatics_method=electrostatics_method)
+
 def process_superfamily(job: Job, superfamily: Union[str, None], cathFileStoreID: Union[str, FileID], 
                         update_features: Union[list[str], tuple[str]] = None, force: bool = False, 
-                        use_hsds: bool = True, further_parallize: bool = True, work_dir: Optional[str] = None) -> None:
+                        use_hsds: bool = True, further_parallize: bool = True, work_dir: Optional[str] = None,
+                        batch_size: int = 1, electrostatics_method: str = "apbs") -> None:
     """Process all domains in superfamily
 
     Parameters
@@ -174,8 +284,16 @@ def process_superfamily(job: Job, superfamily: Union[str, None], cathFileStoreID
         Use HSDS, deprecating, alwasy sues hsds.
     further_parallelize : bool
         Create new toil jobs for each step (clean, featurize). Default False
+    batch_size : int
+        Number of domains to process in each job. Default is 1, one job per domain.
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). Default is apbs
     """
     cathcode = superfamily.replace("/", ".")
+
+    #Local h5 files have the same layout as HSDS domains
+    use_hsds = use_hsds or is_local_h5(cathFileStoreID)
+
     if not use_hsds:
         cath_file = job.fileStore.readGlobalFile(cathFileStoreID, cache=True)
         cath_domains = filter_hdf_chunks(
@@ -185,29 +303,28 @@ def process_superfamily(job: Job, superfamily: Union[str, None], cathFileStoreID
             drop_duplicates=True,
             cathcode=cathcode)["cath_domain"].tolist()
     else:
-        with h5pyd.File(cathFileStoreID, mode="a", use_cache=False) as store:
+        with hsds_file(cathFileStoreID, mode="r") as store:
             cath_domains = list(store[f"{superfamily}/domains"].keys())
         cath_domains = cath_domains
 
-    if not force and update_features is None:
-        if use_hsds:
-            try:
-                RealtimeLogger.info("Finding completed domains...")
-                # with h5pyd.File(cathFileStoreID, mode="a", use_cache=False, retries=100) as store:
-                #     processed_domains = defaultdict(int)
-                #     def count_feature_types(name):
-                #         if name.count("/") == 6:
-                #             #Name looks like 1/2/3/4/domains/xx/atom
-                #             domain = name.split("/")[-2]
-                #             processed_domains[domain] += 1
-                #     store[superfamily].visit(count_feature_types)
-                #     done_domains = [domain for domain, count in processed_domains.items() if count==3]
-                done_domains = []
-            except KeyError as e:
-                raise RuntimeError(f"Must create hsds file first. Key not found {e}")
-        else:
-            assert 0
-        cath_domains = list(set(cath_domains)-set(done_domains))
+    check_existing = True
+    if not force and use_hsds:
+        try:
+            RealtimeLogger.info("Finding completed domains...")
+            #One read instead of listing every domain, see Prop3D.generate_data.domain_manifest
+            created, completed = call_h5(cathFileStoreID, init_domain_manifest, superfamily, cath_domains)
+        except KeyError as e:
+            raise RuntimeError(f"Must create hsds file first. Key not found {e}")
+
+        stage = get_stage(update_features)
+        done_domains = [domain for domain, (done_stage, _, _) in completed.items() \
+            if is_stage_complete(done_stage, stage)]
+        n_domains = len(cath_domains)
+        cath_domains = sorted(set(cath_domains)-set(done_domains))
+        RealtimeLogger.info(f"Running {len(cath_domains)}/{n_domains} domains from {cathcode} ({stage})")
+
+        #Domains finished before the manifest existed still need to be checked once
+        check_existing = created
 
     if False and not force and update_features is None:
         #Get domians that have edge features uploaded (last feature file to be uploaded so we know its done)
@@ -229,10 +346,16 @@ def process_superfamily(job: Job, superfamily: Union[str, None], cathFileStoreID
     else:
         RealtimeLogger.info("Running {} domains from {}".format(len(cath_domains), cathcode))
 
-    if further_parallize:
+    if further_parallize and batch_size > 1:
+        #Sorted so domains cut from the same chain end up in the same batch and share tool results
+        map_job(job, get_domain_structures_and_features_batch, list(partitions(sorted(cath_domains), batch_size)),
+            superfamily, cathFileStoreID, update_features=update_features, force=force,
+            check_existing=check_existing, electrostatics_method=electrostatics_method)
+    elif further_parallize:
         map_job(job, get_domain_structure_and_features, cath_domains,
             superfamily, cathFileStoreID, update_features=update_features,
-            further_parallelize=False, use_hsds=use_hsds, force=force)
+            further_parallelize=False, use_hsds=use_hsds, force=force, check_existing=check_existing,
+            electrostatics_method=electrostatics_method)
     else:
         RealtimeLogger.info("Looping over domain")
         for domain in cath_domains:
@@ -240,7 +363,8 @@ def process_superfamily(job: Job, superfamily: Union[str, None], cathFileStoreID
                 RealtimeLogger.info("Processing domain "+domain)
                 get_domain_structure_and_features(job, domain, superfamily,
                     cathFileStoreID, update_features=update_features,
-                    further_parallelize=False, use_hsds=use_hsds, force=force)
+                    further_parallelize=False, use_hsds=use_hsds, force=force,
+                    check_existing=check_existing, electrostatics_method=electrostatics_method)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except:
@@ -249,7 +373,8 @@ def process_superfamily(job: Job, superfamily: Union[str, None], cathFileStoreID
 def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cathcode: Union[list[str], str] = None, 
                               skip_cathcode: Union[list[str], str, None] = None, update_features: Union[list[str], tuple[str], None] = None, 
                               use_hsds: bool = True, work_dir: Union[str, None] = None, pdbs: Union[str,list[str], bool, None] = None, 
-                              force: bool = False, update: bool = False) -> None:
+                              force: bool = False, update: bool = False, batch_size: int = 1,
+                              electrostatics_method: str = "apbs") -> None:
     """Start a new job to follow the CATH hierarchy ending at the superfamily level 
 
     Parameters
@@ -274,7 +399,14 @@ def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cat
         If True, clean all structures if already preocess. Default is False
     update : bool
         Add new entries from source database (CATH or PDB) since last update. Default is False.
+    batch_size : int
+        Number of domains to featurize in each job. Default is 1, one job per domain.
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). Default is apbs
     """
+    #Local h5 files have the same layout as HSDS domains
+    use_hsds = use_hsds or is_local_h5(cathFileStoreID)
+
     if not use_hsds:
         cath_hierarchy_runner = run_cath_hierarchy
     else:
@@ -307,7 +439,7 @@ def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cat
                         if domain.endswith("edges.txt.gz")]
 
             else:
-                with h5pyd.File(cathFileStoreID, mode="r", use_cache=False) as store:
+                with hsds_file(cathFileStoreID, mode="r") as store:
                     try:
                         cath_domains = pd.DataFrame([(cath_domain, sfam) for sfam in fixed_sfams \
                             for cath_domain in store[f"{sfam}/domains"].keys()], columns=["cath_domain", "cathcode"])
@@ -321,7 +453,7 @@ def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cat
         else:
             #No update and forced
             RealtimeLogger.info(f"Counting # of domains from {fixed_sfams}")
-            with h5pyd.File(cathFileStoreID, mode="a", use_cache=False) as store:
+            with hsds_file(cathFileStoreID, mode="r") as store:
                 try:
                     cath_domains = sum(1 for sfam in fixed_sfams for cath_domain in \
                         store[f"{sfam}/domains"].keys())
@@ -329,10 +461,11 @@ def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cat
                     raise RuntiemError("Must create hsds file first")
     elif pdbs is not None:
         assert use_hsds
-        with h5pyd.File(cathFileStoreID, mode="r", use_cache=False) as store:
+        with hsds_file(cathFileStoreID, mode="r") as store:
             all_domains = list(store["domains"].keys()) 
             try:
-                done_domains = [k for k in all_domains if len(store[f"domains/{k}"].keys())==3]
+                done_domains = [k for k in all_domains if \
+                    {"atom", "residue", "edges"}.issubset(store[f"domains/{k}"].keys())]
             except KeyError:
                 raise RuntimeError(f"Must create hsds file first.")
             
@@ -360,7 +493,7 @@ def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cat
         RealtimeLogger.info(f"Running domains: {domains_to_run}")
         map_job(job, get_domain_structure_and_features, domains_to_run, None, cathFileStoreID,
             update_features=update_features, force=force, further_parallelize=True, use_hsds=use_hsds,
-            work_dir=work_dir)
+            work_dir=work_dir, electrostatics_method=electrostatics_method)
         return
     else:
         #No cath code proved, use all
@@ -387,19 +520,21 @@ def start_domain_and_features(job: Job, cathFileStoreID: Union[str, FileID], cat
         RealtimeLogger.info("Starting CATH Hierachy")
         cath_hierarchy_runner(job, cathcode, process_superfamily, cathFileStoreID,
             skip_cathcode=skip_cathcode, update_features=update_features, use_hsds=use_hsds, force=force,
-            work_dir=work_dir)
+            work_dir=work_dir, batch_size=batch_size, electrostatics_method=electrostatics_method)
     else:
         superfamilies = domains_to_run["cathcode"].drop_duplicates().str.replace(".", "/")
         if skip_cathcode is not None and len(skip_cathcode) > 0:
             superfamilies = superfamilies[~superfamilies.isin(skip_cathcode)]
         RealtimeLogger.info("Superfamilies to run: {}".format(len(superfamilies)))
         map_job(job, process_superfamily, superfamilies, cathFileStoreID,
-            update_features=update_features, force=force, work_dir=work_dir)
+            update_features=update_features, force=force, work_dir=work_dir, batch_size=batch_size,
+            electrostatics_method=electrostatics_method)
 
 def start_domain_and_features_then_create_splits(job: Job, cathFileStoreID: Union[str, FileID], cathcode: Union[list[str], str] = None, 
                                                  skip_cathcode: Union[list[str], str, None] = None, update_features: Union[list[str], tuple[str], None] = None, 
                                                  use_hsds: bool = True, work_dir: Union[str, None] = None, pdbs:Union[str,list[str], bool, None] = None, 
-                                                 force: bool = False, update: bool = False) -> None:
+                                                 force: bool = False, update: bool = False, batch_size: int = 1,
+                                                 electrostatics_method: str = "apbs") -> None:
     """Start a new job to follow the cath hierchy to prepare and featurize proteins then create data splits. Useful for adding in PDB ids becuase there are too many.
 
     Parameters
@@ -424,10 +559,15 @@ def start_domain_and_features_then_create_splits(job: Job, cathFileStoreID: Unio
         If True, clean all structures if already preocess. Default is False
     update : bool
         Add new entries from source database (CATH or PDB) since last update. Default is False.
+    batch_size : int
+        Number of domains to featurize in each job. Default is 1, one job per domain.
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). Default is apbs
     """
     job.addChildJobFn(start_domain_and_features, cathFileStoreID, cathcode=cathcode,
         skip_cathcode=skip_cathcode, update_features=update_features, use_hsds=use_hsds,
-        pdbs=pdbs, force=force, work_dir=work_dir)
+        pdbs=pdbs, force=force, work_dir=work_dir, batch_size=batch_size,
+        electrostatics_method=electrostatics_method)
     
     if (isinstance(pdbs, bool) and pdbs):
         #Use entire PDB database
@@ -442,7 +582,8 @@ def start_domain_and_features_then_create_splits(job: Job, cathFileStoreID: Unio
 def start_toil(job: Job, cathFileStoreID: Union[str, FileID], cathcode: Union[list[str], str] = None, 
                skip_cathcode: Union[list[str], str, None] = None, pdbs:Union[str, list[str], bool, None] = None, 
                update_features: Union[list[str], tuple[str], None] = None, use_hsds: bool = True, work_dir: Union[str, None] = None, 
-               force: bool = False, update: bool = False) -> None:
+               force: bool = False, update: bool = False, batch_size: int = 1,
+               electrostatics_method: str = "apbs") -> None:
     """A new job that starts the entire Prop3D workflow
 
     Parameters
@@ -467,6 +608,10 @@ def start_toil(job: Job, cathFileStoreID: Union[str, FileID], cathcode: Union[li
         If True, clean all structures if already preocess. Default is False
     update : bool
         Add new entries from source database (CATH or PDB) since last update. Default is False.
+    batch_size : int
+        Number of domains to featurize in each job. Default is 1, one job per domain.
+    electrostatics_method : "apbs", "coulomb", or "debye_huckel"
+        How to calculate electrostatic potentials (see ProteinFeaturizer). Default is apbs
     """
     # if work_dir is None:
     #     if job is not None and hasattr(job, "fileStore"):
@@ -479,9 +624,15 @@ def start_toil(job: Job, cathFileStoreID: Union[str, FileID], cathcode: Union[li
     if pdbs is not None and (cathcode is not None or skip_cathcode is not None):
         raise RuntimeError("Cannot use --pdbs with --cathcode or --skip_cathcode")
 
-    if not use_hsds:
-        raise RuntimeError("You must use HSDS")
-    
+    if not use_hsds and not is_local_h5(cathFileStoreID):
+        raise RuntimeError("You must use HSDS or a local h5 file")
+
+    if is_local_h5(cathFileStoreID) and uses_pdb_ids(pdbs):
+        raise RuntimeError("PDB IDs can only be used with HSDS, not a local h5 file. Use --pdb with files instead")
+
+    #Local h5 files have the same layout as HSDS domains
+    use_hsds = True
+
     hierarchy_job = job.addChildJobFn(create_h5_hierarchy, cathFileStoreID, cathcode=cathcode,
         skip_cathcode=skip_cathcode, pdbs=pdbs, work_dir=work_dir, force=force)
 
@@ -512,8 +663,17 @@ def start_toil(job: Job, cathFileStoreID: Union[str, FileID], cathcode: Union[li
         
     job.addFollowOnJobFn(next_job, cathFileStoreID, cathcode=cathcode,
         skip_cathcode=skip_cathcode, update_features=update_features, use_hsds=use_hsds,
-        pdbs=pdbs, force=force, update=update)
+        pdbs=pdbs, force=force, update=update, batch_size=batch_size,
+        electrostatics_method=electrostatics_method)
     
+def uses_pdb_ids(pdbs: Union[str, list[str], bool, None]) -> bool:
+    """Check if pdbs are PDB IDs or the entire PDB (see Prop3D.generate_data.update_pdb)
+    instead of structure files"""
+    if isinstance(pdbs, bool):
+        return pdbs
+    return isinstance(pdbs, (list, tuple)) and len(pdbs) > 0 and isinstance(pdbs[0], str) and \
+        len(pdbs[0]) < 9 and not Path(pdbs[0]).is_file()
+
 def str2boolorval(v: Any) -> Union[bool,int]:
     """Convert argparse parameter to either a bool or an an int e.g. 'false' -> False, '0'->0
     """
@@ -543,18 +703,32 @@ def start_workflow(options: Namespace) -> None:
     options: argparse.Namespace
         All parsed arguments
     """
-    with Toil(options) as workflow:
-        if not workflow.options.restart:
-            if options.no_hsds:
-                cathFileStoreID = workflow.importFile("file://" + os.path.abspath(sfam_file))
+    writer = None
+    if options.local_h5 is not None:
+        #Workers send all writes to one process that owns the file
+        local_h5 = "file://" + os.path.abspath(options.local_h5)
+        writer = start_local_h5_writer(local_h5)
+
+    try:
+        with Toil(options) as workflow:
+            if not workflow.options.restart:
+                if options.local_h5 is not None:
+                    cathFileStoreID = local_h5
+                elif options.no_hsds:
+                    cathFileStoreID = workflow.importFile("file://" + os.path.abspath(sfam_file))
+                else:
+                    cathFileStoreID = options.hsds_file
+                job = Job.wrapJobFn(start_toil, cathFileStoreID, cathcode=options.cathcode,
+                    skip_cathcode=options.skip_cathcode, pdbs=options.pdb, update_features=options.features,
+                    use_hsds=not options.no_hsds and options.local_h5 is None, work_dir=options.work_dir,
+                    force=options.force, update=options.update, batch_size=options.batch_size,
+                    electrostatics_method=options.electrostatics_method)
+                workflow.start(job)
             else:
-                cathFileStoreID = options.hsds_file
-            job = Job.wrapJobFn(start_toil, cathFileStoreID, cathcode=options.cathcode,
-                skip_cathcode=options.skip_cathcode, pdbs=options.pdb, update_features=options.features,
-                use_hsds=not options.no_hsds, work_dir=options.work_dir, force=options.force, update=options.update)
-            workflow.start(job)
-        else:
-            workflow.restart()
+                workflow.restart()
+    finally:
+        if writer is not None:
+            stop_local_h5_writer(writer, local_h5)
 
 if __name__ == "__main__":
     from toil.common import Toil
@@ -596,6 +770,16 @@ if __name__ == "__main__":
         const=True,
         default=False,
         help="Which files should be overwrriten. (0, False)=No files overwritten; (1, True)=Only Features, 2=Structure and Features, 3=Entire database. Default is False.")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Number of domains to prepare and featurize in each job, sharing one worker. Default is 1.")
+    parser.add_argument(
+        "--electrostatics_method",
+        choices=electrostatics_methods,
+        default="apbs",
+        help="How to calculate electrostatic potentials: apbs (Poisson-Boltzmann), or the faster coulomb or debye_huckel approximations for screening. Default is apbs.")
     parser.add_argument(
         "--hsds_file",
         default=None,
@@ -604,6 +788,10 @@ if __name__ == "__main__":
         "--no_hsds",
         action="store_true",
         default=False)
+    parser.add_argument(
+        "--local_h5",
+        default=None,
+        help="Path to a local h5 file to use instead of HSDS, for single node runs")
     parser.add_argument(
         "--work_dir",
         default=None)
@@ -651,7 +839,11 @@ if __name__ == "__main__":
             else:
                 raise RuntimeError("Invalid option for --pdb. Must be paths to pdbs files as arguments, a single file with path on each line, or a directory with pdb files")
 
-    if options.no_hsds:
+    if options.local_h5 is not None:
+        #No HSDS server needed
+        if uses_pdb_ids(options.pdb):
+            raise RuntimeError("Cannot use --local_h5 with PDB IDs, use paths to pdb files with --pdb")
+    elif options.no_hsds:
         sfam_file = os.path.abspath("cath.h5")
         if not os.path.isfile(sfam_file):
             store = IOStore.get("aws:us-east-1:Prop3D-cath")
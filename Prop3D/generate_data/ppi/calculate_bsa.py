@@ -16,13 +16,13 @@ import numpy as np
 # import dask.dataframe as dd
 from joblib import Parallel, delayed
 
-import freesasa
-
-from Bio.PDB import PDBList
+from Bio.PDB import PDBList, PDBParser
 
 from molmimc.util import data_path_prefix, get_interfaces_path, iter_cdd, iter_unique_superfams
 from molmimc.generate_data.mmcif2pdb import mmcif2pdb
-from Prop3D.parsers.FreeSASA import run_freesasa
+from Prop3D.parsers.FreeSASA import run_freesasa, FreeSASAException
+from Prop3D.util.sasa import get_atom_arrays
+from Prop3D.util.sasa import calculate_buried_surface_area as shrake_rupley_bsa
 
 NUM_WORKERS = 20
 # dask.config.set(scheduler='multiprocessing', num_workers=NUM_WORKERS)
@@ -144,46 +144,63 @@ def get_pdb(pdb, chain1, chain2, sdi1, sdi2):
 #     except:
 #         raise FreeSASAException("Unable to freesasa convert to JSON: {}".format(freesasa))
 
+def _in_selection(residue, residues=None, ranges=None):
+    """Check if a Bio.PDB residue is in a face (list of residue numbers as str) or
+    in a list of sdi ranges ("from:to", to may be empty for the end of the chain)"""
+    resnum = "{}{}".format(residue.get_id()[1], residue.get_id()[2]).strip()
+    if residues is not None and resnum not in residues:
+        return False
+    if ranges is not None:
+        for sdi_range in ranges:
+            #Residue numbers can be negative, so only split on the separator
+            match = re.match(r"(-?\d+)[A-Za-z]?[-:](?:(-?\d+)[A-Za-z]?)?$", str(sdi_range).strip())
+            if match is None:
+                continue
+            start, stop = match.groups()
+            if int(start) <= residue.get_id()[1] and (stop is None or residue.get_id()[1] <= int(stop)):
+                break
+        else:
+            return False
+    return True
+
 def calculate_buried_surface_area(pdb_file, pdb, sdi_sel1=None, sdi_sel2=None, face1=None, face2=None, job=None):
     """Calculate the burried surface area (BSA) of a complex. Assumes the interacting
-    partners are in the same file in two separate chains, named "1" and "2" respectively.
+    partners are in the same file in two separate chains, named "M" and "I" respectively
+    (see get_pdb).
 
     BSA(12) = ASA(1)+ASA(2)-ASA(12)
 
-    where, 12 is the complex and 1 is the first monomer, 2 is the second monomer
+    where, 12 is the complex and 1 is the first monomer, 2 is the second monomer.
+    Areas are calculated in process in one pass with Prop3D.util.sasa.
 
     Paramters
     ---------
+    pdb_file : str
+        Path to pdb file with both partners
+    pdb : str
+        PDB code
+    sdi_sel1, sdi_sel2 : list of str or None
+        Domain ranges ("from:to") to use from each partner. If None, use the full chain
+    face1, face2 : str or None
+        Comma separated residue numbers of the binding site of each partner
+
     Returns
     -------
+    pd.Series with
     bsa : float
         the calculated burried surface area
     ppi_type,
     c1_asa,
     c2_asa,
-    complex_asa
+    complex_asa,
+    face1_asa,
+    face2_asa
     """
-    parameters = ["--chain-groups=12+1+2"]#["freesasa", "--format=json", "--chain-groups=12+1+2"]
-
-    if sdi_sel1 is not None and sdi_sel1 is not None:
-        command.append("--select='domain1, chain I and resi {}'".format("+".join(sdi_sel1).replace("-", "\-")))
-        command.append("--select='domain2, chain M and resi {}'".format("+".join(sdi_sel2).replace("-", "\-")))
-
-    if face1 is not None:
-        residues1 = face1.replace(",", "+").replace("-", "\-")
-        selection1 = "binding-site1, chain M and resi {}".format(residues1)
-        command.append("--select='{}'".format(selection1))
-
-    if face2 is not None:
-        residues2 = face2.replace(",", "+").replace("-", "\-")
-        selection2 = "binding-site2, chain I and resi {}".format(residues2)
-        command.append("--select='{}'".format(selection2))
-
-    #command.append(pdb_file)
-
     try:
-        freesasa = run_freesasa(pdb_file, parameters, job)
-    except FreeSASAException as e:
+        structure = PDBParser(QUIET=True).get_structure(pdb, pdb_file)
+        model = next(structure.get_models())
+        chain1, chain2 = model["M"], model["I"]
+    except (IOError, ValueError, KeyError, StopIteration) as e:
         print(e)
         return pd.Series({
             "c1_asa": np.nan,
@@ -195,42 +212,28 @@ def calculate_buried_surface_area(pdb_file, pdb, sdi_sel1=None, sdi_sel2=None, f
             "ppi_type": "unknown",
         })
 
+    atoms1, coords1, radii1 = get_atom_arrays([a for r in chain1 if _in_selection(r, ranges=sdi_sel1) for a in r])
+    atoms2, coords2, radii2 = get_atom_arrays([a for r in chain2 if _in_selection(r, ranges=sdi_sel2) for a in r])
+    sasa = shrake_rupley_bsa(coords1, radii1, coords2, radii2)
+
     result = {
-        "c1_asa": freesasa["results"][2]["structure"][0]["area"]["total"],
-        "c2_asa": freesasa["results"][3]["structure"][0]["area"]["total"],
-        "complex_asa": freesasa["results"][1]["structure"][0]["area"]["total"]
+        "c1_asa": sasa["c1_asa"],
+        "c2_asa": sasa["c2_asa"],
+        "complex_asa": sasa["complex_asa"],
+        "face1_asa": np.nan,
+        "face2_asa": np.nan,
+        "bsa": sasa["bsa"],
     }
 
-    if sdi_sel1 is not None and sdi_sel1 is not None:
-        try:
-            result["c1_asa"] = freesasa["results"][2]["structure"][0]["selections"][0]["area"]
-        except (IndexError, KeyError):
-            #Use full chain area, it is assumed the interacting domains are split out
-            pass
-
-        try:
-            result["c2_asa"] = freesasa["results"][3]["structure"][0]["selections"][0]["area"]
-        except (IndexError, KeyError):
-            #Use full chain area, it is assumed the interacting domains are split out
-            pass
-
-        _complex_asa = sum([sel["area"] for sel in freesasa["results"][1]["structure"][0]["selections"] \
-            if "domain" in sel["name"]])
-
-        if _complex_asa > 0.0:
-            result["complex_asa"] = _complex_asa
-        else:
-            print("Error, used total", complex_asa, freesasa["results"][1]["structure"][0]["selections"], command)
-
-    if face1 is not None:
-        face1_sel = {s["name"]:s["area"] for s in freesasa["results"][2]["structure"][0]["selections"]}
-        result["face1_asa"] = face1_sel["binding-site1"]
-
-    if face2 is not None:
-        face2_sel = {s["name"]:s["area"] for s in freesasa["results"][3]["structure"][0]["selections"]}
-        result["face2_asa"] = face2_sel["binding-site2"]
+    if face1 is not None and isinstance(face1, str):
+        residues1 = set(face1.split(","))
+        result["face1_asa"] = sum(asa for atom, asa in zip(atoms1, sasa["atom_c1_asa"]) \
+            if _in_selection(atom.get_parent(), residues=residues1))
 
-    result["bsa"] = result["c1_asa"]+result["c2_asa"]-result["complex_asa"]
+    if face2 is not None and isinstance(face2, str):
+        residues2 = set(face2.split(","))
+        result["face2_asa"] = sum(asa for atom, asa in zip(atoms2, sasa["atom_c2_asa"]) \
+            if _in_selection(atom.get_parent(), residues=residues2))
 
     for ppi_type, (low_cut, high_cut) in list(cutoffs.items()):
         if low_cut <= result["bsa"] < high_cut:
@@ -6,12 +6,17 @@ from prodigy.predict_IC import calculate_ic, Prodigy
 import Bio.PDB
 from Bio.PDB import Select
 import pandas as pd
-import freesasa
 import numpy as np
 
+try:
+    import freesasa
+except ImportError:
+    freesasa = None
+
 from Prop3D.parsers.superpose import Align
 from Prop3D.parsers.zrank import ZRank
 from Prop3D.util.pdb import read_pdb, replace_chains, extract_chains, rottrans, get_all_chains
+from Prop3D.util.sasa import get_atom_arrays, calculate_buried_surface_area
 
 from toil.realtimeLogger import RealtimeLogger
 
@@ -130,13 +135,34 @@ class Complex(Select):
     def set_prefix(self):
         return self.results.rename(lambda l: "{}_{}".format(self.method, l))
 
-    def BSA(self, param_f=None, atom=False):
+    def BSA(self, param_f=None, atom=False, engine=None):
+        """Calculate the burried surface area of the complex
+
+        Parameters
+        ----------
+        param_f : str or None
+            freesasa classifier file. Only used with freesasa
+        atom : bool
+            Return the BSA of each atom
+        engine : "freesasa", "shrake_rupley" or None
+            SASA implementation. "shrake_rupley" calculates the complex and both
+            chains in one pass in NumPy (Prop3D.util.sasa). If None, use freesasa
+            if it is installed, otherwise shrake_rupley.
+        """
         cutoffs = {
             "weak transient": (0, 1500),
             "transient": (1500, 2500),
             "permanent": (2500, float("inf"))
         }
 
+        if engine is None:
+            engine = "freesasa" if freesasa is not None and param_f is None else "shrake_rupley"
+
+        if engine == "shrake_rupley":
+            return self._BSA_shrake_rupley(cutoffs, atom=atom)
+        elif engine != "freesasa":
+            raise ValueError("Unknown SASA engine: {}".format(engine))
+
         try:
             # Run freesasa
             classifier = freesasa.Classifier(param_f)
@@ -200,6 +226,43 @@ class Complex(Select):
             "ppi_type": ppi_type,
         })
 
+    def _BSA_shrake_rupley(self, cutoffs, atom=False):
+        atoms1, coords1, radii1 = get_atom_arrays(self.s[0][self.chain1])
+        atoms2, coords2, radii2 = get_atom_arrays(self.s[0][self.chain2])
+        sasa = calculate_buried_surface_area(coords1, radii1, coords2, radii2)
+
+        if not atom:
+            complex_bsa = sasa["bsa"]
+            for ppi_type, (low_cut, high_cut) in list(cutoffs.items()):
+                if low_cut <= complex_bsa < high_cut:
+                    break
+            else:
+                ppi_type = "unknown"
+        else:
+            monomer_asa = np.concatenate((sasa["atom_c1_asa"], sasa["atom_c2_asa"]))
+            complex_bsa = {}
+            for a, complex_asa, at_monomer_asa in zip(atoms1+atoms2, sasa["atom_complex_asa"], monomer_asa):
+                residue = a.get_parent()
+                at_id = (residue.get_parent().id, residue.get_resname(), residue.id[1], a.get_id())
+                complex_bsa[at_id] = at_monomer_asa-complex_asa
+            ppi_type = None
+
+        def face_asa(face, atoms, atom_asa):
+            if not isinstance(face, (list, tuple)) or len(face) == 0:
+                return None
+            face = set(face)
+            return sum(asa for a, asa in zip(atoms, atom_asa) if a.get_parent().id[1] in face)
+
+        return pd.Series({
+            "c1_asa": sasa["c1_asa"],
+            "c2_asa": sasa["c2_asa"],
+            "complex_asa": sasa["complex_asa"],
+            "face1_asa": face_asa(self.face1, atoms1, sasa["atom_c1_asa"]),
+            "face2_asa": face_asa(self.face2, atoms2, sasa["atom_c2_asa"]),
+            "complex_bsa": complex_bsa,
+            "ppi_type": ppi_type,
+        })
+
     def radius_of_gyration(self):
         face1 = get_coords(list(self.neighbors[self.chain1].keys()))
         face2 = get_coords(list(self.neighbors[self.chain2].keys()))
@@ -11,6 +11,8 @@ from toil.fileStores import FileID
 from toil.realtimeLogger import RealtimeLogger
 
 from Prop3D.util.toil import map_job
+from Prop3D.util.hsds import hsds_file, call_h5
+from Prop3D.util.local_h5 import is_local_h5, local_path
 from Prop3D.generate_data.create_data_splits import split_dataset_at_level
 from Prop3D.generate_data.update_pdb import get_all_pdbs, get_custom_pdbs
 
@@ -66,7 +68,7 @@ def create_splits_for_superfamily_levels(job: Job, sfam: str, cath_full_h5: str)
     superfamily, sfam_df = sfam
     RealtimeLogger.info(f"Start splits for {superfamily}")
 
-    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+    with hsds_file(cath_full_h5, mode="a") as store:
         store.require_group(f"{superfamily}/data_splits")
 
     for level_key, level_name in [("S", "S35"), (list("SO"), "S60"), (list("SOL"), "S95"), (list("SOLI"), "S100")]:
@@ -94,7 +96,7 @@ def create_representatives_for_superfamily(job: Job, sfam: str, cath_full_h5: st
 
     missing_domains = []
 
-    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+    with hsds_file(cath_full_h5, mode="a") as store:
         group = store.require_group(key)
 
         for domain in representatives:
@@ -141,11 +143,14 @@ def process_cath_domain_list_for_group(job: Job, group: tuple[str, pd.DataFrame]
     """
     name, group_df = group
 
-    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-        for _, row in group_df.iterrows():
-            group = store.require_group(f"{row.h5_key}/domains/{row.cath_domain}")
-            group.domain_length = row.domain_length
-            group.resolution = row.resolution
+    call_h5(cath_full_h5, add_domain_groups, group_df)
+
+def add_domain_groups(store: h5py.File, group_df: pd.DataFrame) -> None:
+    """Create a group for each domain in group_df under its superfamily. Run with call_h5"""
+    for _, row in group_df.iterrows():
+        group = store.require_group(f"{row.h5_key}/domains/{row.cath_domain}")
+        group.domain_length = row.domain_length
+        group.resolution = row.resolution
 
 def process_cath_domain_list(job: Job, cath_full_h5: str, cathcode: Union[list[str], str] = None, 
                              skip_cathcode: Union[list[str], str] = None, force: bool = False, 
@@ -180,7 +185,7 @@ def process_cath_domain_list(job: Job, cath_full_h5: str, cathcode: Union[list[s
 
     if isinstance(force, bool) or (is_num(force) and int(force)<3):
         try:
-            with h5py.File(cath_full_h5, mode="r", use_cache=False, retries=100) as store:
+            with hsds_file(cath_full_h5, mode="r") as store:
                 run_domain_names = not store.attrs.get("completed_domain_list", False)
                 run_splits = not store.attrs.get("completed_domain_splits", False)
         except IOError:
@@ -252,24 +257,53 @@ def process_cath_names_for_group(job: Job, group: tuple[str, pd.DataFrame], cath
 
     group_df = group_df[group_df.cath_code.str.count(".")==level-1]
 
-    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-        for _, row in group_df.iterrows():
-            group = store.require_group(row.h5_key)
-            try:
-                group.description = row.description
-                group.representativeDomain = row.representative
-            except KeyError:
-                #likely from direcotry
-                group.description.description = None
-                group.representativeDomain = None
-
-            if row.cath_code.count(".") == 3:
-                store.require_group(f"{row.h5_key}/domains")
+    call_h5(cath_full_h5, add_name_groups, group_df)
     
     if level < 4:
         group_df.group = group_df["cath_code"].str.split(".", expand=True)[:level+1].fillna("").agg('.'.join, axis=1)
         map_job(job, process_cath_names_for_group, group_df.groupby("group"), cath_full_h5, level=level+1)
 
+def add_name_groups(store: h5py.File, group_df: pd.DataFrame) -> None:
+    """Create a group for each CATH code in group_df. Run with call_h5"""
+    for _, row in group_df.iterrows():
+        group = store.require_group(row.h5_key)
+        try:
+            group.description = row.description
+            group.representativeDomain = row.representative
+        except KeyError:
+            #likely from direcotry
+            group.description.description = None
+            group.representativeDomain = None
+
+        if row.cath_code.count(".") == 3:
+            store.require_group(f"{row.h5_key}/domains")
+
+def require_groups(store: h5py.File, keys: list[str]) -> None:
+    """Create each group in keys if it does not exist. Run with call_h5"""
+    for key in keys:
+        store.require_group(key)
+
+def set_root_attr(store: h5py.File, attribute: str, value: Any) -> None:
+    """Set an attribute on the root of the file. Run with call_h5"""
+    store.attrs[attribute] = value
+
+def delete_h5(cath_full_h5: str) -> None:
+    """Remove all groups from an HSDS domain and delete it, or delete a local h5 file"""
+    if is_local_h5(cath_full_h5):
+        path = local_path(cath_full_h5)
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+
+    #Empty file if it has been created before
+    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+        delete_groups(store)
+        store.flush()
+        RealtimeLogger.info(f"Deleted {cath_full_h5}")
+
+    with h5py.Folder(os.path.dirname(cath_full_h5)+"/", mode="a", retries=100) as hparent:
+        del hparent[os.path.basename(cath_full_h5)]
+
 def delete_groups(root: h5py.Group) -> None:
     """Delete all groups and datasets from and including given root
     
@@ -316,14 +350,7 @@ def process_cath_names(job: Job, cath_full_h5: str, cathcode: Union[list[str], s
     if is_num(force) and int(force)==3:
         RealtimeLogger.info(f"Removing all previous data from {cath_full_h5}")
         try:
-            #Empty file if it has been created before
-            with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-                delete_groups(store)
-                store.flush()
-                RealtimeLogger.info(f"Deleted {cath_full_h5}")
-
-            with h5py.Folder(os.path.dirname(cath_full_h5)+"/", mode="a") as hparent:
-                del hparent[os.path.basename(cath_full_h5)]
+            delete_h5(cath_full_h5)
         except IOError:
             raise
             #not created
@@ -391,7 +418,7 @@ def process_cath_names(job: Job, cath_full_h5: str, cathcode: Union[list[str], s
     job.addFollowOnJobFn(finish_section, cath_full_h5, "completed_names")
 
 def setup_custom_cath_file_for_sfam(job: Job, full_sfam_path: str, cath_full_h5: str):
-    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+    with hsds_file(cath_full_h5, mode="a") as store:
         for _, row in group_df.iterrows():
             group = store.require_group(row.h5_key)
             group.description = row.description
@@ -425,14 +452,7 @@ def setup_custom_file(job: Job, cath_full_h5: str, pdbs: Union[bool, list[str],
     if is_num(force) and int(force)==3:
         RealtimeLogger.info(f"Removing all previous data from {cath_full_h5}")
         try:
-            #Empty file if it has been created before
-            with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-                delete_groups(store)
-                store.flush()
-                RealtimeLogger.info(f"Deleted {cath_full_h5}")
-
-            with h5py.Folder(os.path.dirname(cath_full_h5)+"/", mode="a", retries=100) as hparent:
-                del hparent[os.path.basename(cath_full_h5)]
+            delete_h5(cath_full_h5)
         except IOError:
             raise
             #not created
@@ -443,8 +463,8 @@ def setup_custom_file(job: Job, cath_full_h5: str, pdbs: Union[bool, list[str],
     else:
         RealtimeLogger.info(f"Not deleting any previous data from {cath_full_h5}")
 
-    with h5py.File(cath_full_h5, mode="a", use_cache=False) as store:
-        pass
+    #Create the file
+    call_h5(cath_full_h5, require_groups, [])
 
     #It might be a direcotry or CATH formatted directory
     if isinstance(pdbs, (str, Path)) and Path(pdbs).is_dir():
@@ -456,13 +476,9 @@ def setup_custom_file(job: Job, cath_full_h5: str, pdbs: Union[bool, list[str],
                 names = pd.DataFrame([(*f.stem.split(), str(f)) for f in child_files], columns=["C", "A", "T", "H", "full_path"])
                 names = names.assign(group=names["cath_code"].str.split(".", expand=True)[[0,1]].fillna("").agg('.'.join, axis=1))
 
-                with h5py.File(cath_full_h5, mode="a", use_cache=False) as store:
-                    for className in names.C.drop_duplicates():
-                        #Only max 4
-                        store.require_group(className)
-                    for class_arch, _ in names.groupby(["C", "A"]):
-                        #only max 41
-                        store.require_group(f"{class_arch[0]}/{class_arch[1]}")
+                #Only max 4 classes and 41 architectures
+                call_h5(cath_full_h5, require_groups, list(names.C.drop_duplicates())+\
+                    [f"{class_arch[0]}/{class_arch[1]}" for class_arch, _ in names.groupby(["C", "A"])])
 
                 map_job(job, setup_custom_cath_file_for_sfam, child_files, cath_full_h5)
             else:
@@ -483,10 +499,7 @@ def setup_custom_file(job: Job, cath_full_h5: str, pdbs: Union[bool, list[str],
         if Path(pdbs[0]).is_file():
             #Ceate custom files, not implemented
             if create_all_hierarchies_first:
-                with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-                    domain_group = store.require_group("domains")
-                    for pdb in pdbs:
-                        group = domain_group.require_group(str(Path(pdb).name))
+                call_h5(cath_full_h5, require_groups, ["domains"]+[f"domains/{Path(pdb).name}" for pdb in pdbs])
                 
             return pdbs
 
@@ -533,7 +546,7 @@ def create_h5_hierarchy(job: Job, cath_full_h5: str, cathcode: Union[str, list[s
     run_names = True
     if isinstance(force, bool) or (is_num(force) and int(force)<3):
         try:
-            with h5py.File(cath_full_h5, mode="r", use_cache=False, retries=100) as store:
+            with hsds_file(cath_full_h5, mode="r") as store:
                 run_names = not store.attrs.get("completed_names", False)
         except IOError:
             #Never created, ignore
@@ -562,8 +575,7 @@ def finish_section(job: Job, cath_full_h5: str, attribute: str) -> None:
     atrribute : str
         Name of complete section
     """
-    with h5py.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
-        store.attrs[attribute] = True
+    call_h5(cath_full_h5, set_root_attr, attribute, True)
 
 def is_num(a: Any) -> bool:
     """Returns True is input in a number (e.g. string)
@@ -11,8 +11,11 @@ try:
 except ImportError:
     raise ImportError("In order to the Prop3D datasets, you must install pytorch")
 
+import h5py
 import h5pyd
 
+from Prop3D.util.local_h5 import is_local_h5, open_local_h5, writer_address
+
 class ConcatDataset(_ConcatDataset):
     def __getattr__(self, name):
         if hasattr(self.datasets[0], name):
@@ -34,7 +37,8 @@ class DistributedDataset(Dataset):
     Paramaters
     ----------
     path : str
-        The name of the full h5 file with all groups and datasets
+        The name of the full h5 file with all groups and datasets, on HSDS or
+        a local h5 file
     key : str
         The key to the dataset or group, specifying all intermediate groups
     test : bool
@@ -57,7 +61,7 @@ class DistributedDataset(Dataset):
         self._f = None
 
         try:
-            f = h5pyd.File(self.path, self.file_mode, use_cache=self.use_cache, retries=self.retries)
+            f = self._open()
         except Exception as e:
             import traceback as tb
             with open(f"{key.replace('/', '_')}.error", "w") as f:
@@ -67,7 +71,7 @@ class DistributedDataset(Dataset):
         data = f[key]
 
         self.embedding = None
-        if not isinstance(data, h5pyd.Dataset):
+        if not isinstance(data, (h5pyd.Dataset, h5py.Dataset)):
             self.is_dataset = False
             if dataset_group_name in data.keys():
                 self.key = os.path.join(key, dataset_group_name)
@@ -98,6 +102,9 @@ class DistributedDataset(Dataset):
             self.order = list(range(len(data)))
             self.is_dataset = True
 
+        #Items are read with a new handle (see f)
+        f.close()
+
     @classmethod
     def create_multiple(cls, path, keys, balance=None, **kwds):
         if not isinstance(keys, (list, tuple)):
@@ -158,9 +165,19 @@ class DistributedDataset(Dataset):
     @property
     def f(self):
         if self._f is None:
-            self._f = h5pyd.File(self.path, self.file_mode, use_cache=self.use_cache, retries=self.retries)
+            self._f = self._open()
         return self._f
 
+    def _open(self):
+        """Open the HSDS domain, or a local h5 file with the same layout. The dataset keeps
+        its handle open, which would block the local writer, so local files that are still
+        being written by a workflow cannot be used"""
+        if is_local_h5(self.path):
+            if os.path.exists(writer_address(self.path)):
+                raise RuntimeError(f"{self.path} is being written by a Prop3D workflow, use it after the workflow finishes")
+            return open_local_h5(self.path, self.file_mode, retries=self.retries)
+        return h5pyd.File(self.path, self.file_mode, use_cache=self.use_cache, retries=self.retries)
+
     @f.deleter
     def f(self):
         if self._f is not None:
@@ -177,7 +194,7 @@ class DistributedDatasetSplit(DistributedDataset):
 
     def split(self, split_size={"train":0.8, "validation":0.1, "test":0.1}, ):
         if self.file_mode == "r":
-            if isinstance(self.data, h5pyd.Dataset):
+            if isinstance(self.data, (h5pyd.Dataset, h5py.Dataset)):
                 return {self.data.attrs["data_split"][split_name] \
                     for split_name in split_size.items()}
             else:
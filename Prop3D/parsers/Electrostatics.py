@@ -44,6 +44,12 @@ class Electrostatics(object):
     def atom_potentials_from_pqr(self, pqr_file):
         return self.apbs.atom_potentials_from_pqr(pqr_file)
 
+    def get_dx_grid_from_pdb(self, pdb_file, key=None, cache=None, force_field="amber", **kwds):
+        return self.apbs.get_dx_grid_from_pdb(pdb_file, key=key, cache=cache, force_field=force_field, **kwds)
+
+    def get_potentials_at_coordinates(self, coordinates, pdb_file, key=None, cache=None, **kwds):
+        return self.apbs.get_potentials_at_coordinates(coordinates, pdb_file, key=key, cache=cache, **kwds)
+
     #Multivalue
 
     ##Multivalue from pdb
@@ -135,7 +141,7 @@ class _APBS(Container):
             pqr_path = self.format_in_path(None, self.full_pqr_path)
             input_file, out_file = self.write_apbs_electrostatics_input(self.full_pqr_path)
             kwds["in_file"] = input_file
-        super(self, APBS).local(*args, **kwds)
+        return super().local(*args, **kwds)
 
     @staticmethod
     def parse_atom_pot_file(atom_pot_file):
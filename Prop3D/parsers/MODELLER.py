@@ -168,7 +168,7 @@ class MODELLER(Container):
             if len(args) >= 1:
                 args = [modeller_file]+args[1:]
             kwds["modeller_file"] = modeller_file
-        super().local(*args, **kwds)
+        return super().local(*args, **kwds)
 
     def make_ca_model(self, template_pdb, chain=None, num_models=5, return_best=True):
         return self.remodel_structure(template_pdb, chain=chain,
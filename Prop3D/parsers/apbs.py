@@ -1,9 +1,11 @@
 import os
+import hashlib
 
 from Prop3D.parsers.psize import Psize
 from Prop3D.parsers.container import Container
 from Prop3D.parsers.pdb2pqr import Pdb2pqr
 from Prop3D.util.pdb import get_first_chain, replace_chains
+from Prop3D.util.dx import DXGrid, DXCache
 
 class APBS(Container):
     IMAGE = 'docker://edraizen/apbs:latest'
@@ -95,13 +97,64 @@ class APBS(Container):
         pqr_file, apbs_in_file = self._pdb_to_pqr(pdb_file, force_field=force_field, **pdb2pqr_kwds)
         return self.get_atom_potentials_from_pqr(pqr_file, apbs_in_file=apbs_in_file, with_charge=with_charge)
 
+    def dx_from_pdb(self, pdb_file, force_field="amber", **pdb2pqr_kwds):
+        """Run APBS and write the potential of the entire grid as a dx file, using
+        the input file from pdb2pqr (--apbs-input)
+        """
+        pdb2pqr_kwds["apbs_input"] = True
+        dx_file = self.atom_potentials_from_pdb(pdb_file, force_field=force_field, **pdb2pqr_kwds)
+        if not dx_file.endswith(".dx"):
+            raise RuntimeError(f"APBS did not write a dx map for {pdb_file}")
+        return dx_file
+
+    def get_dx_grid_from_pdb(self, pdb_file, key=None, cache=None, force_field="amber", **pdb2pqr_kwds):
+        """Get the APBS potential map for a structure, only running APBS if it is not
+        already in the cache
+
+        Parameters
+        ----------
+        pdb_file : str
+            Path to pdb file
+        key : str or None
+            Name to save the map under, e.g. the domain name. If None, use the file
+            name and a hash of its contents
+        cache : DXCache or None
+            Local cache of maps. If None, use the default DXCache
+
+        Returns
+        -------
+        A DXGrid
+        """
+        if cache is None:
+            cache = DXCache()
+
+        if key is None:
+            with open(pdb_file, "rb") as f:
+                key = "{}-{}".format(os.path.splitext(os.path.basename(pdb_file))[0],
+                    hashlib.sha1(f.read()).hexdigest()[:12])
+
+        def calculate_grid():
+            dx_file = self.dx_from_pdb(pdb_file, force_field=force_field, **pdb2pqr_kwds)
+            grid = DXGrid.read(dx_file)
+            self.files_to_remove.append(dx_file)
+            self.clean()
+            return grid
+
+        return cache.get_or_compute(key, calculate_grid)
+
+    def get_potentials_at_coordinates(self, coordinates, pdb_file, key=None, cache=None, **kwds):
+        """Potential at any coordinates (in the frame of pdb_file) by trilinear interpolation
+        of the cached APBS map. See get_dx_grid_from_pdb for parameters.
+        """
+        return self.get_dx_grid_from_pdb(pdb_file, key=key, cache=cache, **kwds).interpolate(coordinates)
+
     def local(self, *args, **kwds):
         self.is_local = True
         if hasattr(self, "running_atom_potentials") and self.running_atom_potentials:
             pqr_path = self.format_in_path(None, self.full_pqr_path)
             input_file, out_file = self.write_apbs_electrostatics_input(self.full_pqr_path)
             kwds["in_file"] = input_file
-        super(self, APBS).local(*args, **kwds)
+        return super().local(*args, **kwds)
 
     @staticmethod
     def parse_atom_pot_file(atom_pot_file):
@@ -2,7 +2,12 @@ import os
 import sys
 import json
 import time
+import uuid
+import shlex
+import re
 import types
+import atexit
+import threading
 import subprocess
 import tempfile
 import shutil
@@ -19,7 +24,7 @@ from contextlib import contextmanager
 from toil.realtimeLogger import RealtimeLogger
 from toil.job import Job
 from Prop3D.util import silence_stdout, silence_stderr
-from Prop3D.util.iostore import IOStore
+from Prop3D.util.iostore import IOStore, reflink
 
 # class RealtimeLogger:
 #     @staticmethod
@@ -34,6 +39,20 @@ FORCE_LOCAL = os.environ.get("FORCE_LOCAL", "false")[0].lower()=="t"
 USE_SINGULARITY = os.environ.get("USE_SINGULARITY", "false")[0].lower()=="t"
 USE_DOCKER = os.environ.get("USE_DOCKER", "false")[0].lower()=="t"
 
+#Send tool calls to long running containers (one per image) instead of starting
+#a new container for each call. Only used by Container subclasses with SESSION_SAFE
+USE_CONTAINER_SESSIONS = os.environ.get("USE_CONTAINER_SESSIONS", "false")[0].lower()=="t"
+
+#How input files outside of the work dir are given to containers:
+#  link: hardlink read-only files into the work dir, reflink or copy writable files
+#        and files on a different filesystem (default)
+#  bind: mount the parent directory read-only, link/copy for sessions and local runs
+#  copy: always copy into the work dir
+CONTAINER_STAGING = os.environ.get("CONTAINER_STAGING", "link").lower()
+
+#Use tools installed on the PATH instead of containers when they pass version checks
+PREFER_LOCAL_TOOLS = os.environ.get("PREFER_LOCAL_TOOLS", "false")[0].lower()=="t"
+
 class ContainerSystemError(RuntimeError):
     pass
 
@@ -103,15 +122,309 @@ if USE_DOCKER or FORCE_LOCAL:
 class StoreTrueValue(object):
     pass
 
+#Images already pulled by this process
+_pulled_images = {}
+
+def pull_container_once(image):
+    """Pull an image only the first time it is used in this process"""
+    if image not in _pulled_images:
+        _pulled_images[image] = pullContainer(image, pull_folder=CONTAINER_PATH)
+    return _pulled_images[image]
+
+class ContainerSession(object):
+    """A long running container that tool calls are sent to with 'exec', so short tools
+    do not pay for starting and removing a container on every call. One directory
+    per process (see get_session_root) is bind mounted at container_file_prefix and
+    each call runs in its own subdirectory, so jobs with different work dirs share the
+    container. The container is checked before each call and restarted if it died.
+
+    Parameters
+    ----------
+    image : str
+        Pulled image name (docker) or path (singularity)
+    work_dir : str
+        Local directory mounted at container_file_prefix
+    container_file_prefix : str
+        Mount point inside the container
+    max_restarts : int
+        Stop restarting after this many failures
+    """
+    def __init__(self, image, work_dir, container_file_prefix="/data", max_restarts=3):
+        if not USE_DOCKER and not USE_SINGULARITY:
+            raise ContainerSystemError("Container sessions require docker or singularity")
+        self.image = image
+        self.work_dir = os.path.abspath(work_dir)
+        self.container_file_prefix = container_file_prefix
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.calls = 0
+        self.name = None
+        self._default_entrypoint = None
+        self.start()
+
+    def start(self):
+        self.name = f"prop3d-session-{uuid.uuid4().hex[:12]}"
+        if USE_DOCKER:
+            #Keep the container alive by replacing the entrypoint
+            cmd = ["docker", "run", "-d", "--rm", "--name", self.name,
+                "-v", f"{self.work_dir}:{self.container_file_prefix}:rw",
+                "-w", self.container_file_prefix, "--entrypoint", "sleep", self.image, "infinity"]
+        else:
+            cmd = ["singularity", "instance", "start", "--bind",
+                f"{self.work_dir}:{self.container_file_prefix}", self.image, self.name]
+
+        try:
+            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise ContainerSystemError(f"Unable to start session for {self.image}: {e.output.decode('utf-8', 'replace')}")
+
+        RealtimeLogger.info(f"Started container session {self.name} for {self.image}")
+
+    def stop(self):
+        if self.name is None:
+            return
+        if USE_DOCKER:
+            cmd = ["docker", "rm", "-f", self.name]
+        else:
+            cmd = ["singularity", "instance", "stop", self.name]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.name = None
+
+    def restart(self):
+        if self.restarts >= self.max_restarts:
+            raise ContainerSystemError(f"Container session for {self.image} failed {self.restarts} times")
+        self.restarts += 1
+        RealtimeLogger.info(f"Restarting container session for {self.image} ({self.restarts}/{self.max_restarts})")
+        self.stop()
+        self.start()
+
+    def is_healthy(self):
+        """Check that the container is still running and accepts commands"""
+        if self.name is None:
+            return False
+        if USE_DOCKER:
+            cmd = ["docker", "inspect", "-f", "{{.State.Running}}", self.name]
+        else:
+            cmd = ["singularity", "exec", f"instance://{self.name}", "true"]
+        try:
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+        except subprocess.TimeoutExpired:
+            return False
+        return out.returncode == 0 and (not USE_DOCKER or out.stdout.strip() == b"true")
+
+    def default_entrypoint(self):
+        """Entrypoint of a docker image, which was replaced to keep the container alive"""
+        if self._default_entrypoint is None:
+            self._default_entrypoint = get_image_entrypoint(self.image)
+        return self._default_entrypoint
+
+    def command(self, parameters, entrypoint=None, working_dir=None):
+        if isinstance(entrypoint, str):
+            entrypoint = shlex.split(entrypoint)
+
+        if working_dir is None:
+            working_dir = self.container_file_prefix
+
+        if USE_DOCKER:
+            entrypoint = entrypoint if entrypoint is not None else self.default_entrypoint()
+            return ["docker", "exec", "-w", working_dir, self.name]+list(entrypoint)+parameters
+        elif entrypoint is not None:
+            return ["singularity", "exec", "--pwd", working_dir,
+                f"instance://{self.name}"]+list(entrypoint)+parameters
+        else:
+            #Use the image's runscript
+            return ["singularity", "run", "--pwd", working_dir,
+                f"instance://{self.name}"]+parameters
+
+    def exec(self, parameters, entrypoint=None, working_dir=None):
+        """Run a tool inside of the session, restarting the container if it is not running
+
+        Parameters
+        ----------
+        parameters : list of str
+            Formatted parameters (see Container.format_parameters)
+        entrypoint : str, list, or None
+            Program to run. If None, use the image default.
+        working_dir : str or None
+            Directory inside of the container to run in. Default: container_file_prefix
+
+        Returns
+        -------
+        Combined stdout and stderr as a string
+        """
+        while True:
+            if not self.is_healthy():
+                self.restart()
+
+            self.calls += 1
+            out = subprocess.run(self.command(parameters, entrypoint=entrypoint, working_dir=working_dir),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            message = out.stdout.decode("utf-8", "replace")
+
+            if out.returncode == 0:
+                return message
+
+            if self.is_healthy():
+                #Tool failed, not the container
+                raise RuntimeError(f"{parameters} exited with {out.returncode}: {message}")
+
+            #Container died during the call, restart and try again
+
+def get_image_entrypoint(image):
+    """Get the default command of an image as a list, used when a container is
+    started with a different entrypoint (sessions and batch driver scripts)"""
+    if USE_DOCKER:
+        out = subprocess.run(["docker", "image", "inspect", "-f", "{{json .Config.Entrypoint}}", image],
+            check=True, stdout=subprocess.PIPE)
+        return json.loads(out.stdout) or []
+    else:
+        #Standard location of the runscript inside of singularity images
+        return ["/.singularity.d/runscript"]
+
+#Results of find_local_tool for each Container subclass
+_local_tools = {}
+
+def parse_version(text):
+    """Get the first version number (e.g. 2.2.1) from a string as a tuple of ints"""
+    match = re.search(r"(\d+(?:\.\d+)+)", text)
+    if match is None:
+        return None
+    return tuple(int(v) for v in match.group(1).split("."))
+
+#LOCAL commands starting with an interpreter are always found, so finding them
+#says nothing about whether the tool itself is installed
+INTERPRETERS = re.compile(r"^(python[\d.]*|pypy[\d.]*|perl|ruby|node|java|R|Rscript|bash|sh)$")
+
+def is_interpreter(program):
+    """Check if a LOCAL program is an interpreter instead of the tool itself"""
+    if os.path.realpath(program) == os.path.realpath(sys.executable):
+        return True
+    return INTERPRETERS.match(os.path.basename(program)) is not None
+
+def find_local_tool(container_cls):
+    """Find the LOCAL program of a Container subclass on the PATH and check that its
+    version is at least LOCAL_MIN_VERSION. LOCAL commands that run an interpreter
+    (e.g. MODELLER's [sys.executable]) are never auto-detected. Results are cached
+    per class.
+
+    Returns
+    -------
+    Path to the program, or None if it is not installed, too old, or cannot be checked
+    """
+    if container_cls in _local_tools:
+        return _local_tools[container_cls]
+
+    path = None
+    if container_cls.LOCAL is not None and len(container_cls.LOCAL) > 0 and \
+      not is_interpreter(container_cls.LOCAL[0]):
+        path = shutil.which(container_cls.LOCAL[0])
+
+    if path is not None and container_cls.LOCAL_MIN_VERSION is not None:
+        try:
+            out = subprocess.run(container_cls.LOCAL+container_cls.LOCAL_VERSION_ARGS,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+            version = parse_version(out.stdout.decode("utf-8", "replace"))
+        except (OSError, subprocess.TimeoutExpired):
+            version = None
+
+        min_version = parse_version(container_cls.LOCAL_MIN_VERSION)
+        if version is None or version < min_version:
+            RealtimeLogger.info(f"Not using local {container_cls.LOCAL[0]}, version {version} < {min_version}")
+            path = None
+
+    _local_tools[container_cls] = path
+    return path
+
+#Running sessions in this process keyed by image
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+#Directory mounted into every session, created on first use. Job work dirs are
+#temporary, so calls stage their files into a subdirectory of this one instead
+_session_root = None
+
+def get_session_root():
+    """Get the local directory shared by all sessions in this process"""
+    global _session_root
+    if _session_root is None:
+        _session_root = tempfile.mkdtemp(prefix="prop3d-sessions-")
+        os.chmod(_session_root, 0o777)
+    return _session_root
+
+def get_session(image, container_file_prefix="/data"):
+    """Get the running session for an image or start a new one. The prefix is only
+    used when the session is started"""
+    with _sessions_lock:
+        if image not in _sessions:
+            _sessions[image] = ContainerSession(image, get_session_root(),
+                container_file_prefix=container_file_prefix)
+        return _sessions[image]
+
+def stop_sessions():
+    """Stop all container sessions started by this process"""
+    global _session_root
+    while len(_sessions) > 0:
+        _, session = _sessions.popitem()
+        session.stop()
+    if _session_root is not None:
+        shutil.rmtree(_session_root, ignore_errors=True)
+        _session_root = None
+
+atexit.register(stop_sessions)
+
+#Cumulative wall time spent inside (non-detached) container or local tool calls
+#in this process, so callers can separate external tool time from python time.
+#Calls overlapping on several threads are counted once: seconds is the time at
+#least one tool was running, tracked with the number of threads inside a tool
+_tool_time = {"seconds": 0., "calls": 0, "active": 0, "start": None}
+_tool_time_lock = threading.Lock()
+
+#Nesting of tool calls on each thread, only the outermost call is timed
+_tool_depth = threading.local()
+
+def get_tool_time():
+    """Get the total wall time (seconds) and number of calls spent running
+    external tools through Container subclasses in this process"""
+    with _tool_time_lock:
+        seconds = _tool_time["seconds"]
+        if _tool_time["active"] > 0:
+            seconds += time.perf_counter()-_tool_time["start"]
+        return seconds, _tool_time["calls"]
+
+_staging_bytes = {"copied": 0, "linked": 0, "reflinked": 0, "mounted": 0}
+
+def get_staging_bytes():
+    """Get the total number of input bytes copied, hardlinked, reflinked, and bind
+    mounted into work dirs by Container subclasses in this process"""
+    return dict(_staging_bytes)
+
 def iterator_to_list(func):
     def wrapper(*args, **kwds):
-        result = func(*args, **kwds)
-        if isinstance(result, types.GeneratorType):
-            result = list(result)
-            if len(result) == 1:
-                return result[0]
+        #Only time the outermost call if one tool calls another
+        depth = getattr(_tool_depth, "depth", 0)
+        _tool_depth.depth = depth+1
+        if depth == 0:
+            with _tool_time_lock:
+                if _tool_time["active"] == 0:
+                    _tool_time["start"] = time.perf_counter()
+                _tool_time["active"] += 1
+        try:
+            result = func(*args, **kwds)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+                if len(result) == 1:
+                    return result[0]
+                return result
             return result
-        return result
+        finally:
+            _tool_depth.depth = depth
+            if depth == 0:
+                with _tool_time_lock:
+                    _tool_time["active"] -= 1
+                    _tool_time["calls"] += 1
+                    if _tool_time["active"] == 0:
+                        _tool_time["seconds"] += time.perf_counter()-_tool_time["start"]
+                        _tool_time["start"] = None
     return wrapper
 
 
@@ -131,10 +444,18 @@ class Container(object):
 
     Custom methods must return the updated value. If None, value will be
     removed from parameter list.
+
+    SESSION_SAFE: bool
+        The tool can run in a ContainerSession (USE_CONTAINER_SESSIONS). Only set this
+        if every path goes through PARAMETERS when the tool is called. Session calls
+        run in their own directory under the session mount, so paths formatted before
+        __call__ (e.g. written into input files) or hard coded to /data are not found.
     """
 
     IMAGE = None
     LOCAL = None
+    LOCAL_VERSION_ARGS = ["--version"]
+    LOCAL_MIN_VERSION = None
     PARAMETERS = []
     RULES = {}
     ENTRYPOINT = None
@@ -145,9 +466,11 @@ class Container(object):
     GPUS = False
     EXTRA_CONTAINER_KWDS = {}
     CONTAINER_FILE_PREFIX = "/data"
+    SESSION_SAFE = False
 
     def __init__(self, job=None, return_files=False, force_local=False, fallback_local=False,
-      intermediate_file_store=None, work_dir=None, detach=False, cleanup_when_done=True):
+      intermediate_file_store=None, work_dir=None, detach=False, cleanup_when_done=True, session=None,
+      prefer_local=None):
         assert (self.IMAGE, self.LOCAL).count(None) <= 1, "Must define container or local path"
 
         if self.LOCAL is not None:
@@ -158,11 +481,22 @@ class Container(object):
 
         self.work_dir = work_dir if work_dir is not None else os.getcwd()
         self.force_local = (FORCE_LOCAL or force_local or self.IMAGE is None) and self.LOCAL is not None
+        #Running locally only because the tool was found, use the container if it fails
+        self.preferred_local = False
+        if not self.force_local and (PREFER_LOCAL_TOOLS if prefer_local is None else prefer_local):
+            #Skip container start up if the tool is installed
+            self.force_local = self.preferred_local = find_local_tool(self.__class__) is not None
         self.fallback_local = fallback_local or self.LOCAL is not None
         self.return_files = return_files or self.RETURN_FILES
         self.detach = detach or self.DETACH
         self.cleanup_when_done = cleanup_when_done
         self.job = job
+
+        #Reuse a running container (see ContainerSession). Not used for detached or GPU
+        #calls, or tools that format paths themselves (see SESSION_SAFE)
+        self.session = (USE_CONTAINER_SESSIONS and self.SESSION_SAFE if session is None else session) and \
+            not self.detach and not self.GPUS and (USE_DOCKER or USE_SINGULARITY)
+        self.session_dir = None
         self.rules = {
             str: lambda k, v: str(v),
             "str": lambda k, v: str(v),
@@ -220,6 +554,10 @@ class Container(object):
         self.is_local = False
         self.stdin = None
 
+        #Parent dirs of inputs to mount read-only and bytes copied for the current call
+        self.input_volumes = {}
+        self.bytes_copied = 0
+
         for i, p in enumerate(self.PARAMETERS):
             if isinstance(p, str):
                 self.parameters.append([p])
@@ -297,32 +635,57 @@ class Container(object):
                         raise RuntimeError("invalid parameters: {}".format(p))
 
     def __call__(self, *args, **kwds):
-        if self.force_local:
+        if self.force_local and not self.preferred_local:
             yield self.local(*args, **kwds)
+            return
+        elif self.force_local:
+            try:
+                result = self.local(*args, **kwds)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as e:
+                #Installed tool does not work, use the container from now on
+                RealtimeLogger.info(f"Local {self.LOCAL[0]} failed, using container {self.IMAGE}: {type(e).__name__}: {e}")
+                _local_tools[self.__class__] = None
+                self.force_local = self.preferred_local = False
+            else:
+                yield result
+                return
 
         assert self.job is not None
 
-        parameters = self.format_parameters(args, kwds)
-        RealtimeLogger.info(parameters)
-        print(parameters)
-
         image = self.IMAGE
         if USE_DOCKER:
             image = image.replace("docker://", "")
 
-        image = pullContainer(image, pull_folder=CONTAINER_PATH)
+        image = pull_container_once(image)
+
+        self.input_volumes = {}
+        if self.session:
+            session = self.enter_session(image)
+        try:
+            parameters = self.format_parameters(args, kwds)
+        except:
+            self.leave_session(remove=True)
+            raise
+        RealtimeLogger.info(parameters)
+        print(parameters)
 
         if USE_SINGULARITY:
             self.EXTRA_CONTAINER_KWDS["return_result"] = True
 
         try:
-            if True: #with silence_stdout(), silence_stderr():
+            if self.session:
+                container_dir = self.CONTAINER_FILE_PREFIX
+                self.leave_session()
+                out = session.exec(parameters, entrypoint=self.ENTRYPOINT, working_dir=container_dir)
+            else: #with silence_stdout(), silence_stderr():
                 out = containerCall(
                     self.job,
                     image=image,
                     entrypoint=self.ENTRYPOINT,
                     working_dir=self.CONTAINER_FILE_PREFIX,
-                    volumes={self.work_dir:{"bind":self.CONTAINER_FILE_PREFIX, "mode":"rw"}},
+                    volumes={self.work_dir:{"bind":self.CONTAINER_FILE_PREFIX, "mode":"rw"}, **self.input_volumes},
                     parameters=parameters,
                     detach=self.detach,
                     **self.EXTRA_CONTAINER_KWDS)
@@ -333,6 +696,7 @@ class Container(object):
                 #Handle bug when running on samba shares
                 raise
             else:
+                self.remove_session_dir()
                 if self.fallback_local:
                     import traceback as tb
                     RealtimeLogger.error(tb.format_exc())
@@ -368,7 +732,7 @@ class Container(object):
                 raise RuntimeError(f"Output: {message}, Error: {tb.format_exc()}")
 
         else:
-            if USE_SINGULARITY:
+            if USE_SINGULARITY and not self.session:
                 message = "".join(out["message"])
 
                 if out["return_code"] and not "chown: changing ownership:" not in message.splitlines()[-1]:
@@ -376,7 +740,7 @@ class Container(object):
                     self.change_paths = OrderedDict()
                     raise RuntimeError(f"{parameters} {out}")
             else:
-                #Docker already handled error above
+                #Docker and sessions already handled error above
                 message = out
 
         self.message = out
@@ -389,6 +753,8 @@ class Container(object):
             self.change_paths = OrderedDict()
             
             raise
+        finally:
+            self.remove_session_dir()
 
         self.out_files = out_files
 
@@ -416,21 +782,220 @@ class Container(object):
             if self.stdin is not None:
                 with open(self.stdin) as f:
                     out = subprocess.check_output(self.LOCAL+parameters,
-                        env=env, stdin=f)
+                        env=env, stdin=f, cwd=self.work_dir)
             else:
-                out = subprocess.check_output(self.LOCAL+parameters, env=env)
+                out = subprocess.check_output(self.LOCAL+parameters, env=env, cwd=self.work_dir)
         except (SystemExit, KeyboardInterrupt):
             raise
         except:
+            self.is_local = False
+            self.stdin = None
+            self.clean()
+            self.change_paths = OrderedDict()
             raise
         self.is_local = False
         self.stdin = None
-        self.clean()
+
+        message = out.decode("utf-8", "replace")
+        self.message = message
+
+        try:
+            out_files = self.check_output()
+        finally:
+            self.clean()
+            self.change_paths = OrderedDict()
+
+        if self.return_files:
+            self.stdout = message
+            return out_files
+
+        return message
 
     def set_local_env(self):
         return None
 
+    @iterator_to_list
+    def map(self, inputs, batch_name=None):
+        """Run the tool on many inputs with a single container. All inputs are staged
+        into the work dir and a driver script runs the command once per input inside of
+        the container, saving each exit code and output separately so one failure does
+        not stop the batch. Subclasses with a native multi-input mode can override
+        map_commands.
+
+        Parameters
+        ----------
+        inputs : list of dicts or tuples
+            Parameters for each call, the same as keywords or positional arguments to __call__
+        batch_name : str or None
+            Name of the directory inside work_dir for logs. Default: random name
+
+        Returns
+        -------
+        results : list
+            Result for each input in order (output files if return_files, else the
+            tool's output), or None if the input failed
+        errors : dict
+            Index of each failed input to its exception
+        """
+        results = [None]*len(inputs)
+        errors = {}
+
+        if len(inputs) == 0:
+            return results, errors
+
+        if self.force_local or not (USE_DOCKER or USE_SINGULARITY):
+            #No container to share, run each input separately
+            for i, item in enumerate(inputs):
+                try:
+                    if isinstance(item, dict):
+                        results[i] = self(**item)
+                    else:
+                        results[i] = self(*item)
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception as e:
+                    errors[i] = e
+            return results, errors
+
+        image = self.IMAGE
+        if USE_DOCKER:
+            image = image.replace("docker://", "")
+        image = pull_container_once(image)
+
+        if self.session:
+            #Stage the whole batch into one session call directory
+            session = self.enter_session(image)
+
+        if batch_name is None:
+            batch_name = f"{self.__class__.__name__}-batch-{uuid.uuid4().hex[:8]}"
+        batch_dir = os.path.join(self.work_dir, batch_name)
+        os.makedirs(batch_dir, exist_ok=True)
+
+        #Stage inputs and save output paths for each item
+        self.input_volumes = {}
+        item_parameters = {}
+        item_change_paths = {}
+        for i, item in enumerate(inputs):
+            self.change_paths = OrderedDict()
+            try:
+                if isinstance(item, dict):
+                    item_parameters[i] = self.format_parameters((), dict(item))
+                else:
+                    item_parameters[i] = self.format_parameters(tuple(item), {})
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as e:
+                errors[i] = e
+                continue
+            item_change_paths[i] = self.change_paths
+        self.change_paths = OrderedDict()
+
+        entrypoint = self.ENTRYPOINT
+        if entrypoint is None:
+            entrypoint = get_image_entrypoint(image)
+        elif isinstance(entrypoint, str):
+            entrypoint = shlex.split(entrypoint)
+
+        #Write driver script to run each item and save its output and exit code
+        container_batch_dir = os.path.join(self.CONTAINER_FILE_PREFIX, batch_name)
+        driver_file = os.path.join(batch_dir, "driver.sh")
+        item_groups = {}
+        with open(driver_file, "w") as f:
+            print("#!/bin/sh", file=f)
+            print(f"cd {shlex.quote(self.CONTAINER_FILE_PREFIX)}", file=f)
+            for g, (indices, commands) in enumerate(self.map_commands(entrypoint, item_parameters)):
+                log_file = shlex.quote(os.path.join(container_batch_dir, f"{g}.log"))
+                rc_file = shlex.quote(os.path.join(container_batch_dir, f"{g}.rc"))
+                command = " && ".join(" ".join(shlex.quote(p) for p in c) for c in commands)
+                print(f"({command}) > {log_file} 2>&1; echo $? > {rc_file}", file=f)
+                item_groups.update({i:g for i in indices})
+
+        RealtimeLogger.info(f"Running {len(item_parameters)} inputs for {self.__class__.__name__} in one container")
+
+        driver_parameters = [os.path.join(container_batch_dir, "driver.sh")]
+        try:
+            if self.session:
+                container_dir = self.CONTAINER_FILE_PREFIX
+                self.leave_session()
+                session.exec(driver_parameters, entrypoint="sh", working_dir=container_dir)
+            else:
+                if USE_SINGULARITY:
+                    self.EXTRA_CONTAINER_KWDS["return_result"] = True
+                containerCall(
+                    self.job,
+                    image=image,
+                    entrypoint="sh",
+                    working_dir=self.CONTAINER_FILE_PREFIX,
+                    volumes={self.work_dir:{"bind":self.CONTAINER_FILE_PREFIX, "mode":"rw"}, **self.input_volumes},
+                    parameters=driver_parameters,
+                    **self.EXTRA_CONTAINER_KWDS)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            #Items that finished before the failure still have exit codes
+            import traceback as tb
+            RealtimeLogger.error(tb.format_exc())
+
+        #Split results back per item
+        for i, change_paths in item_change_paths.items():
+            message = ""
+            try:
+                g = item_groups[i]
+                with open(os.path.join(batch_dir, f"{g}.log")) as f:
+                    message = f.read()
+                with open(os.path.join(batch_dir, f"{g}.rc")) as f:
+                    rc = int(f.read().strip())
+            except (KeyError, IOError, ValueError):
+                errors[i] = RuntimeError(f"{item_parameters[i]} did not run. Message: {message}")
+                continue
+
+            if rc != 0:
+                errors[i] = RuntimeError(f"{item_parameters[i]} exited with {rc}: {message}")
+                continue
+
+            self.change_paths = change_paths
+            self.message = message
+            try:
+                out_files = self.check_output()
+            except AssertionError as e:
+                errors[i] = e
+                continue
+
+            results[i] = out_files if self.return_files else message
+
+        self.change_paths = OrderedDict()
+        self.clean()
+
+        if self.cleanup_when_done:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        self.remove_session_dir()
+
+        if len(errors) > 0:
+            RealtimeLogger.info(f"{self.__class__.__name__}: {len(errors)}/{len(inputs)} inputs failed")
+
+        return results, errors
+
+    def map_commands(self, entrypoint, item_parameters):
+        """Commands to run for a batch. By default each item is run separately. Override
+        to use a tool's native multi-input mode by grouping items into one command; the
+        output and exit code of a group are used for all of its items.
+
+        Parameters
+        ----------
+        entrypoint : list of str
+            Program to run inside of the container
+        item_parameters : dict
+            Index of each item to its formatted parameters
+
+        Returns
+        -------
+        list of (item indices, list of commands), each command is a list of str
+        """
+        return [([i], [entrypoint+parameters]) for i, parameters in item_parameters.items()]
+
     def format_parameters(self, args, kwds):
+        self.bytes_copied = 0
+
         if len(args)+len(kwds) == self.number_of_parameters:
             pass
 
@@ -497,6 +1062,8 @@ class Container(object):
                 except KeyError:
                     parameters[idx] = self.arg_formatter(k, val, "{}")
 
+        RealtimeLogger.info(f"{self.__class__.__name__}: copied {self.bytes_copied} bytes of inputs into {self.work_dir}")
+
         return [p for parameter in parameters for p in parameter if p is not None and isinstance(p, str)]
 
     def arg_formatter(self, key, value, formatter):
@@ -545,6 +1112,42 @@ class Container(object):
         else:
             raise RuntimeError(f"Invalid arg formatter: {formatter}")
 
+    def enter_session(self, image):
+        """Point work_dir and CONTAINER_FILE_PREFIX at a new directory inside of the
+        session mount for one call, so format_parameters stages inputs into it and
+        outputs are written there. Call leave_session before running the tool
+
+        Returns
+        -------
+        The ContainerSession for the image
+        """
+        session = get_session(image, self.CONTAINER_FILE_PREFIX)
+        name = f"{self.__class__.__name__}-{uuid.uuid4().hex[:12]}"
+        self.session_dir = os.path.join(session.work_dir, name)
+        os.makedirs(self.session_dir)
+        os.chmod(self.session_dir, 0o777)
+        self._job_work_dir = self.work_dir
+        self._job_file_prefix = self.CONTAINER_FILE_PREFIX
+        self.work_dir = self.session_dir
+        self.CONTAINER_FILE_PREFIX = os.path.join(session.container_file_prefix, name)
+        return session
+
+    def leave_session(self, remove=False):
+        """Restore the job's work dir after formatting a session call. The call
+        directory is kept until remove_session_dir so check_output can move the
+        outputs out of it"""
+        if self.session_dir is None or self.work_dir != self.session_dir:
+            return
+        self.work_dir = self._job_work_dir
+        self.CONTAINER_FILE_PREFIX = self._job_file_prefix
+        if remove:
+            self.remove_session_dir()
+
+    def remove_session_dir(self):
+        if self.session_dir is not None:
+            shutil.rmtree(self.session_dir, ignore_errors=True)
+            self.session_dir = None
+
     def format_in_path(self, name, path, move_files_to_work_dir=True, absolute_path=True):
         if False and self.is_local or not move_files_to_work_dir or any(path.startswith(p) for p in os.environ.get("ALLOWABLE_CONTAINER_PATHS", "").split(":")):
             if not os.path.isfile(path):
@@ -566,19 +1169,57 @@ class Container(object):
                     else:
                         new_path = path
                 else:
-                    local_path = os.path.abspath(os.path.join(self.work_dir, os.path.basename(path)))
-                    if not os.path.isfile(local_path):
-                        shutil.copyfile(path, local_path)
-                        #self.files_to_remove.append(local_path)
-                    new_path = os.path.join(self.CONTAINER_FILE_PREFIX, os.path.basename(path)) if not self.is_local else os.path.basename(path)
-                    if not os.path.isfile(local_path):
-                        time.sleep(2)
-                    assert os.path.isfile(local_path), f"DNE {local_path}"
+                    new_path = self.stage_in_file(path)
             else:
                 new_path = os.path.join(self.CONTAINER_FILE_PREFIX, os.path.basename(path)) if not self.is_local else os.path.basename(path)
 
             return new_path
 
+    def stage_in_file(self, path):
+        """Make a file outside of the work dir available to the tool without copying
+        if possible (see CONTAINER_STAGING), returning the path the tool should use"""
+        size = os.path.getsize(path)
+
+        if CONTAINER_STAGING == "bind" and not self.is_local and not self.session:
+            #Mount the parent directory read-only. Sessions already have fixed mounts
+            parent = os.path.abspath(os.path.dirname(path))
+            if parent not in self.input_volumes:
+                self.input_volumes[parent] = {
+                    "bind":f"/inputs/{len(self.input_volumes)}",
+                    "mode":"ro"}
+            _staging_bytes["mounted"] += size
+            return os.path.join(self.input_volumes[parent]["bind"], os.path.basename(path))
+
+        local_path = os.path.abspath(os.path.join(self.work_dir, os.path.basename(path)))
+        if not os.path.isfile(local_path):
+            staged = False
+            if CONTAINER_STAGING != "copy":
+                try:
+                    if not os.access(path, os.W_OK):
+                        #Shares the inode with the original, only safe if it cannot
+                        #be written through the link
+                        os.link(path, local_path)
+                        _staging_bytes["linked"] += size
+                    else:
+                        #Independent copy that shares data blocks until written
+                        reflink(path, local_path)
+                        _staging_bytes["reflinked"] += size
+                    staged = True
+                except OSError:
+                    #Different filesystem or links not supported
+                    pass
+            if not staged:
+                shutil.copyfile(path, local_path)
+                self.bytes_copied += size
+                _staging_bytes["copied"] += size
+            #self.files_to_remove.append(local_path)
+
+        if not os.path.isfile(local_path):
+            time.sleep(2)
+        assert os.path.isfile(local_path), f"DNE {local_path}"
+
+        return os.path.join(self.CONTAINER_FILE_PREFIX, os.path.basename(path)) if not self.is_local else os.path.basename(path)
+
     def format_out_path(self, name, path):
         path = os.path.abspath(path)
 
@@ -703,3 +1344,80 @@ class Container(object):
 
     def isRunning(self):
         containerIsRunning()
+
+def benchmark_tools(pdb_file, tools=None, repeats=3, work_dir=None):
+    """Compare the time to run tools in containers and with local binaries on one
+    structure to choose the fastest mode for a deployment (see PREFER_LOCAL_TOOLS)
+
+    Parameters
+    ----------
+    pdb_file : str
+        Path to sample structure
+    tools : list of str or None
+        Names of tools to test (dssp, cx, reduce). Default: all
+    repeats : int
+        Number of runs for each tool and mode
+    work_dir : str or None
+        Where to run tools. Default: current directory
+
+    Returns
+    -------
+    List of dicts with tool, mode, and mean/min seconds per call
+    """
+    from Prop3D.parsers.dssp import DSSP
+    from Prop3D.parsers.cx import CX
+    from Prop3D.parsers.reduce import Reduce
+
+    work_dir = os.getcwd() if work_dir is None else work_dir
+    all_tools = {
+        "dssp": (DSSP, lambda: {"in_file":pdb_file, "out_file":os.path.join(work_dir, "benchmark.dssp")}),
+        "cx": (CX, lambda: {"in_file":pdb_file}),
+        "reduce": (Reduce, lambda: {"in_file":pdb_file}),
+    }
+    tools = list(all_tools.keys()) if tools is None else tools
+
+    results = []
+    for name in tools:
+        tool_cls, get_kwds = all_tools[name]
+        modes = []
+        if USE_DOCKER or USE_SINGULARITY:
+            modes.append("container")
+        if find_local_tool(tool_cls) is not None:
+            modes.append("local")
+
+        for mode in modes:
+            tool = tool_cls(work_dir=work_dir, force_local=mode=="local", prefer_local=False)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                try:
+                    tool(**get_kwds())
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception as e:
+                    RealtimeLogger.info(f"{name} failed in {mode}: {e}")
+                    times = None
+                    break
+                times.append(time.perf_counter()-start)
+
+            if times is None:
+                results.append({"tool":name, "mode":mode, "mean":None, "min":None})
+            else:
+                results.append({"tool":name, "mode":mode, "mean":sum(times)/len(times), "min":min(times)})
+
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare container and local tool run times")
+    parser.add_argument("pdb_file")
+    parser.add_argument("--tools", nargs="+", default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'tool':<10}{'mode':<12}{'mean (s)':>10}{'min (s)':>10}")
+    for r in benchmark_tools(args.pdb_file, tools=args.tools, repeats=args.repeats):
+        if r["mean"] is None:
+            print(f"{r['tool']:<10}{r['mode']:<12}{'failed':>10}{'':>10}")
+        else:
+            print(f"{r['tool']:<10}{r['mode']:<12}{r['mean']:>10.3f}{r['min']:>10.3f}")
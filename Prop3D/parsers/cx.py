@@ -6,12 +6,19 @@ from Prop3D.parsers.container import Container
 class CX(Container):
     IMAGE = 'docker://edraizen/cx:latest'
     LOCAL = ["cx"]
+    SESSION_SAFE = True
     PARAMETERS = [("in_file", "path:in:stdin")]
 
     def get_concavity(self, pdb_file):
         cx_f = self(in_file=pdb_file)
         return self.parse_cx(cx_f.splitlines())
 
+    def get_concavity_batch(self, pdb_files):
+        """Run CX on many structures in one container. Returns parsed results for each
+        file (None if it failed) and a dict of failed indices to errors"""
+        results, errors = self.map([{"in_file":pdb_file} for pdb_file in pdb_files])
+        return [self.parse_cx(r.splitlines()) if r is not None else None for r in results], errors
+
     @staticmethod
     def parse_cx(cx_file):
         """cx_file: FIle-like object or list of lines
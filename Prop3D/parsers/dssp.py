@@ -8,6 +8,8 @@ from Prop3D.util.pdb import remove_ter_lines as _remove_ter_lines
 class DSSP(Container):
     IMAGE = 'docker://edraizen/dssp:latest'
     LOCAL = ["dssp"]
+    LOCAL_MIN_VERSION = "2.0"
+    SESSION_SAFE = True
     PARAMETERS = [
         ("in_file", "path:in", "i"),
         ("out_file", "path:out", "o")]
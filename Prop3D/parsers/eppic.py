@@ -336,11 +336,11 @@ class EPPICLocal(Container):
                 self(input_file=pdb_file, s=s, p=p, l=l)
                 self.eppic_files = [os.path.basename(f) for f in \
                     glob.glob("{}.*".format(os.path.splitext(self.pdb)[0]))]
-                for f in self.eppic_files:
-                    eppic_local_store.write_output_file(f, "{}/{}".format(self.pdb.lower(), f))
+                eppic_local_store.write_output_files([(f, "{}/{}".format(self.pdb.lower(), f)) \
+                    for f in self.eppic_files])
             else:
-                for f in self.eppic_files:
-                    eppic_local_store.read_input_file(f, os.path.join(self.work_dir, f))
+                eppic_local_store.read_input_files([(f, os.path.join(self.work_dir, f)) \
+                    for f in self.eppic_files], raise_errors=True)
         else:
             #If not pdb id, just run and dont store/check in s3
             self(input_file=self.pdb, s=s, p=p, l=l)
@@ -23,6 +23,7 @@ class WebService(object):
         self.max_attempts = max_attempts
         #self.get = memory.cache(self.get)
         self.files = {}
+        self._prefetched = set()
 
     def __get__(self, key):
         return self.get(key)
@@ -30,6 +31,13 @@ class WebService(object):
     def __del__(self):
         self.clean()
 
+        #Prefetched files that were never used
+        for key in getattr(self, "_prefetched", ()):
+            try:
+                os.remove(self.local_file(key))
+            except OSError:
+                pass
+
     def clean(self):
         if not hasattr(self, 'files'):
             return 
@@ -59,28 +67,47 @@ class WebService(object):
     def __get__(self, key):
         return self.get(key)
 
+    def normalize_key(self, key):
+        if isinstance(key, (list, tuple)):
+            return "/".join(self.fix_key(str(k)) for k in key)
+        elif isinstance(key, str):
+            return self.fix_key(key)
+        raise KeyError(key)
+
+    def local_file(self, key):
+        return os.path.join(self.work_dir, "{}-{}{}".format(
+            self.store.store_name.replace("/", "-"), key.replace("/", "-"),
+            self.extension(key)))
+
+    def prefetch(self, keys, workers=None):
+        """Read many keys from the store at once (see IOStore.read_input_files) so
+        later calls to get only parse the local files. Keys that are not in the
+        store are skipped and downloaded by get as usual. Returns a TransferReport"""
+        keys = {self.normalize_key(key) for key in keys}
+        files = [(key, self.local_file(key)) for key in sorted(keys) \
+            if not os.path.isfile(self.local_file(key))]
+        report = self.store.read_input_files(files, workers=workers)
+        self._prefetched.update(key for key, _ in report.succeeded)
+        return report
+
     def get(self, key, attempts=None, last_source=None):
         if attempts is None:
             attempts = self.max_attempts
 
-        if isinstance(key, (list, tuple)):
-            key = "/".join(self.fix_key(str(k)) for k in key)
-        elif isinstance(key, str):
-            key = self.fix_key(key)
-        else:
-            raise KeyError(key)
+        key = self.normalize_key(key)
 
         store_key = "{}{}".format(key, self.extension(key))
-        fname = os.path.join(self.work_dir, "{}-{}{}".format(
-            self.store.store_name.replace("/", "-"), key.replace("/", "-"),
-            self.extension(key)))
+        fname = self.local_file(key)
 
         #Check if file should be download or get from store
         if os.path.isfile(fname) and not last_source=="local":
             #File already exists or previosly downloaded in this session
             RealtimeLogger.info("API read from file")
             source = "local"
-            should_remove = False #If previosly downloaded in this session, it will not remove
+            #If previosly downloaded in this session, it will not remove. Prefetched
+            #files are removed after use like files read from the store
+            should_remove = key in self._prefetched
+            self._prefetched.discard(key)
         elif self.store.exists(key) and not last_source=="IOStore":
             RealtimeLogger.info("API get from store")
             self.store.read_input_file(key, fname)
@@ -133,6 +133,14 @@ class Pdb2pqr(Container):
 
     @staticmethod
     def parse_pqr(pqr_file):
+        for key, coord, charge, radius in Pdb2pqr.parse_pqr_records(pqr_file):
+            yield key, charge
+
+    @staticmethod
+    def parse_pqr_records(pqr_file):
+        """Parse each atom in a pqr file into its Bio.PDB atom id, coordinates,
+        charge, and radius
+        """
         with open(pqr_file) as pqr:
             for line in pqr:
                 if not line.startswith("ATOM  ") or line.startswith("HETATM"): continue
@@ -166,5 +174,4 @@ class Pdb2pqr(Container):
 
                 key = (residue_id, (atomName.strip(), ' '))
 
-                yield key, float(charge)
-                #result[key] = (float(charge), electrostatic_potential)
+                yield key, (float(X), float(Y), float(Z)), float(charge), float(radius)
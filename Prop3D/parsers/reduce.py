@@ -39,6 +39,7 @@ class Reduce(Container):
     IMAGE = 'docker://edraizen/reduce:latest'
     LOCAL = ["reduce"]
     ENTRYPOINT = "/opt/reduce/reduce"
+    SESSION_SAFE = True
     PARAMETERS = [
         (":trim", "store_true", ["-Trim"]),
         (":his", "store_true", ["-HIS"]),
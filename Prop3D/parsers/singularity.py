@@ -182,7 +182,8 @@ def apiSingularityCall(job,
             bind = []
 
         if isinstance(volumes, dict):
-            bind += ["{}:{}".format(host_path, container_path["bind"]) for \
+            bind += ["{}:{}{}".format(host_path, container_path["bind"],
+                ":ro" if container_path.get("mode") == "ro" else "") for \
                 host_path, container_path in volumes.items()]
 
     if len(bind) == 0:
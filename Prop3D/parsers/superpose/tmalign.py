@@ -43,7 +43,7 @@ class TMAlign(Superpose):
 
     def make_file_list(self, key, file_list, format_in_path=True):
         file_list = super().make_file_list(key, file_list, format_in_path=format_in_path, basename=False)
-        chain_folder = self.work_dir if self.is_local else "/data/"
+        chain_folder = self.work_dir if self.is_local else self.CONTAINER_FILE_PREFIX
         if not chain_folder.endswith("/"):
             chain_folder += "/"
         return [chain_folder, file_list]
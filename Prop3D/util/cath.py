@@ -7,12 +7,11 @@ from Prop3D.parsers.cath import CATHApi
 from Prop3D.util.hdf import get_file, filter_hdf, filter_hdf_chunks
 from Prop3D.util.toil import map_job
 from Prop3D.util import safe_remove
+from Prop3D.util.hsds import hsds_file
 from Prop3D.generate_data.data_stores import data_stores
 
 from toil.realtimeLogger import RealtimeLogger
 
-import h5pyd
-
 def fix_cathcode(c):
     if isinstance(cathcode, (int, float, str)):
         try:
@@ -225,7 +224,7 @@ def run_cath_hierarchy_h5(job, cathcode, func, path, *args, **kwds):
         #cathcode = dict(zip(cath_names, cathcode))
         #RealtimeLogger.info("Loading cathcde 2 {}".format(cathcode))
 
-        with h5pyd.File(path, 'r', use_cache=False, retries=100) as cath_file:
+        with hsds_file(path, 'r') as cath_file:
             cathcodes = pd.DataFrame(
                 [cathcode+[c] for c in cath_file["/"+"/".join(cathcode)].keys()],
                 columns=cath_names[:len(cathcode)+1])
@@ -0,0 +1,223 @@
+"""Read APBS OpenDX potential maps, cache them per domain, and sample them at
+arbitrary coordinates with vectorized trilinear interpolation. Once a domain's map
+is cached, potentials at new points (voxel centers, docking poses) do not need
+another APBS run.
+"""
+import os
+import json
+import uuid
+from typing import Union, Callable
+
+import numpy as np
+
+from toil.realtimeLogger import RealtimeLogger
+
+class DXGrid(object):
+    """A regular, axis aligned 3D grid of values, e.g. the electrostatic potential from APBS
+
+    Parameters
+    ----------
+    data : (nx, ny, nz) array
+        Values at each grid point, x changes slowest as in the DX format
+    origin : 3-vector
+        Coordinate of the first grid point
+    spacing : 3-vector
+        Distance between grid points along x, y and z
+    """
+    def __init__(self, data: np.array, origin: np.array, spacing: np.array) -> None:
+        self.data = data
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        self.shape = np.array(data.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    @classmethod
+    def read(cls, dx_file: str) -> "DXGrid":
+        """Parse an OpenDX file written by APBS ('write pot dx')
+
+        Parameters
+        ----------
+        dx_file : str
+            Path to dx file
+        """
+        counts = origin = None
+        deltas = []
+        with open(dx_file) as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                fields = line.split()
+                if line.startswith("object 1"):
+                    counts = [int(n) for n in fields[-3:]]
+                elif fields[0] == "origin":
+                    origin = [float(n) for n in fields[1:4]]
+                elif fields[0] == "delta":
+                    deltas.append([float(n) for n in fields[1:4]])
+                elif line.startswith("object 3"):
+                    break
+
+            if counts is None or origin is None or len(deltas) != 3:
+                raise RuntimeError(f"Invalid dx file: {dx_file}")
+
+            deltas = np.array(deltas)
+            if not np.allclose(deltas, np.diag(np.diag(deltas))):
+                raise RuntimeError("Only axis aligned dx grids are supported")
+
+            #Values are written 3 per line until the trailing 'attribute'/'object' lines
+            n = int(np.prod(counts))
+            data = np.fromstring(f.read().split("attribute", 1)[0].split("object", 1)[0],
+                sep=" ", dtype=np.float32)
+
+        if len(data) != n:
+            raise RuntimeError(f"Invalid dx file: expected {n} values, got {len(data)}")
+
+        return cls(data.reshape(counts), origin, np.diag(deltas))
+
+    def interpolate(self, points: np.array, fill_value: float = np.nan, chunk_size: int = 1000000) -> np.array:
+        """Evaluate the grid at any coordinates with trilinear interpolation
+
+        Parameters
+        ----------
+        points : (n, 3) array
+            Coordinates in the same frame as the grid
+        fill_value : float
+            Value for points outside of the grid. Default NaN
+        chunk_size : int
+            Number of points to evaluate at a time, limits memory use
+
+        Returns
+        -------
+        (n,) array of interpolated values
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        values = np.full(len(points), fill_value, dtype=np.float64)
+
+        for start in range(0, len(points), chunk_size):
+            #Fractional grid index of each point
+            index = (points[start:start+chunk_size]-self.origin)/self.spacing
+            inside = np.all((index >= 0) & (index <= self.shape-1), axis=1)
+            index = index[inside]
+
+            #Lower corner of the enclosing cell, clipped so points on the last
+            #plane use the last cell
+            lower = np.minimum(np.floor(index).astype(np.int64), np.maximum(self.shape-2, 0))
+            frac = index-lower
+            x, y, z = lower.T
+            x1, y1, z1 = [np.minimum(c+1, s-1) for c, s in zip((x, y, z), self.shape)]
+            fx, fy, fz = frac.T
+
+            c00 = self.data[x, y, z]*(1-fx)+self.data[x1, y, z]*fx
+            c10 = self.data[x, y1, z]*(1-fx)+self.data[x1, y1, z]*fx
+            c01 = self.data[x, y, z1]*(1-fx)+self.data[x1, y, z1]*fx
+            c11 = self.data[x, y1, z1]*(1-fx)+self.data[x1, y1, z1]*fx
+            c0 = c00*(1-fy)+c10*fy
+            c1 = c01*(1-fy)+c11*fy
+
+            chunk_values = values[start:start+chunk_size]
+            chunk_values[inside] = c0*(1-fz)+c1*fz
+            values[start:start+chunk_size] = chunk_values
+
+        return values
+
+class DXCache(object):
+    """A local on disk cache of DX grids, keyed by domain. Grids are stored as
+    raw arrays and memory mapped when read, so a cached map loads in milliseconds.
+    The least recently used grids are removed when the cache grows past max_size.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        Where to save grids. If None, use ~/.cache/Prop3D/dx
+    max_size : int
+        Maximum size of the cache in bytes. Default 2GB
+    """
+    def __init__(self, cache_dir: Union[str, None] = None, max_size: int = 2*1024**3) -> None:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "Prop3D", "dx")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        key = key.strip("/").replace("/", "_")
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isfile(self._path(key)+".json")
+
+    def get(self, key: str) -> Union[DXGrid, None]:
+        """Get a cached grid, or None if it is not in the cache"""
+        path = self._path(key)
+        try:
+            with open(path+".json") as f:
+                meta = json.load(f)
+            data = np.load(path+".npy", mmap_mode="r")
+        except (IOError, ValueError):
+            return None
+
+        #Mark as recently used
+        os.utime(path+".json")
+
+        return DXGrid(data, meta["origin"], meta["spacing"])
+
+    def put(self, key: str, grid: DXGrid) -> None:
+        """Save a grid into the cache, then evict old grids if the cache is too large"""
+        path = self._path(key)
+
+        #Write to temporary files first so readers never see partial grids
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        np.save(tmp+".npy", np.asarray(grid.data))
+        with open(tmp+".json", "w") as f:
+            json.dump({"origin": grid.origin.tolist(), "spacing": grid.spacing.tolist()}, f)
+        os.replace(tmp+".npy", path+".npy")
+        os.replace(tmp+".json", path+".json")
+
+        self.evict()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Union[str, DXGrid]]) -> DXGrid:
+        """Get a cached grid or calculate and cache it
+
+        Parameters
+        ----------
+        key : str
+            Unique name for the grid, e.g. the domain name
+        compute : callable
+            Function run on a cache miss that returns a DXGrid or the path to a dx file
+        """
+        grid = self.get(key)
+        if grid is not None:
+            return grid
+
+        RealtimeLogger.info(f"DX cache miss for {key}")
+        grid = compute()
+        if isinstance(grid, str):
+            grid = DXGrid.read(grid)
+        self.put(key, grid)
+        return grid
+
+    def evict(self) -> None:
+        """Remove the least recently used grids until the cache is smaller than max_size"""
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(".json") or fname.endswith(".tmp.json"):
+                continue
+            path = os.path.join(self.cache_dir, fname[:-5])
+            try:
+                entries.append((os.path.getmtime(path+".json"), os.path.getsize(path+".npy"), path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            for ext in (".json", ".npy"):
+                try:
+                    os.remove(path+ext)
+                except OSError:
+                    pass
+            total -= size
+            RealtimeLogger.info(f"Evicted {path} from DX cache")
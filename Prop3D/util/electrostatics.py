@@ -0,0 +1,127 @@
+"""Fast approximate electrostatic potentials (Coulomb / Debye-Hückel) from pdb2pqr
+charges, an in-process alternative to solving the Poisson-Boltzmann equation with APBS.
+
+Potentials are returned in kT/e at each atom center, the same units as the APBS
+atompot output, so they can be used with the same thresholds. The potential at an
+atom excludes its own charge.
+"""
+from typing import Union, Any
+
+import numpy as np
+from scipy import spatial
+
+from Prop3D.parsers.pdb2pqr import Pdb2pqr
+
+#Coulomb constant in kcal*A/(mol*e^2) and Boltzmann constant in kcal/(mol*K)
+COULOMB_CONSTANT = 332.0636
+BOLTZMANN_CONSTANT = 0.0019872041
+AVOGADRO = 6.02214076e23
+
+electrostatics_methods = ("apbs", "coulomb", "debye_huckel")
+
+def bjerrum_length(dielectric: float = 78.54, temperature: float = 298.15) -> float:
+    """Distance (Angstroms) at which the interaction of two unit charges equals kT"""
+    return COULOMB_CONSTANT/(BOLTZMANN_CONSTANT*temperature*dielectric)
+
+def debye_kappa(ionic_strength: float = 0.15, solvent_dielectric: float = 78.54, temperature: float = 298.15) -> float:
+    """Inverse Debye screening length (1/Angstroms) for an ionic strength in molar"""
+    #kappa^2 = 8*pi*l_B*N_A*I, with I converted from mol/L to molecules/A^3
+    return np.sqrt(8*np.pi*bjerrum_length(solvent_dielectric, temperature)*AVOGADRO*ionic_strength*1e-27)
+
+def screened_coulomb_potential(coords: np.array, charges: np.array, dielectric: float = 2.0, ionic_strength: float = 0.15,
+                               cutoff: Union[float, None] = None, solvent_dielectric: float = 78.54,
+                               temperature: float = 298.15, chunk_size: int = 1000) -> np.array:
+    """Calculate the Debye-Hückel screened Coulomb potential at each atom:
+
+    phi_i = l_B/eps * sum_j!=i q_j exp(-kappa r_ij)/r_ij
+
+    Parameters
+    ----------
+    coords : (n, 3) array
+        Atom coordinates
+    charges : (n,) array
+        Partial charges, e.g. from pdb2pqr
+    dielectric : float
+        Dielectric constant for the direct interaction. Default 2.0, the same as the
+        solute dielectric in the APBS input (see APBS.make_apbs_electrostatics_input)
+    ionic_strength : float
+        Ionic strength in molar used for screening. If 0, this is a plain Coulomb potential
+    cutoff : float or None
+        Ignore pairs further than cutoff Angstroms, found with a KD-tree. Only faster for
+        very large structures. If None (default), all pairs are evaluated in chunks of rows
+    solvent_dielectric : float
+        Dielectric constant of the solvent, only used for the screening length
+    temperature : float
+        Temperature in Kelvin
+    chunk_size : int
+        Number of atoms per chunk when cutoff is None
+
+    Returns
+    -------
+    (n,) array of potentials in kT/e
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    charges = np.asarray(charges, dtype=np.float64)
+    n_atoms = len(coords)
+    scale = bjerrum_length(dielectric, temperature)
+    kappa = debye_kappa(ionic_strength, solvent_dielectric, temperature) if ionic_strength > 0 else 0.
+
+    if cutoff is not None:
+        pairs = spatial.cKDTree(coords).query_pairs(r=cutoff, output_type="ndarray")
+        i, j = pairs[:, 0], pairs[:, 1]
+        r = np.linalg.norm(coords[i]-coords[j], axis=1)
+        keep = r > 0
+        i, j, r = i[keep], j[keep], r[keep]
+        kernel = np.exp(-kappa*r)/r
+        potential = np.bincount(i, weights=charges[j]*kernel, minlength=n_atoms)
+        potential += np.bincount(j, weights=charges[i]*kernel, minlength=n_atoms)
+    else:
+        potential = np.zeros(n_atoms)
+        for start in range(0, n_atoms, chunk_size):
+            block = coords[start:start+chunk_size]
+            r = spatial.distance.cdist(block, coords)
+            with np.errstate(divide="ignore"):
+                kernel = np.where(r > 0, np.exp(-kappa*r)/r, 0.)
+            potential[start:start+chunk_size] = kernel @ charges
+
+    return scale*potential
+
+def get_atom_potentials_from_pqr(pqr_file: str, method: str = "debye_huckel", with_charge: bool = True,
+                                 **kwds: Any) -> dict[tuple, Union[float, tuple[float, float]]]:
+    """Calculate approximate potentials for each atom in a pqr file. Output has the same
+    format as APBS.get_atom_potentials_from_pqr.
+
+    Parameters
+    ----------
+    pqr_file : str
+        Path to pqr file from pdb2pqr
+    method : "coulomb" or "debye_huckel"
+        "coulomb" ignores ionic screening
+    with_charge : bool
+        Return charge with the potential
+    **kwds :
+        Passed to screened_coulomb_potential
+
+    Returns
+    -------
+    A dict of Bio.PDB atom ids (residue_id, (atom name, altloc)) to (charge, potential)
+    if with_charge else potential
+    """
+    if method == "coulomb":
+        kwds["ionic_strength"] = 0.
+    elif method != "debye_huckel":
+        raise ValueError("Unknown electrostatics method: {}".format(method))
+
+    atoms, coords, charges = [], [], []
+    for key, coord, charge, radius in Pdb2pqr.parse_pqr_records(pqr_file):
+        atoms.append(key)
+        coords.append(coord)
+        charges.append(charge)
+
+    potentials = screened_coulomb_potential(np.array(coords).reshape(-1, 3), charges, **kwds)
+
+    if with_charge:
+        return {atom:(charge, potential) for atom, charge, potential in \
+            zip(atoms, charges, potentials)}
+    else:
+        return dict(zip(atoms, potentials))
@@ -0,0 +1,231 @@
+"""A per-process pool of open HSDS files. Opening an h5pyd.File is an HTTP round trip
+plus domain metadata requests, so jobs running in the same worker share one handle
+(and its keep-alive HTTP session) for each endpoint, domain, and mode instead of
+opening a new file for every table. h5pyd is not thread safe, so each thread gets its
+own handles; handles of threads that have exited are closed when a new one is opened,
+and the rest when the worker exits.
+
+Local HDF5 files (see Prop3D.util.local_h5) can be used anywhere an HSDS domain is
+expected, hsds_file and call_h5 open them with the local backend instead.
+"""
+import os
+import atexit
+import threading
+from contextlib import contextmanager
+from typing import Union, Any, Iterator, Callable
+
+try:
+    import h5pyd
+except ImportError:
+    #Only needed when HSDS files are opened
+    h5pyd = None
+
+from toil.realtimeLogger import RealtimeLogger
+
+from Prop3D.util.local_h5 import is_local_h5, open_local_h5, locked_local_h5, call_local_h5, file_lock
+
+#Open handles keyed by (endpoint, domain, mode, thread id)
+_pool = {}
+_pool_lock = threading.RLock()
+_pool_pid = os.getpid()
+
+#Modes that change the file when opened are never shared
+UNPOOLED_MODES = ("w", "w-", "x")
+
+#Largest request body accepted in front of HSDS if the server does not report it.
+#The nginx proxy used with HSDS rejects larger bodies with 'Request Entity Too Large'
+DEFAULT_MAX_REQUEST_SIZE = 1024**2
+
+_max_request_size = None
+
+def get_max_request_size() -> int:
+    """Get the largest request (bytes) that can be sent to HSDS, from HSDS_MAX_REQUEST_SIZE,
+    the server info, or DEFAULT_MAX_REQUEST_SIZE"""
+    global _max_request_size
+    if _max_request_size is None:
+        size = os.environ.get("HSDS_MAX_REQUEST_SIZE")
+        if size is None:
+            try:
+                size = h5pyd.getServerInfo().get("max_request_size")
+            except Exception:
+                size = None
+        _max_request_size = int(size) if size is not None else DEFAULT_MAX_REQUEST_SIZE
+    return _max_request_size
+
+def get_endpoint(endpoint: Union[str, None] = None) -> Union[str, None]:
+    """Get the HSDS endpoint used by h5pyd if not given"""
+    if endpoint is not None:
+        return endpoint
+    return os.environ.get("HS_ENDPOINT")
+
+def _is_open(f: "h5pyd.File") -> bool:
+    try:
+        return f.id is not None and f.id.http_conn is not None
+    except AttributeError:
+        return True
+
+def _close_dead_threads() -> None:
+    """Close handles opened by threads that have exited, call with _pool_lock held"""
+    alive = {t.ident for t in threading.enumerate()}
+    for key in [key for key in _pool if key[3] not in alive]:
+        f = _pool.pop(key)
+        try:
+            if key[2] != "r":
+                f.flush()
+            f.close()
+        except Exception as e:
+            RealtimeLogger.info(f"Unable to close HSDS file {key[1]}: {e}")
+
+def get_hsds_file(path: str, mode: str = "r", endpoint: Union[str, None] = None, use_cache: bool = False,
+                  retries: int = 100, **kwds: Any) -> "h5pyd.File":
+    """Get an open HSDS file from the pool or open a new one. Handles are only shared
+    within a thread. Do not close the returned file, it is closed by close_hsds_files
+    when the process exits.
+
+    Parameters
+    ----------
+    path : str
+        HSDS domain, e.g. /home/user/Prop3D.h5
+    mode : str
+        File mode. Read requests use a writable handle if one is already open
+    endpoint : str or None
+        HSDS endpoint. Default: HS_ENDPOINT from environment or h5pyd config
+    use_cache : bool
+        Passed to h5pyd.File
+    retries : int
+        Passed to h5pyd.File
+    **kwds :
+        Other arguments to h5pyd.File
+    """
+    global _pool_pid
+
+    if h5pyd is None:
+        raise ImportError("h5pyd must be installed to use HSDS")
+
+    endpoint = get_endpoint(endpoint)
+    if endpoint is not None:
+        kwds["endpoint"] = endpoint
+
+    if mode in UNPOOLED_MODES:
+        return h5pyd.File(path, mode=mode, use_cache=use_cache, retries=retries, **kwds)
+
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            #Forked, connections belong to the parent process
+            _pool.clear()
+            _pool_pid = os.getpid()
+
+        thread = threading.get_ident()
+        keys = [(endpoint, path, mode, thread)]
+        if mode == "r":
+            keys += [(endpoint, path, "a", thread), (endpoint, path, "r+", thread)]
+
+        for key in keys:
+            f = _pool.get(key)
+            if f is not None:
+                if _is_open(f):
+                    return f
+                del _pool[key]
+
+        _close_dead_threads()
+        f = h5pyd.File(path, mode=mode, use_cache=use_cache, retries=retries, **kwds)
+        _pool[(endpoint, path, mode, thread)] = f
+        return f
+
+def get_thread_file(store: Any) -> Any:
+    """Get a handle to the same HSDS domain as store that is only used by the current
+    thread, for thread pools working on a file opened by their caller. Local h5py
+    files are returned as is, h5py serializes calls with its own lock"""
+    if h5pyd is None or not isinstance(store, h5pyd.File):
+        return store
+    try:
+        endpoint = store.id.http_conn.endpoint
+    except AttributeError:
+        endpoint = None
+    return get_hsds_file(store.filename, mode=store.mode, endpoint=endpoint)
+
+@contextmanager
+def hsds_file(path: str, mode: str = "r", endpoint: Union[str, None] = None, **kwds: Any) -> Iterator["h5pyd.File"]:
+    """Use a pooled HSDS file in a with statement like h5pyd.File. The file stays open
+    afterwards for later jobs, unless there was an error while using it. Local files
+    are opened for reading with SWMR or for writing while holding the lock file. The
+    writer cannot open a local file while it is open for reading, so keep the with
+    statement short or use call_h5 with mode="r"
+
+    Parameters
+    ----------
+    See get_hsds_file
+    """
+    if is_local_h5(path):
+        if mode == "r":
+            #Do not open while a write is in progress
+            with file_lock(path):
+                f = open_local_h5(path, "r")
+            try:
+                yield f
+            finally:
+                f.close()
+        else:
+            with locked_local_h5(path, mode) as f:
+                yield f
+        return
+
+    f = get_hsds_file(path, mode=mode, endpoint=endpoint, **kwds)
+    try:
+        yield f
+    except OSError:
+        #HTTP error, connection may be in a bad state so open a new one next time
+        discard_hsds_file(f)
+        raise
+    finally:
+        if mode in UNPOOLED_MODES:
+            f.close()
+
+def call_h5(path: str, func: Callable, *args: Any, mode: str = "a", **kwds: Any) -> Any:
+    """Run func(store, *args, **kwds) on an HSDS domain or local HDF5 file. Local
+    writes are sent to the single writer process if one is running (see
+    Prop3D.util.local_h5), so func must be defined at the top level of a module
+
+    Parameters
+    ----------
+    path : str
+        HSDS domain or local h5 file
+    func : callable
+        Function to run, the open file is the first argument
+    mode : str
+        File mode
+    """
+    if is_local_h5(path):
+        return call_local_h5(path, func, *args, mode=mode, **kwds)
+
+    with hsds_file(path, mode=mode) as store:
+        return func(store, *args, **kwds)
+
+def discard_hsds_file(f: "h5pyd.File") -> None:
+    """Remove a file from the pool and close it"""
+    with _pool_lock:
+        for key, pooled in list(_pool.items()):
+            if pooled is f:
+                del _pool[key]
+    try:
+        f.close()
+    except Exception:
+        pass
+
+def close_hsds_files() -> None:
+    """Close all pooled HSDS files, called automatically when the process exits"""
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool.clear()
+            return
+
+        while len(_pool) > 0:
+            (endpoint, path, mode, _), f = _pool.popitem()
+            try:
+                if mode != "r":
+                    f.flush()
+                f.close()
+            except Exception as e:
+                RealtimeLogger.info(f"Unable to close HSDS file {path}: {e}")
+
+atexit.register(close_hsds_files)
@@ -36,18 +36,112 @@ import time
 import dateutil
 import traceback
 import stat
+import errno
 from toil.realtimeLogger import RealtimeLogger
-import subprocess
 import datetime
 import json
-import subprocess
 import shutil
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+#How FileIOStore.read_input_file gives local paths to files in the store: 'auto' tries
+#reflink, hardlink, symlink, then copy; or force one of 'reflink', 'hardlink', 'symlink', 'copy'
+IOSTORE_LINK_MODE = os.environ.get("IOSTORE_LINK_MODE", "auto").lower()
+
+LINK_METHODS = ("reflink", "hardlink", "symlink", "copy")
+
+#Linux ioctl to share extents between files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+#Errors meaning a method never works on a filesystem, others may only affect one file
+UNSUPPORTED_LINK_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
+#Methods that failed for a (source device, destination device), so they are not tried again
+_unsupported_links = collections.defaultdict(set)
+
+#Bytes read from FileIOStores in this process by each method
+_read_bytes = {method: 0 for method in LINK_METHODS}
+_read_bytes_lock = threading.Lock()
+
+def get_read_bytes():
+    """Get the number of bytes FileIOStores in this process returned with each method.
+    Everything except 'copy' is data that did not need to be copied"""
+    with _read_bytes_lock:
+        stats = dict(_read_bytes)
+    stats["saved"] = sum(v for k, v in stats.items() if k != "copy")
+    return stats
+
+def reflink(src, dst):
+    """Copy a file by sharing its data blocks (copy-on-write) if the filesystem supports it"""
+    if not sys.platform.startswith("linux"):
+        raise OSError("reflinks are only supported on linux")
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+#Number of files transferred at once by read_input_files and write_output_files
+IOSTORE_WORKERS = int(os.environ.get("IOSTORE_WORKERS", 8))
+
+#S3 files larger than the threshold are sent in parts of S3_MULTIPART_CHUNKSIZE bytes,
+#S3_MULTIPART_CONCURRENCY parts of each file at a time
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 64*1024**2))
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 16*1024**2))
+S3_MULTIPART_CONCURRENCY = int(os.environ.get("S3_MULTIPART_CONCURRENCY", 4))
+
+class TransferReport(object):
+    """
+    Result of a batch of transfers from read_input_files or write_output_files.
+    succeeded lists the (source, destination) pairs that were transferred and
+    failed maps the pairs that were not to their exception.
+
+    """
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.succeeded = []
+        self.failed = {}
+        self.bytes = 0
+        self.seconds = 0.
+
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+    def raise_for_errors(self):
+        if not self.ok:
+            raise BatchTransferError(self)
+
+    def __str__(self):
+        return "{} {} files ({:.1f} MB) in {:.1f}s, {} failed".format(
+            self.direction, len(self.succeeded), self.bytes/1024**2, self.seconds,
+            len(self.failed))
+
+class BatchTransferError(RuntimeError):
+    """
+    Raised after a batch transfer if any file failed, the full TransferReport
+    is in the report attribute.
+
+    """
+
+    def __init__(self, report, max_listed=10):
+        self.report = report
+        failed = list(report.failed.items())
+        lines = ["  {} -> {}: {}".format(src, dst, e) for (src, dst), e in failed[:max_listed]]
+        if len(failed) > max_listed:
+            lines.append("  and {} more".format(len(failed)-max_listed))
+        super().__init__("\n".join([str(report)]+lines))
 
 # Need stuff for Amazon s3
 try:
     import boto3
     import botocore
+    from boto3.s3.transfer import TransferConfig
     have_s3 = True
 except ImportError:
     have_s3 = False
@@ -230,12 +324,106 @@ class IOStore(object):
 
         raise NotImplementedError()
 
-    def write_output_directory(self, local_direcotry, output_directory=""):
-        for dirpath, dirnames, filenames in os.walk(local_direcotry):
+    def read_input_files(self, files, workers=None, raise_errors=False):
+        """
+        Read many input files at once. files is a list of (input_path,
+        local_path) pairs, or input paths to read to the same relative local
+        path. Missing local directories are created.
+
+        Files are read with read_input_file on a pool of workers threads
+        (default IOSTORE_WORKERS) sharing this store's connection. Returns a
+        TransferReport; files that fail are listed in it without stopping the
+        rest of the batch. If raise_errors is True, a BatchTransferError is
+        raised after the batch if any file failed.
+
+        """
+
+        return self._transfer_files(self._read_one, files, "Read", workers=workers,
+            raise_errors=raise_errors)
+
+    def write_output_files(self, files, workers=None, raise_errors=False):
+        """
+        Write many output files at once. files is a list of (local_path,
+        output_path) pairs, or local paths to write to the same relative output
+        path.
+
+        Files are written with write_output_file on a pool of workers threads
+        (default IOSTORE_WORKERS), see read_input_files for the report and errors.
+
+        """
+
+        return self._transfer_files(self._write_one, files, "Wrote", workers=workers,
+            raise_errors=raise_errors)
+
+    def _read_one(self, input_path, local_path):
+        parent_dir = os.path.dirname(local_path)
+        if parent_dir != "":
+            robust_makedirs(parent_dir)
+        self.read_input_file(input_path, local_path)
+        return os.path.getsize(local_path)
+
+    def _write_one(self, local_path, output_path):
+        self.write_output_file(local_path, output_path)
+        return os.path.getsize(local_path)
+
+    def _transfer_files(self, transfer, files, direction, workers=None, raise_errors=False):
+        """Run transfer(source, destination) for each pair on a thread pool"""
+        files = [(f, f) if isinstance(f, str) else tuple(f) for f in files]
+        workers = IOSTORE_WORKERS if workers is None else workers
+
+        report = TransferReport(direction)
+        start = time.time()
+
+        if len(files) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(files)))) as pool:
+                futures = {pool.submit(transfer, src, dst): (src, dst) for src, dst in files}
+                for future in as_completed(futures):
+                    pair = futures[future]
+                    try:
+                        report.bytes += future.result() or 0
+                        report.succeeded.append(pair)
+                    except Exception as e:
+                        RealtimeLogger.debug("Failed transfer {} -> {}: {}".format(*pair, e))
+                        report.failed[pair] = e
+
+        report.seconds = time.time()-start
+        RealtimeLogger.info("{} {}".format(self.store_string, report))
+
+        if raise_errors:
+            report.raise_for_errors()
+
+        return report
+
+    def download_input_directory(self, prefix, local_dir, postfix=None, workers=None):
+        """
+        Read all files under prefix (ending with postfix if given) into
+        local_dir, keeping their relative paths. Returns a TransferReport and
+        raises a BatchTransferError if any file failed.
+
+        """
+
+        files = [(os.path.join(prefix, f), os.path.join(local_dir, f)) for f in \
+            self.list_input_directory(prefix, recursive=True) if \
+            postfix is None or f.endswith(postfix)]
+        return self.read_input_files(files, workers=workers, raise_errors=True)
+
+    def write_output_directory(self, local_directory, output_directory="", postfix=None, workers=None):
+        """
+        Write all files in local_directory (ending with postfix if given) under
+        output_directory, keeping their relative paths. Returns a TransferReport
+        and raises a BatchTransferError if any file failed.
+
+        """
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(local_directory):
             for f in filenames:
+                if postfix is not None and not f.endswith(postfix):
+                    continue
                 fpath = os.path.join(dirpath, f)
-                key = fpath[len(direcotry):]
-                self.write_output_file(fpath, output_directory+key)
+                key = os.path.relpath(fpath, local_directory)
+                files.append((fpath, os.path.join(output_directory, key)))
+        return self.write_output_files(files, workers=workers, raise_errors=True)
 
     def exists(self, path):
         """
@@ -388,15 +576,19 @@ class FileIOStore(IOStore):
 
     """
 
-    def __init__(self, path_prefix="", create=True):
+    def __init__(self, path_prefix="", create=True, link_mode=None):
         """
         Make a new FileIOStore that just treats everything as local paths,
-        relative to the given prefix.
+        relative to the given prefix. Files are read with link_mode (default
+        IOSTORE_LINK_MODE) instead of copying when possible.
 
         """
 
         self.path_prefix = self.store_name = path_prefix
         self.store_string = "file:"+path_prefix
+        self.link_mode = (link_mode or IOSTORE_LINK_MODE).lower()
+        if self.link_mode != "auto" and self.link_mode not in LINK_METHODS:
+            raise ValueError(f"Invalid link mode {self.link_mode}, must be 'auto' or one of {LINK_METHODS}")
 
         path = Path(self.path_prefix)
         if not path.is_dir():
@@ -435,17 +627,41 @@ class FileIOStore(IOStore):
                 self.path_prefix))
             raise RuntimeError("File {} missing!".format(real_path))
 
-        # Make a temporary file
-        temp_handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(local_path))
+        # Make a temporary name next to the destination
+        temp_handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(local_path) or ".")
         os.close(temp_handle)
+        os.unlink(temp_path)
 
-        # Copy to the temp file
-        shutil.copy2(real_path, temp_path)
+        # Link or copy to the temp file
+        method = self._place_file(real_path, temp_path)
 
         # Rename the temp file to the right place, atomically
-        RealtimeLogger.info("rename {} -> {}".format(temp_path, local_path))
+        RealtimeLogger.debug("{} {} -> {}".format(method, temp_path, local_path))
         os.rename(temp_path, local_path)
 
+        with _read_bytes_lock:
+            _read_bytes[method] += os.path.getsize(real_path)
+
+    def _link_methods(self, real_path, dest_dir):
+        """Methods to try for this filesystem, in order"""
+        methods = LINK_METHODS if self.link_mode == "auto" else (self.link_mode, "copy")
+        try:
+            devices = (os.stat(real_path).st_dev, os.stat(dest_dir).st_dev)
+        except OSError:
+            return ["copy"]
+
+        methods = [m for m in methods if m not in _unsupported_links[devices]]
+        if devices[0] != devices[1]:
+            #Hardlinks never work across filesystems
+            methods = [m for m in methods if m != "hardlink"]
+        return methods
+
+    def _protect(self, real_path):
+        """
+        Make a file in the store read only so it cannot be clobbered through a
+        hardlink or symlink. Returns False if it may still be writable.
+        """
+
         # Look at the file stats
         file_stats = os.stat(real_path)
 
@@ -463,11 +679,54 @@ class FileIOStore(IOStore):
                 # change permissions), ignore it.
                 pass
 
-    def download_input_directory(self, prefix, local_dir, postfix=None, force=False):
-        if force:
-            shutil.copytree(os.path.join(self.path_prefix, prefix), local_dir)
-        else:
-            os.symlink(os.path.join(self.path_prefix, prefix), local_dir)
+        #Root can still write to files without write bits
+        return not os.access(real_path, os.W_OK)
+
+    def _place_file(self, real_path, temp_path):
+        """Reflink, hardlink, symlink, or copy real_path to temp_path using the first
+        method that works on this filesystem. Returns the method used"""
+        dest_dir = os.path.dirname(os.path.abspath(temp_path))
+        devices = None
+        for method in self._link_methods(real_path, dest_dir):
+            try:
+                if method == "reflink":
+                    #Independent copy, does not need protecting
+                    reflink(real_path, temp_path)
+                elif method in ("hardlink", "symlink"):
+                    if not self._protect(real_path):
+                        #Not safe to share, but may work for other files
+                        continue
+                    if method == "hardlink":
+                        os.link(real_path, temp_path)
+                    else:
+                        os.symlink(real_path, temp_path)
+                else:
+                    shutil.copy2(real_path, temp_path)
+                return method
+            except OSError as e:
+                if method == "copy":
+                    raise
+                RealtimeLogger.debug(f"Cannot {method} {real_path}: {e}")
+                if e.errno in UNSUPPORTED_LINK_ERRORS:
+                    #Do not try again on this filesystem
+                    if devices is None:
+                        devices = (os.stat(real_path).st_dev, os.stat(dest_dir).st_dev)
+                    _unsupported_links[devices].add(method)
+                if os.path.lexists(temp_path):
+                    os.unlink(temp_path)
+
+    def download_input_directory(self, prefix, local_dir, postfix=None, force=False, workers=None):
+        """
+        Symlink the directory to local_dir, or if force (or only files ending
+        with postfix are wanted) read each file into local_dir, linking them
+        when possible (see read_input_file).
+
+        """
+
+        if force or postfix is not None:
+            return super().download_input_directory(prefix, local_dir, postfix=postfix,
+                workers=workers)
+        os.symlink(os.path.join(self.path_prefix, prefix), local_dir)
 
     def list_input_directory(self, input_path, recursive=False, with_times=False):
         """
@@ -738,8 +997,10 @@ class S3IOStore(IOStore):
                 self.bucket_name, self.region))
 
             kwds = {}
+            #One connection per part being transferred by batch reads and writes
             kwds["config"] = botocore.client.Config(signature_version='s3v4',
-                retries={"max_attempts":20})
+                retries={"max_attempts":20},
+                max_pool_connections=max(10, IOSTORE_WORKERS*S3_MULTIPART_CONCURRENCY))
 
             if "S3_ENDPOINT" in os.environ:
                 kwds["endpoint_url"] = os.environ["S3_ENDPOINT"]
@@ -759,6 +1020,10 @@ class S3IOStore(IOStore):
             # Connect to the s3 bucket service where we keep everything
             self.s3 = boto3.client('s3', self.region, **kwds)
             self.s3r = boto3.resource('s3', self.region, **kwds)
+            self.transfer_config = TransferConfig(
+                multipart_threshold=S3_MULTIPART_THRESHOLD,
+                multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                max_concurrency=S3_MULTIPART_CONCURRENCY)
             try:
                 self.s3.head_bucket(Bucket=self.bucket_name)
             except:
@@ -786,11 +1051,32 @@ class S3IOStore(IOStore):
         RealtimeLogger.debug("Loading {} from S3IOStore".format(
             input_path))
 
-        # Download the file contents.
-        self.s3.download_file(self.bucket_name, os.path.join(self.name_prefix, input_path), local_path)
+        # Download the file contents, in parts if it is large
+        self.s3.download_file(self.bucket_name, os.path.join(self.name_prefix, input_path), local_path,
+            Config=self.transfer_config)
 
         return local_path
 
+    def read_input_files(self, files, workers=None, raise_errors=False):
+        """
+        Read many files from S3 at once, see IOStore.read_input_files. All
+        threads share one client and its connection pool, and large files are
+        downloaded in parts.
+        """
+
+        # Connect before starting threads so they all use the same client
+        self.__connect()
+        return super().read_input_files(files, workers=workers, raise_errors=raise_errors)
+
+    def write_output_files(self, files, workers=None, raise_errors=False):
+        """
+        Write many files to S3 at once, see IOStore.write_output_files. Large
+        files are uploaded in parts.
+        """
+
+        self.__connect()
+        return super().write_output_files(files, workers=workers, raise_errors=raise_errors)
+
     @backoff
     def list_input_directory(self, input_path=None, recursive=False, with_times=False):
         """
@@ -821,56 +1107,82 @@ class S3IOStore(IOStore):
         for obj in bucket:
             yield get_output(obj)
 
-    def download_input_directory(self, prefix, local_dir, postfix=None):
-        return self.sync_directory(local_dir, local_dir, postfix=postfix, download=True)
-    
-    def upload_input_directory(self, local_dir, prefix, postfix=None):
-        return self.sync_directory(local_dir, local_dir, postfix=postfix, download=False)
-
-    def sync_directory(self, dir1, dir2, postfix=None, download=True):
-
-        from boto.utils import get_instance_metadata
-#         instanceMetadata = get_instance_metadata()["iam"]["security-credentials"]["toil_cluster_toil"]
-#         RealtimeLogger.info("CRED={}".format(instanceMetadata))
-#         os.environ["AWS_ACCESS_KEY_ID"] = instanceMetadata["AccessKeyId"]
-#         os.environ["AWS_SECRET_ACCESS_KEY"] = instanceMetadata["SecretAccessKey"]
-#         os.environ["AWS_SESSION_TOKEN"] = instanceMetadata["Token"]
-#
-#         if not os.path.isfile("~/.aws/credentials"):
-#             if not os.path.isdir("~/.aws"):
-#                 os.makedirs("~/.aws")
-#             with open("~/.aws/credentials", "w") as f:
-#                 print("""[default]
-# aws_access_key_id = {AccessKeyId}
-# aws_secret_access_key = {SecretAccessKey}
-# """.format(**instanceMetadata))
-
-        subprocess.call([sys.executable, "-m", "pip", "install", "awscli", "--upgrade", "--user"])
-
-        import awscli.clidriver
-        driver = awscli.clidriver.create_clidriver()
+    def download_input_directory(self, prefix, local_dir, postfix=None, workers=None):
+        """
+        Download all files under prefix into local_dir, skipping files already
+        there with the same size.
+        """
+
+        return self.sync_directory(prefix, local_dir, postfix=postfix, download=True,
+            workers=workers)
+
+    def upload_input_directory(self, local_dir, prefix, postfix=None, workers=None):
+        """
+        Upload all files in local_dir under prefix, skipping files already
+        there with the same size.
+        """
+
+        return self.sync_directory(local_dir, prefix, postfix=postfix, download=False,
+            workers=workers)
+
+    @backoff
+    def list_sizes(self, prefix=""):
+        """
+        Get the size of every file under prefix (after name_prefix), keyed by
+        its path relative to prefix
+        """
+
+        self.__connect()
+
+        key_prefix = os.path.join(self.name_prefix, prefix)
+        if key_prefix != "" and not key_prefix.endswith("/"):
+            key_prefix += "/"
+
+        sizes = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=key_prefix):
+            for obj in page.get("Contents", []):
+                if not obj["Key"].endswith("/"):
+                    sizes[obj["Key"][len(key_prefix):]] = obj["Size"]
+        return sizes
+
+    def sync_directory(self, dir1, dir2, postfix=None, download=True, workers=None):
+        """
+        Copy files from dir1 to dir2 that are missing or have a different size,
+        like 'aws s3 sync'. If download, dir1 is a prefix in the bucket and dir2
+        a local directory, otherwise dir1 is local and dir2 the prefix. Only
+        files ending with postfix are copied if given.
+
+        Returns a TransferReport and raises a BatchTransferError if any file
+        failed.
+        """
+
+        prefix = dir1 if download else dir2
+        local_dir = dir2 if download else dir1
+
+        remote = self.list_sizes(prefix)
 
         if download:
-            dir1 = "s3://{}/{}".format(self.bucket_name, dir1)
+            files = [(os.path.join(prefix, f), os.path.join(local_dir, f)) for f, size in \
+                remote.items() if not os.path.isfile(os.path.join(local_dir, f)) or \
+                os.path.getsize(os.path.join(local_dir, f)) != size]
         else:
-            dir2 = "s3://{}/{}".format(self.bucket_name, dir2)
+            files = []
+            for dirpath, dirnames, filenames in os.walk(local_dir):
+                for f in filenames:
+                    fpath = os.path.join(dirpath, f)
+                    key = os.path.relpath(fpath, local_dir)
+                    if remote.get(key) != os.path.getsize(fpath):
+                        files.append((fpath, os.path.join(prefix, key)))
 
-        cmd = ["s3", "sync", dir1, dir2]
         if postfix is not None:
-            cmd += ["--exclude=\"*\"", "--include=\"*{}\"".format(postfix)]
-        if self.endpoint_url is not None:
-            cmd = ["--endpoint-url", self.endpoint_url] + cmd
+            files = [(src, dst) for src, dst in files if src.endswith(postfix)]
 
-        rc = driver.main(args=cmd)
+        RealtimeLogger.info("Syncing {} files from {} to {}".format(len(files), dir1, dir2))
 
-        # del os.environ["AWS_ACCESS_KEY_ID"]
-        # del os.environ["AWS_SECRET_ACCESS_KEY"]
-        # del os.environ["AWS_SESSION_TOKEN"]
-        del awscli.clidriver
-
-        if rc != 0:
-            assert 0
-            subprocess.call(["aws", "configure"])
+        if download:
+            return self.read_input_files(files, workers=workers, raise_errors=True)
+        return self.write_output_files(files, workers=workers, raise_errors=True)
 
     def write_output_file(self, local_path, output_path):
         """
@@ -885,9 +1197,10 @@ class S3IOStore(IOStore):
         if os.path.isdir(local_path):
             return self.upload_input_directory(local_path, output_path)
 
-        # Download the file contents.
-        #self.s3.upload_file(local_path, self.bucket_name, os.path.join(self.name_prefix, output_path))
-        self.s3r.Bucket(self.bucket_name).upload_file(local_path, os.path.join(self.name_prefix, output_path))
+        # Upload the file contents, in parts if it is large. The client is
+        # thread safe, unlike the resource
+        self.s3.upload_file(local_path, self.bucket_name, os.path.join(self.name_prefix, output_path),
+            Config=self.transfer_config)
 
     @backoff
     def exists(self, path):
@@ -996,10 +1309,38 @@ class FileS3IOStore(object):
         return self.S3IOStore.list_input_directory(input_path=input_path,
             recursive=recursive, with_times=with_times)
 
-    def download_input_directory(self, prefix, local_dir=None, postfix=None):
-        self.S3IOStore.download_input_directory(path, self.FileIOStore.path_prefix)
+    def read_input_files(self, files, workers=None, raise_errors=False):
+        """
+        Read many files at once from the local copy, downloading the missing
+        ones from S3 into it first. See IOStore.read_input_files.
+        """
+        files = [(f, f) if isinstance(f, str) else tuple(f) for f in files]
+
+        missing = [(src, os.path.join(self.path_prefix, src)) for src, _ in files \
+            if not self.FileIOStore.exists(src)]
+        s3_report = self.S3IOStore.read_input_files(missing, workers=workers)
+        not_found = {src: e for (src, _), e in s3_report.failed.items()}
+
+        report = self.FileIOStore.read_input_files(
+            [(src, dst) for src, dst in files if src not in not_found], workers=workers)
+        report.failed.update({(src, dst): not_found[src] for src, dst in files if src in not_found})
+
+        if raise_errors:
+            report.raise_for_errors()
+
+        return report
+
+    def download_input_directory(self, prefix, local_dir=None, postfix=None, workers=None):
+        """
+        Sync prefix from S3 into the local copy, then link or copy it into
+        local_dir if given.
+        """
+        report = self.S3IOStore.download_input_directory(prefix,
+            os.path.join(self.path_prefix, prefix), postfix=postfix, workers=workers)
         if local_dir is not None:
-            pass
+            report = self.FileIOStore.download_input_directory(prefix, local_dir,
+                postfix=postfix, force=True, workers=workers)
+        return report
 
     def write_output_file(self, local_path, output_path):
         """
@@ -1008,6 +1349,20 @@ class FileS3IOStore(object):
         self.FileIOStore.write_output_file(local_path, output_path)
         self.S3IOStore.write_output_file(local_path, output_path)
 
+    def write_output_files(self, files, workers=None, raise_errors=False):
+        """
+        Write many files at once to the local copy and S3. See
+        IOStore.write_output_files.
+        """
+        local_report = self.FileIOStore.write_output_files(files, workers=workers)
+        report = self.S3IOStore.write_output_files(files, workers=workers)
+        report.failed.update(local_report.failed)
+
+        if raise_errors:
+            report.raise_for_errors()
+
+        return report
+
     @backoff
     def exists(self, path):
         """
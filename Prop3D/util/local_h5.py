@@ -0,0 +1,244 @@
+"""A local HDF5 backend for single node runs without an HSDS server. The file has
+the same hierarchy as the HSDS domain (/{sfam}/domains/{domain}/atom|residue|edges,
+data_splits, representatives).
+
+Concurrent Toil workers cannot write to one HDF5 file directly, so writes go through
+a single writer process (see LocalH5Writer) started by the leader. Workers send it
+functions to run on the open file and the writer executes them one at a time,
+opening the file once for everything that is waiting. If no writer is running, e.g.
+workers on other nodes, writes are serialized with a lock file instead.
+
+Readers open the file with SWMR (single writer multiple reader) when possible. New
+groups cannot be created while a file is in SWMR mode, so the writer only keeps the
+file open while it has requests and readers retry if the file is locked. The writer
+cannot open the file while any reader has it open either, so jobs must not hold a
+read handle across long work: read with call_local_h5(..., mode="r"), which is sent
+to the writer when it is running, or open, read, and close right away.
+"""
+import os
+import time
+import fcntl
+import queue
+import threading
+import traceback
+from contextlib import contextmanager
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client
+from typing import Any, Callable, Iterator
+
+import h5py
+
+try:
+    #Registers blosc and other filters for files written with them
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    pass
+
+from toil.realtimeLogger import RealtimeLogger
+
+LOCAL_PREFIX = "file://"
+AUTHKEY = b"Prop3D-local-h5"
+
+def is_local_h5(path: Any) -> bool:
+    """Check if a path is a local HDF5 file instead of an HSDS domain. Paths starting
+    with file:// are always local (use for files that do not exist yet)"""
+    if not isinstance(path, (str, os.PathLike)):
+        return False
+    path = str(path)
+    return path.startswith(LOCAL_PREFIX) or os.path.isfile(path)
+
+def local_path(path: str) -> str:
+    """Remove the file:// prefix"""
+    path = str(path)
+    if path.startswith(LOCAL_PREFIX):
+        path = path[len(LOCAL_PREFIX):]
+    return os.path.abspath(path)
+
+def writer_address(path: str) -> str:
+    """Unix socket used by the writer for a file"""
+    return local_path(path)+".writer"
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Exclusive lock between processes while writing a local file"""
+    with open(local_path(path)+".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def open_local_h5(path: str, mode: str = "r", retries: int = 100) -> h5py.File:
+    """Open a local HDF5 file. Readers use SWMR if the file supports it and
+    retry while the writer has it locked
+
+    Parameters
+    ----------
+    path : str
+        Path to h5 file (file:// prefix optional)
+    mode : str
+        File mode
+    retries : int
+        Number of times to try opening the file if it is locked
+    """
+    path = local_path(path)
+    for attempt in range(retries):
+        try:
+            if mode == "r":
+                try:
+                    return h5py.File(path, "r", libver="latest", swmr=True)
+                except (OSError, ValueError):
+                    #File not created with libver=latest or in use
+                    return h5py.File(path, "r")
+            else:
+                return h5py.File(path, mode, libver="latest")
+        except OSError:
+            if attempt == retries-1 or not os.path.isfile(path) and mode == "r":
+                raise
+            time.sleep(min(0.1*(attempt+1), 2))
+
+@contextmanager
+def locked_local_h5(path: str, mode: str = "a") -> Iterator[h5py.File]:
+    """Open a local file for writing while holding the lock file"""
+    with file_lock(path):
+        f = open_local_h5(path, mode)
+        try:
+            yield f
+        finally:
+            f.close()
+
+class LocalH5Writer(object):
+    """The single writer for a local HDF5 file. Run with start_local_h5_writer.
+    Each client connection is read on its own thread, while all requests are executed
+    in order on the writer thread.
+
+    Parameters
+    ----------
+    path : str
+        Path to h5 file (file:// prefix optional)
+    """
+    def __init__(self, path: str) -> None:
+        self.path = local_path(path)
+        self.address = writer_address(path)
+        self.requests = queue.Queue()
+
+    def serve(self) -> None:
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        listener = Listener(self.address, family="AF_UNIX", authkey=AUTHKEY)
+        threading.Thread(target=self._write, daemon=True).start()
+        RealtimeLogger.info(f"Local h5 writer for {self.path} listening on {self.address}")
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+    def _handle(self, conn: Any) -> None:
+        try:
+            while True:
+                request = conn.recv()
+                reply = queue.Queue(maxsize=1)
+                self.requests.put((request, reply))
+                conn.send(reply.get())
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _write(self) -> None:
+        while True:
+            waiting = [self.requests.get()]
+            while not self.requests.empty():
+                waiting.append(self.requests.get())
+
+            #Open once for all waiting requests
+            try:
+                with locked_local_h5(self.path, "a") as store:
+                    for (func, args, kwds), reply in waiting:
+                        try:
+                            result = (True, func(store, *args, **kwds))
+                        except Exception as e:
+                            result = (False, RuntimeError(f"{e}\n{traceback.format_exc()}"))
+                        store.flush()
+                        reply.put(result)
+                        #Only unanswered requests are left if the file fails
+                        waiting = waiting[1:]
+            except Exception as e:
+                for _, reply in waiting:
+                    reply.put((False, RuntimeError(f"Unable to open {self.path}: {e}")))
+
+def _run_writer(path: str) -> None:
+    LocalH5Writer(path).serve()
+
+def start_local_h5_writer(path: str) -> Process:
+    """Start the writer process for a local file, stop it with stop_local_h5_writer
+    after all jobs have finished"""
+    process = Process(target=_run_writer, args=(path,), daemon=True)
+    process.start()
+
+    #Wait for the socket
+    address = writer_address(path)
+    for _ in range(100):
+        if os.path.exists(address):
+            break
+        time.sleep(0.05)
+
+    return process
+
+def stop_local_h5_writer(process: Process, path: str) -> None:
+    process.terminate()
+    process.join()
+    try:
+        os.remove(writer_address(path))
+    except OSError:
+        pass
+
+#Connections to writers from this process keyed by socket address
+_clients = {}
+_clients_lock = threading.Lock()
+
+def call_local_h5(path: str, func: Callable, *args: Any, mode: str = "a", **kwds: Any) -> Any:
+    """Run func(store, *args, **kwds) with the local file open. Writes are sent to the
+    writer process if it is running, otherwise the file is opened with the lock file.
+    func must be importable (defined at the top level of a module)
+
+    Parameters
+    ----------
+    path : str
+        Path to h5 file (file:// prefix optional)
+    func : callable
+        Function to run, the open file is the first argument
+    mode : str
+        Mode to use if the file is opened in this process
+    """
+    address = writer_address(path)
+    if os.path.exists(address):
+        with _clients_lock:
+            try:
+                if address not in _clients:
+                    _clients[address] = Client(address, family="AF_UNIX", authkey=AUTHKEY)
+                conn = _clients[address]
+                conn.send((func, args, kwds))
+                success, result = conn.recv()
+            except (OSError, EOFError):
+                #Writer stopped, use the lock file instead
+                _clients.pop(address, None)
+                success = None
+
+        if success is True:
+            return result
+        elif success is False:
+            raise result
+
+    if mode == "r":
+        with file_lock(path):
+            f = open_local_h5(path, "r")
+        try:
+            return func(f, *args, **kwds)
+        finally:
+            f.close()
+
+    with locked_local_h5(path, mode) as f:
+        return func(f, *args, **kwds)
@@ -0,0 +1,135 @@
+"""Compression and chunk layout used when writing feature tables. Each table type
+(atom, residue, edges) can use a different setting, chosen with the environment
+variable PROP3D_TABLE_STORAGE. It is either the name of a preset for all tables, e.g.
+PROP3D_TABLE_STORAGE=lzf, or JSON mapping table types to presets or settings:
+
+    PROP3D_TABLE_STORAGE='{"atom": "blosc-lz4", "edges": {"compression": "gzip", "level": 4, "chunks": 8192}}'
+
+A setting has the keys compression (gzip, lzf, blosc:<cname>, or None), level, shuffle,
+and chunks (rows per chunk, or True to let HSDS/h5py decide). Missing keys come from
+'preset' (default DEFAULT_PRESET), except level and shuffle reset to CODEC_DEFAULTS when
+the compression differs from the preset's. Tables not listed use
+the 'default' entry, which defaults to DEFAULT_PRESET. Blosc in local h5 files
+requires hdf5plugin, HSDS uses its own blosc compressors (blosclz, lz4, lz4hc, zstd, ...)
+"""
+import os
+import json
+from typing import Union, Any
+
+try:
+    import hdf5plugin
+except ImportError:
+    #Only needed to write blosc compressed local files
+    hdf5plugin = None
+
+STORAGE_PRESETS = {
+    "gzip9": {"compression": "gzip", "level": 9, "shuffle": False, "chunks": True},
+    "gzip4": {"compression": "gzip", "level": 4, "shuffle": True, "chunks": True},
+    "gzip1": {"compression": "gzip", "level": 1, "shuffle": True, "chunks": True},
+    "lzf": {"compression": "lzf", "level": None, "shuffle": True, "chunks": True},
+    "blosc-lz4": {"compression": "blosc:lz4", "level": 5, "shuffle": True, "chunks": True},
+    "blosc-zstd": {"compression": "blosc:zstd", "level": 3, "shuffle": True, "chunks": True},
+    "none": {"compression": None, "level": None, "shuffle": False, "chunks": True},
+}
+
+#Setting used before tables were configurable
+DEFAULT_PRESET = "gzip9"
+
+#Level and shuffle used when a setting changes the compression without giving them
+CODEC_DEFAULTS = {
+    "gzip": {"level": 4, "shuffle": True},
+    "lzf": {"level": None, "shuffle": True},
+    "blosc": {"level": 5, "shuffle": True},
+    None: {"level": None, "shuffle": False},
+}
+
+def resolve_storage(setting: Union[str, dict[str, Any], None]) -> dict[str, Any]:
+    """Convert a preset name or partial setting into a full setting"""
+    if setting is None:
+        setting = DEFAULT_PRESET
+    if isinstance(setting, str):
+        try:
+            return dict(STORAGE_PRESETS[setting])
+        except KeyError:
+            raise KeyError(f"Unknown table storage preset '{setting}', choose from {list(STORAGE_PRESETS.keys())}")
+
+    setting = dict(setting)
+    base = resolve_storage(setting.pop("preset", DEFAULT_PRESET))
+    if "compression" in setting and setting["compression"] != base["compression"]:
+        #Options of the preset's codec may not be valid for the new one, e.g. lzf takes no level
+        codec = setting["compression"].split(":", 1)[0] if setting["compression"] else None
+        try:
+            base.update(CODEC_DEFAULTS[codec])
+        except KeyError:
+            base.update({"level": None, "shuffle": False})
+    base.update(setting)
+    return base
+
+def get_storage_config(config: Union[str, dict[str, Any], None] = None) -> dict[str, Any]:
+    """Parse the table storage config (default: PROP3D_TABLE_STORAGE) into table type -> setting"""
+    if config is None:
+        config = os.environ.get("PROP3D_TABLE_STORAGE", DEFAULT_PRESET)
+
+    if isinstance(config, str):
+        config = config.strip()
+        config = json.loads(config) if config.startswith("{") else {"default": config}
+
+    if "compression" in config or "preset" in config:
+        #One setting for all tables
+        config = {"default": config}
+
+    return {table: resolve_storage(setting) for table, setting in config.items()}
+
+def get_table_storage(table: str, storage: Union[str, dict[str, Any], None] = None, local: bool = False) -> dict[str, Any]:
+    """Get the create_table/create_dataset arguments to store a table
+
+    Parameters
+    ----------
+    table : str
+        Table type or full key of the table, e.g. /1/10/10/10/domains/1kq2A00/atom
+    storage : str, dict, or None
+        Preset name, setting, or config for all table types. Default: PROP3D_TABLE_STORAGE
+    local : bool
+        Arguments for a local h5py file instead of HSDS
+
+    Returns
+    -------
+    Keyword arguments, chunks is rows per chunk or True
+    """
+    config = get_storage_config(storage)
+    parts = table.strip("/").split("/")
+    table = parts[-1]
+    if len(parts) > 1 and parts[-2].endswith("_updates"):
+        #Partial updates ({table}_updates/{category}) use the setting of their table
+        table = parts[-2][:-len("_updates")]
+    setting = config.get(table, config.get("default", resolve_storage(None)))
+
+    chunks = setting.get("chunks", True)
+    kwds = {"chunks": True if chunks is None or chunks is True else int(chunks)}
+
+    compression = setting.get("compression")
+    level = setting.get("level")
+    shuffle = bool(setting.get("shuffle", False))
+
+    if compression is None:
+        return kwds
+
+    if compression.startswith("blosc"):
+        cname = compression.split(":", 1)[1] if ":" in compression else "lz4"
+        if local:
+            if hdf5plugin is None:
+                raise ImportError("hdf5plugin must be installed to write blosc compressed h5 files")
+            kwds.update(hdf5plugin.Blosc(cname=cname, clevel=5 if level is None else level,
+                shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+            return kwds
+
+        #HSDS runs blosc compressors by name
+        compression = cname
+
+    kwds["compression"] = compression
+    if level is not None and compression != "lzf":
+        kwds["compression_opts"] = level
+    if shuffle:
+        kwds["shuffle"] = True
+
+    return kwds